@@ -1,8 +1,17 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, Request
 
-from app.api.endpoints import chat
+from app.api.endpoints import chat, metrics
+from app.db.pool import current_endpoint
 
-api_router = APIRouter()
+
+async def tag_endpoint(request: Request) -> None:
+    # Tag the DB pool checkouts done for this request with its route, not its URL:
+    # the paths have ids in them. Async, so it runs in the context of the endpoint.
+    current_endpoint.set(f"{request.method} {request.scope['route'].path}")
+
+
+api_router = APIRouter(dependencies=[Depends(tag_endpoint)])
 
 api_router.include_router(chat.chat_router, prefix="/chat")
+api_router.include_router(metrics.metrics_router, prefix="/metrics")
 # api_router.include_router(users.user_router, prefix="/users")
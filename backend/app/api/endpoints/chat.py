@@ -1,9 +1,11 @@
-from urllib import response
+import time
+import asyncio
 import llama_index
+from contextlib import aclosing
 
-from pathlib import Path
 from typing import Annotated, List
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi import (
     File,
     Form,
@@ -14,36 +16,47 @@ from fastapi import (
     Request,
     status
 )
-from llama_index import StorageContext, VectorStoreIndex, SummaryIndex
-from llama_index.selectors.llm_selectors import LLMSingleSelector
 from llama_index.llms.types import MessageRole, ChatMessage
-from llama_index.retrievers import VectorIndexRetriever, SummaryIndexEmbeddingRetriever, RouterRetriever
-from llama_index.tools import RetrieverTool
-from llama_index.chat_engine import ContextChatEngine
-from llama_index.memory import ChatMemoryBuffer
-from llama_index.vector_stores import (
-    MetadataFilter,
-    MetadataFilters,
-    FilterOperator
-)
-
-from llama_index.callbacks import CallbackManager, LlamaDebugHandler
 
 from app.utils.json_to import json_to_model
-from app.utils.index import get_index
+from app.utils.index import get_index, index_cache
 from app.utils.auth import decode_access_token
-from app.utils.fs import get_s3_fs, get_s3_boto_client
-from app.db.pg_vector import get_vector_store_singleton
-from app.db.crud import get_documents, create_documents, delete_document, is_user_existed
+from app.utils.fs import get_s3_boto_client
+from app.utils.stream import iterate_in_thread, response_tokens, replay_text
+from app.db.crud import (
+    get_documents,
+    create_documents,
+    delete_document,
+    get_documents_version,
+    set_documents_active,
+)
 from app.pydantic_models.chat import ChatData
+from app.pydantic_models.documents import DocumentActivation
 from app.orm_models import Document
-from app.core.ingest import ingest_user_documents
-from app.prompts.system import LLM_SYSTEM_MESSAGE
-from app.prompts.selector import MULTI_SELECT_PROMPT_TEMPLATE, SINGLE_SELECTOR_PROMPT_TEMPLATE
+from app.core.ingest_jobs import (
+    IngestionQueueFull,
+    UploadedFile,
+    ingestion_queue,
+    invalidate_user_caches,
+)
+from app.core.scheduler import inference_scheduler, SchedulerOverloaded
+from app.core.chat_engine import chat_engine_factory
+from app.core.chat_session import ChatSession, SessionMemory, chat_sessions
+from app.core.answer_cache import answer_cache
+from app.core.precompute import document_answers
 
 chat_router = r = APIRouter()
 
 
+async def compact_session(user_id: str, session: ChatSession) -> None:
+    """Summarize the old turns of a session once its response has been sent."""
+    if not session.needs_compaction():
+        return
+    async with inference_scheduler.slot(user_id, wait=True):
+        await asyncio.to_thread(
+            chat_sessions.compact, session, llama_index.global_service_context.llm)
+
+
 @r.post("")
 async def chat(
     request: Request,
@@ -55,15 +68,6 @@ async def chat(
 ):
     # logger = logging.getLogger("uvicorn")
     user_id = token_payload["user_id"]
-    # Only need to retrieve indices from the current user.
-    filters = MetadataFilters(
-        filters=[
-            MetadataFilter(
-                key="user_id",
-                operator=FilterOperator.EQ,
-                value=user_id),
-        ]
-    )
 
     # check preconditions and get last message
     if len(data.messages) == 0:
@@ -77,146 +81,204 @@ async def chat(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Last message must be from user",
         )
-    # convert messages coming from the request to type ChatMessage
-    messages = [
-        ChatMessage(
-            role=m.role,
-            content=m.content,
+    # Continue the server-side session, or start one from the history sent by the client.
+    if data.session_id is not None:
+        session = chat_sessions.get(data.session_id, user_id)
+        if session is None:
+            # Expired, or kept by another worker: answering without its history would
+            # treat a follow-up as a new question.
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Unknown chat session, resend the whole conversation without session_id",
+            )
+    else:
+        # convert messages coming from the request to type ChatMessage
+        messages = [
+            ChatMessage(
+                role=m.role,
+                content=m.content,
+            )
+            for m in data.messages
+        ]
+        session = chat_sessions.create(user_id, messages)
+    headers = {"X-Session-Id": session.id}
+
+    # Standalone questions can be answered from a previous answer to the same question.
+    # Follow-ups depend on the conversation, so they always go to the LLM.
+    question_embedding = None
+    if not session.turns:
+        # The version is shared by the workers: it catches changes made through the others.
+        question_embedding, documents_version = await asyncio.gather(
+            asyncio.to_thread(
+                llama_index.global_service_context.embed_model.get_query_embedding,
+                lastMessage.content),
+            get_documents_version(user_id),
         )
-        for m in data.messages
-    ]
+        answer = await document_answers.lookup(user_id, question_embedding)
+        if answer is None:
+            cached = answer_cache.lookup(user_id, question_embedding, documents_version)
+            answer = cached.answer if cached is not None else None
+        if answer is not None:
+            session.append(ChatMessage(
+                role=MessageRole.USER, content=lastMessage.content))
+            session.append(ChatMessage(
+                role=MessageRole.ASSISTANT, content=answer))
+            return StreamingResponse(
+                replay_text(answer), media_type="text/plain", headers=headers)
 
     # query chat engine
     # system_message = (
     #     "You are a professional job candidate who will answer the recruiter question using the context information."
     #     "If the question is out of scope, kindly apologize and refuse to answer."
     # )
-
-    # Callbacks for observability.
-    # TODO: this is not working.
-    llama_debug = LlamaDebugHandler(print_trace_on_end=True)
-    callback_manager = CallbackManager([llama_debug])
-
-    vs_retriever = VectorIndexRetriever(
-        index=index["vector"],
-        similarity_top_k=3,
-        filters=filters,
-    )
-    summary_retriever = SummaryIndexEmbeddingRetriever(
-        index=index["summary"],
-        similarity_top_k=3,
-    )
-
-    vs_tool = RetrieverTool.from_defaults(
-        retriever=vs_retriever,
-        description="Useful for retrieving specific context from uploaded documents."
-    )
-    summary_tool = RetrieverTool.from_defaults(
-        retriever=summary_retriever,
-        description="Useful to retrieve all context from uploaded documents and summary tasks. Don't use if the question only requires more specific context."
-    )
-
-    # TODO: correct the prompt used by LLM to use router retriever.
-    retriever = RouterRetriever(
-        selector=LLMSingleSelector.from_defaults(
-            # prompt_template_str=SINGLE_SELECTOR_PROMPT_TEMPLATE
-        ),
-        retriever_tools=[vs_tool, summary_tool]
-    )
-
-    chat_engine = ContextChatEngine(
-        retriever=vs_retriever,
-        llm=llama_index.global_service_context.llm,
-        memory=ChatMemoryBuffer.from_defaults(token_limit=4096),
-        prefix_messages=[ChatMessage(
-            role="system", content=LLM_SYSTEM_MESSAGE)],
-        callback_manager=callback_manager,
-    )
-    print(chat_engine._retriever.get_prompts())
-
-    response = chat_engine.stream_chat(lastMessage.content, messages)
+    chat_engine = chat_engine_factory.build(
+        user_id, index, memory=SessionMemory(session))
+    # Bumped by uploads and deletions: an answer from older documents isn't cached.
+    generation = index["generation"]
+
+    def generate_tokens():
+        # Runs on a worker thread: retrieval and generation both block.
+        response = chat_engine.stream_chat(lastMessage.content)
+        try:
+            yield from response_tokens(response)
+        finally:
+            # Stop generating for a client that went away, and only return once
+            # llama.cpp is done with the model.
+            response.stop()
+            response.finished.wait()
+
+    # Tell the client to come back later rather than queueing for too long.
+    try:
+        inference_scheduler.check_admission()
+    except SchedulerOverloaded as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
 
     # stream response
     async def event_generator():
-        for token in response.response_gen:
-            # If client closes connection, stop sending events
-            if await request.is_disconnected():
-                break
-            yield token
+        # The slot is taken by the response body, so a client that leaves before
+        # the body starts holds nothing.
+        await inference_scheduler.acquire(user_id, wait=True)
+        start = time.perf_counter()
+
+        def generation_done() -> None:
+            inference_scheduler.record_service_time(
+                time.perf_counter() - start)
+            inference_scheduler.release()
+
+        answer = ""
+        async with aclosing(
+                iterate_in_thread(generate_tokens, on_done=generation_done)) as tokens:
+            async for token in tokens:
+                # If client closes connection, stop sending events
+                if await request.is_disconnected():
+                    break
+                answer += token
+                yield token
+            else:
+                if (question_embedding is not None and answer.strip()
+                        and index_cache.generation(user_id) == generation):
+                    answer_cache.store(
+                        user_id, lastMessage.content, answer.strip(), question_embedding,
+                        documents_version)
+
+    async def finish_response(body) -> None:
+        # Stop the generation if the body was left suspended by a disconnect.
+        await body.aclose()
+        await compact_session(user_id, session)
+
+    body = event_generator()
+    return StreamingResponse(
+        body,
+        media_type="text/plain",
+        headers=headers,
+        background=BackgroundTask(finish_response, body),
+    )
 
-    return StreamingResponse(event_generator(), media_type="text/plain")
+
+async def submit_upload(
+    user_id: str,
+    files: List[UploadFile],
+    descriptions: List[str],
+    questions: List[str],
+) -> dict:
+    """Create the document rows and queue their ingestion.
+
+    Returns the job with the created documents; they are only usable once the
+    job polled at `/upload/jobs/{id}` is done, and deleted if it fails.
+    """
+    docs = [
+        Document(
+            s3_path=f"{user_id}/{file.filename}",
+            is_active=True,
+            description=description,
+            question=question,
+            user_id=user_id,
+        )
+        for file, description, question in zip(files, descriptions, questions)
+    ]
+    # The upload is read now, the request's file is closed once the response is sent.
+    contents = [await file.read() for file in files]
+    # Create new records in db.
+    docs = await create_documents(docs)
+    uploaded = [
+        UploadedFile(
+            document_id=str(doc.id),
+            s3_path=doc.s3_path,
+            content=content,
+            description=doc.description,
+            question=doc.question,
+        )
+        for doc, content in zip(docs, contents)
+    ]
+    try:
+        job = await ingestion_queue.submit(user_id, uploaded)
+    except IngestionQueueFull as e:
+        for doc in docs:
+            await delete_document(str(doc.id), user_id)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+        )
+    return {**job.to_dict(), "documents": docs}
 
 
-@r.post("/upload/single")
+@r.post("/upload/single", status_code=status.HTTP_202_ACCEPTED)
 async def upload(
     description: Annotated[str, Form()],
     question: Annotated[str, Form()],
     file: Annotated[UploadFile, File()],
-    token_payload: Annotated[dict, Depends(decode_access_token)]
-) -> Document:
-    vector_store = await get_vector_store_singleton()
-    user_id = token_payload["user_id"]
-    user_s3_folder = Path(f"talking-resume/{user_id}")
-    nodes = []
-
-    # Have to use boto because I don't know how to write temporary file to s3 using f3fs.
-    s3 = get_s3_boto_client()
-    doc = Document(
-        s3_path=f"{user_id}/{file.filename}",
-        is_active=True,
-        description=description,
-        question=question,
-        user_id=user_id,
-    )
-    # Create new record in db.
-    doc_in_db = create_documents([doc])[0]
-    doc_uuid = str(doc_in_db.id)
-
-    # Save the document to S3.
-    s3.upload_fileobj(
-        file.file,
-        "talking-resume",
-        doc.s3_path,
-    )
-    nodes = ingest_user_documents(
-        doc_uuid,
-        f"talking-resume/{doc.s3_path}",
-        doc.description,
-        doc.question,
-        doc.user_id
-    )
-
-    # Save documents indices and embeddings.
-    s3 = get_s3_fs()
-    persist_dir = None
-    if await is_user_existed(user_id):
-        persist_dir = f"talking-resume/{user_id}"
-
-    storage_context = StorageContext.from_defaults(
-        vector_store=vector_store,
-        persist_dir=persist_dir,
-        fs=s3)
-    # Vector store index.
-    vector_index = VectorStoreIndex.from_documents(
-        documents=nodes, storage_context=storage_context, show_progress=True)
-    vector_index.set_index_id(f'vector_{user_id}')
-    vector_index.storage_context.persist(persist_dir=user_s3_folder, fs=s3)
-
-    # Summary index.
-    summary_index = SummaryIndex.from_documents(
-        documents=nodes, storage_context=storage_context, show_progress=True)
-    summary_index.set_index_id(f'summary_{user_id}')
-    summary_index.storage_context.persist(persist_dir=user_s3_folder, fs=s3)
-
-    return doc_in_db
+    token_payload: Annotated[dict, Depends(decode_access_token)],
+) -> dict:
+    """Queue the ingestion of a document and return the job to poll."""
+    return await submit_upload(
+        token_payload["user_id"], [file], [description], [question])
+
+
+@r.get("/upload/jobs/{job_id}")
+async def get_upload_job(
+    job_id: str,
+    token_payload: Annotated[dict, Depends(decode_access_token)],
+) -> dict:
+    """Status, per-stage progress and timings of an ingestion job."""
+    job = await ingestion_queue.status(job_id, token_payload["user_id"])
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Ingestion job not found",
+        )
+    return job
 
 
 @r.get("/upload")
-def get_upload(
+async def get_upload(
     user_id: str,
     token_payload: Annotated[dict, Depends(decode_access_token)]
 ) -> List[Document]:
-    documents = get_documents(user_id)
+    documents = await get_documents(user_id)
     for document in documents:
         s3 = get_s3_boto_client()
         s3_url = s3.generate_presigned_url(
@@ -236,57 +298,32 @@ async def delete_upload(
     user_id: str,
 ) -> None:
     await delete_document(document_id, user_id)
+    await invalidate_user_caches(user_id)
+
+
+@r.patch("/upload/active")
+async def set_upload_active(
+    data: DocumentActivation,
+    token_payload: Annotated[dict, Depends(decode_access_token)],
+) -> List[Document]:
+    """Activate or deactivate documents without deleting their embeddings."""
+    user_id = token_payload["user_id"]
+    documents = await set_documents_active(
+        data.document_ids, user_id, data.is_active)
+    await invalidate_user_caches(user_id)
+    return documents
 
 
-@r.post("/upload/multiple")
+@r.post("/upload/multiple", status_code=status.HTTP_202_ACCEPTED)
 async def upload(
     descriptions: Annotated[List[str], Form()],
     questions: Annotated[List[str], Form()],
     files: Annotated[List[UploadFile], File()],
-    token_payload: Annotated[dict, Depends(decode_access_token)]
-) -> List[Document]:
-    vector_store = await get_vector_store_singleton()
-    user_id = token_payload["user_id"]
-    user_s3_folder = Path(f"talking-resume/{user_id}")
-
+    token_payload: Annotated[dict, Depends(decode_access_token)],
+) -> dict:
+    """Queue the ingestion of several documents as one job."""
     # TODO: smartly remove or inactivate documents instead of full deletion.
     # if await is_user_existed(user_id):
     #     await delete_all_documents_from_user(user_id)
-
-    # Have to use boto because I don't know how to write temporary file to s3 using f3fs.
-    s3 = get_s3_boto_client()
-    nodes = []
-    docs = []
-    for user_document, description, question in zip(files, descriptions, questions):
-        doc = Document(
-            s3_path=f"{user_id}/{user_document.filename}",
-            is_active=True,
-            description=description,
-            question=question,
-            user_id=user_id,
-        )
-
-        # Save the document to S3.
-        s3.upload_fileobj(
-            user_document.file,
-            "talking-resume",
-            doc.s3_path,
-        )
-        nodes.extend(ingest_user_documents(
-            f"talking-resume/{doc.s3_path}", doc.description, doc.question, doc.user_id))
-        docs.append(doc)
-
-    # Save documents indices and embeddings.
-    s3 = get_s3_fs()
-    storage_context = StorageContext.from_defaults(
-        vector_store=vector_store, fs=s3)
-
-    # Vector store index.
-    vector_index = VectorStoreIndex.from_documents(
-        documents=nodes, storage_context=storage_context)
-    vector_index.set_index_id(user_id)
-    vector_index.storage_context.persist(persist_dir=user_s3_folder, fs=s3)
-
-    # Create new record in db.
-    docs = create_documents(docs)
-    return docs
+    return await submit_upload(
+        token_payload["user_id"], files, descriptions, questions)
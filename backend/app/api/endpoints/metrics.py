@@ -0,0 +1,34 @@
+import llama_index
+from fastapi import APIRouter
+
+from app.utils.index import index_cache
+from app.core.scheduler import inference_scheduler
+from app.core.embedding import CachedHuggingFaceEmbedding, query_embedding_cache
+from app.core.answer_cache import answer_cache
+from app.core.precompute import document_answers
+from app.core.chat_engine import chat_engine_factory
+from app.core.chat_session import chat_sessions
+from app.core.ingest_jobs import ingestion_queue
+from app.db.session import pool_stats
+
+metrics_router = r = APIRouter()
+
+
+@r.get("")
+async def get_metrics() -> dict:
+    embed_model = llama_index.global_service_context.embed_model
+    embedding_batcher = None
+    if isinstance(embed_model, CachedHuggingFaceEmbedding):
+        embedding_batcher = embed_model.batcher.stats()
+    return {
+        "index_cache": index_cache.stats(),
+        "inference_scheduler": inference_scheduler.stats(),
+        "query_embedding_cache": query_embedding_cache.stats(),
+        "embedding_batcher": embedding_batcher,
+        "answer_cache": answer_cache.stats(),
+        "document_answers": document_answers.stats(),
+        "chat_engine_factory": chat_engine_factory.stats(),
+        "chat_sessions": chat_sessions.stats(),
+        "ingestion": ingestion_queue.stats(),
+        "db_pools": pool_stats(),
+    }
@@ -0,0 +1,137 @@
+import os
+import time
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Cosine similarity above which two questions are considered the same.
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(
+    os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", 0.95))
+ANSWER_CACHE_MAX_ENTRIES_PER_USER = int(
+    os.getenv("ANSWER_CACHE_MAX_ENTRIES_PER_USER", 128))
+ANSWER_CACHE_TTL_SECONDS = float(
+    os.getenv("ANSWER_CACHE_TTL_SECONDS", 24 * 60 * 60))
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    embedding: np.ndarray
+    # Documents version the answer was generated from.
+    version: int = 0
+    created_at: float = field(default_factory=time.monotonic)
+
+
+class SemanticAnswerCache:
+    """Per-user cache of answers, looked up by similarity of the question embedding.
+
+    The embeddings of each user are kept in one matrix so a lookup is a single
+    matrix-vector product. Entries must be invalidated whenever the user's documents
+    change, since the answers were generated from the old context. `invalidate` only
+    reaches this worker: lookups given the current documents version also drop the
+    entries of other versions, whichever worker changed the documents.
+    """
+
+    def __init__(
+        self,
+        threshold: float = ANSWER_CACHE_SIMILARITY_THRESHOLD,
+        max_entries_per_user: int = ANSWER_CACHE_MAX_ENTRIES_PER_USER,
+        ttl: float = ANSWER_CACHE_TTL_SECONDS,
+    ) -> None:
+        self.threshold = threshold
+        self.max_entries_per_user = max_entries_per_user
+        self.ttl = ttl
+        self._entries: Dict[str, List[CachedAnswer]] = {}
+        self._matrices: Dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale = 0
+
+    @staticmethod
+    def _unit(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(
+        self,
+        user_id: str,
+        embedding: List[float],
+        version: Optional[int] = None,
+    ) -> Optional[CachedAnswer]:
+        query = self._unit(embedding)
+        with self._lock:
+            self._expire(user_id, version)
+            matrix = self._matrices.get(user_id)
+            if matrix is None:
+                self.misses += 1
+                return None
+            scores = matrix @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._entries[user_id][best]
+
+    def store(
+        self,
+        user_id: str,
+        question: str,
+        answer: str,
+        embedding: List[float],
+        version: int = 0,
+    ) -> None:
+        with self._lock:
+            entries = self._entries.setdefault(user_id, [])
+            entries.append(CachedAnswer(question, answer, self._unit(embedding), version))
+            del entries[:-self.max_entries_per_user]
+            self._rebuild(user_id)
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+            self._matrices.pop(user_id, None)
+
+    def _expire(self, user_id: str, version: Optional[int] = None) -> None:
+        entries = self._entries.get(user_id)
+        if not entries:
+            return
+        now = time.monotonic()
+        fresh = [e for e in entries if now - e.created_at <= self.ttl]
+        if version is not None:
+            current = [e for e in fresh if e.version == version]
+            self.stale += len(fresh) - len(current)
+            fresh = current
+        if len(fresh) != len(entries):
+            self._entries[user_id] = fresh
+            self._rebuild(user_id)
+
+    def _rebuild(self, user_id: str) -> None:
+        entries = self._entries.get(user_id)
+        if not entries:
+            self._entries.pop(user_id, None)
+            self._matrices.pop(user_id, None)
+            return
+        self._matrices[user_id] = np.stack([e.embedding for e in entries])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._entries),
+                "entries": sum(len(e) for e in self._entries.values()),
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "stale": self.stale,
+            }
+
+
+answer_cache = SemanticAnswerCache()
@@ -0,0 +1,358 @@
+import time
+import logging
+import threading
+from threading import Thread
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+import llama_index
+from llama_index import VectorStoreIndex
+from llama_index.callbacks import CallbackManager, trace_method
+from llama_index.core import BaseRetriever
+from llama_index.selectors.llm_selectors import LLMSingleSelector
+from llama_index.selectors.types import BaseSelector
+from llama_index.llms.types import ChatMessage, MessageRole
+from llama_index.retrievers import VectorIndexRetriever, SummaryIndexEmbeddingRetriever, RouterRetriever
+from llama_index.tools import RetrieverTool
+from llama_index.chat_engine import ContextChatEngine
+from llama_index.chat_engine.types import (
+    AgentChatResponse,
+    StreamingAgentChatResponse,
+    ToolOutput,
+)
+from llama_index.schema import NodeWithScore, QueryBundle
+from llama_index.memory import ChatMemoryBuffer
+from llama_index.memory.types import BaseMemory
+from llama_index.vector_stores import (
+    MetadataFilter,
+    MetadataFilters,
+    FilterOperator
+)
+from llama_index.vector_stores.types import VectorStoreQueryMode
+
+from app.core.router import (
+    ROUTER_LLM_FALLBACK,
+    ROUTER_MODE,
+    ConfidentEmbeddingSelector,
+)
+from app.db.pg_vector import vector_search_kwargs
+from app.prompts.system import LLM_SYSTEM_MESSAGE
+from app.prompts.selector import (
+    VECTOR_TOOL_DESCRIPTION,
+    SUMMARY_TOOL_DESCRIPTION,
+    ROUTER_EXAMPLE_QUERIES,
+)
+from app.utils.index import index_cache
+from app.utils.metrics import LatencyStats
+
+logger = logging.getLogger("uvicorn")
+
+
+@dataclass
+class StoppableChatResponse(StreamingAgentChatResponse):
+    """Streaming chat response whose generation can be stopped from another thread.
+
+    After `stop`, the thread writing the response closes the LLM stream at the next
+    token, so llama.cpp stops generating for a client that went away. `finished` is
+    set once that thread is done with the model.
+    """
+
+    stopped: threading.Event = field(default_factory=threading.Event)
+    finished: threading.Event = field(default_factory=threading.Event)
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def write_response_to_history(self, memory: BaseMemory) -> None:
+        try:
+            final_text = ""
+            message = None
+            for chat in self.chat_stream:
+                if self.stopped.is_set():
+                    break
+                message = chat.message
+                self.put_in_queue(chat.delta)
+                final_text += chat.delta or ""
+            if message is not None:
+                # Only what was generated, when the stream was cut short.
+                message.content = final_text.strip()
+                memory.put(message)
+        except Exception as e:
+            logger.warning(f"Encountered exception writing response to history: {e}")
+        finally:
+            self.chat_stream.close()
+            self._is_done = True
+            self.finished.set()
+
+
+class PrefixStableContextChatEngine(ContextChatEngine):
+    """ContextChatEngine that puts the retrieved context next to the latest question.
+
+    The stock engine writes the context into the system message, so the prompts of
+    two turns differ right after the system prompt. Here the system prompt and the
+    history come first, which lets llama.cpp reuse their KV state. The memory keeps
+    the bare questions, so the history stays small, but then the previous question
+    differs from the prompt it was answered in: the reused prefix ends before it,
+    and the last exchange is prefilled again with the new context and question.
+    """
+
+    def _build_messages(self, message: str) -> Tuple[List[ChatMessage], List[NodeWithScore]]:
+        context_str, nodes = self._generate_context(message)
+        question = ChatMessage(
+            role=MessageRole.USER, content=f"{context_str}\n{message}")
+        initial_token_count = len(
+            self._memory.tokenizer_fn(
+                " ".join([(m.content or "") for m in [*self._prefix_messages, question]])
+            )
+        )
+        history = self._memory.get(initial_token_count=initial_token_count)
+        # The memory ends with the bare question, replace it with the one with context.
+        if history and history[-1].role == MessageRole.USER and history[-1].content == message:
+            history = history[:-1]
+        return [*self._prefix_messages, *history, question], nodes
+
+    @trace_method("chat")
+    def chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> AgentChatResponse:
+        if chat_history is not None:
+            self._memory.set(chat_history)
+        self._memory.put(ChatMessage(content=message, role="user"))
+
+        all_messages, nodes = self._build_messages(message)
+        chat_response = self._llm.chat(all_messages)
+        self._memory.put(chat_response.message)
+
+        return AgentChatResponse(
+            response=str(chat_response.message.content),
+            sources=[
+                ToolOutput(
+                    tool_name="retriever",
+                    content=str(all_messages[-1]),
+                    raw_input={"message": message},
+                    raw_output=all_messages[-1],
+                )
+            ],
+            source_nodes=nodes,
+        )
+
+    @trace_method("chat")
+    def stream_chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> StoppableChatResponse:
+        if chat_history is not None:
+            self._memory.set(chat_history)
+        self._memory.put(ChatMessage(content=message, role="user"))
+
+        all_messages, nodes = self._build_messages(message)
+        chat_response = StoppableChatResponse(
+            chat_stream=self._llm.stream_chat(all_messages),
+            sources=[
+                ToolOutput(
+                    tool_name="retriever",
+                    content=str(all_messages[-1]),
+                    raw_input={"message": message},
+                    raw_output=all_messages[-1],
+                )
+            ],
+            source_nodes=nodes,
+        )
+        thread = Thread(
+            target=chat_response.write_response_to_history, args=(self._memory,)
+        )
+        thread.start()
+
+        return chat_response
+
+
+class ActiveDocumentsRetriever(BaseRetriever):
+    """Drop the nodes of deactivated documents from the results of another retriever.
+
+    For retrievers that can't filter in the database, like the summary index ones.
+    """
+
+    def __init__(
+        self,
+        retriever: BaseRetriever,
+        inactive_doc_uuids: FrozenSet[str],
+        callback_manager: Optional[CallbackManager] = None,
+    ) -> None:
+        self._retriever = retriever
+        self._inactive_doc_uuids = inactive_doc_uuids
+        super().__init__(callback_manager)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return [
+            node for node in self._retriever.retrieve(query_bundle)
+            if node.node.metadata.get("doc_uuid") not in self._inactive_doc_uuids
+        ]
+
+
+@dataclass
+class ChatComponents:
+    """The parts of a chat engine that don't depend on the conversation."""
+
+    vector_index: VectorStoreIndex
+    retriever: BaseRetriever
+    router: Optional[RouterRetriever]
+    prefix_messages: List[ChatMessage]
+
+
+class ChatEngineFactory:
+    """Build chat engines from components cached per user.
+
+    Retrievers, tools, the router and the prefix messages are built once for each
+    loaded index and reused by every request; only the chat memory is created per
+    conversation. The components are rebuilt when the index cache hands out a new
+    index object, i.e. after the user's documents changed, and dropped when the
+    index cache evicts the user so they don't keep the indices alive.
+    """
+
+    def __init__(self) -> None:
+        self._components: Dict[str, ChatComponents] = {}
+        self._lock = threading.Lock()
+        # Plain callback manager: a LlamaDebugHandler would keep every event of
+        # every request in memory once shared.
+        self.callback_manager = CallbackManager([])
+        self.setup_time = LatencyStats()
+        self._selector = None
+        self.hits = 0
+        self.builds = 0
+
+    @property
+    def selector(self) -> BaseSelector:
+        """Tool selector shared by the routers of all users."""
+        if self._selector is None:
+            if ROUTER_MODE == "llm":
+                self._selector = LLMSingleSelector.from_defaults()
+            else:
+                self._selector = ConfidentEmbeddingSelector(
+                    embed_model=llama_index.global_service_context.embed_model,
+                    fallback=(
+                        LLMSingleSelector.from_defaults() if ROUTER_LLM_FALLBACK else None),
+                    examples=ROUTER_EXAMPLE_QUERIES,
+                )
+        return self._selector
+
+    def _build_components(self, user_id: str, index: dict) -> ChatComponents:
+        # Only need to retrieve indices from the current user's active documents.
+        filters = MetadataFilters(
+            filters=[
+                MetadataFilter(
+                    key="user_id",
+                    operator=FilterOperator.EQ,
+                    value=user_id),
+                MetadataFilter(
+                    key="is_active",
+                    operator=FilterOperator.EQ,
+                    value="true"),
+            ]
+        )
+        # Rank fusion with full text search when the store supports it.
+        query_mode = VectorStoreQueryMode.DEFAULT
+        if getattr(index["vector"].vector_store, "hybrid_search", False):
+            query_mode = VectorStoreQueryMode.HYBRID
+        vs_retriever = VectorIndexRetriever(
+            index=index["vector"],
+            similarity_top_k=3,
+            vector_store_query_mode=query_mode,
+            filters=filters,
+            callback_manager=self.callback_manager,
+            vector_store_kwargs=vector_search_kwargs(),
+        )
+
+        router = None
+        if ROUTER_MODE != "none" and "summary" in index:
+            summary_retriever = SummaryIndexEmbeddingRetriever(
+                index=index["summary"],
+                similarity_top_k=3,
+            )
+            inactive_doc_uuids = index.get("inactive_doc_uuids", frozenset())
+            if inactive_doc_uuids:
+                summary_retriever = ActiveDocumentsRetriever(
+                    summary_retriever, inactive_doc_uuids)
+            vs_tool = RetrieverTool.from_defaults(
+                retriever=vs_retriever,
+                description=VECTOR_TOOL_DESCRIPTION
+            )
+            summary_tool = RetrieverTool.from_defaults(
+                retriever=summary_retriever,
+                description=SUMMARY_TOOL_DESCRIPTION
+            )
+            router = RouterRetriever(
+                selector=self.selector,
+                retriever_tools=[vs_tool, summary_tool]
+            )
+
+        return ChatComponents(
+            vector_index=index["vector"],
+            retriever=router if router is not None else vs_retriever,
+            router=router,
+            prefix_messages=[ChatMessage(
+                role="system", content=LLM_SYSTEM_MESSAGE)],
+        )
+
+    def get_components(self, user_id: str, index: dict) -> ChatComponents:
+        with self._lock:
+            components = self._components.get(user_id)
+            if components is not None and components.vector_index is index["vector"]:
+                self.hits += 1
+                return components
+            components = self._build_components(user_id, index)
+            self._components[user_id] = components
+            self.builds += 1
+            return components
+
+    def build(
+        self,
+        user_id: str,
+        index: dict,
+        memory: Optional[BaseMemory] = None,
+        cache: bool = True,
+    ) -> ContextChatEngine:
+        """Create a chat engine for one conversation turn.
+
+        Args:
+            user_id (str): the owner of the index.
+            index (dict): the user's summary and vector indices.
+            memory (Optional[BaseMemory], optional): the conversation memory.
+                Defaults to a fresh ChatMemoryBuffer.
+            cache (bool, optional): reuse and keep the user's components. Turn it
+                off for indices the index cache doesn't hand out. Defaults to True.
+        """
+        start = time.perf_counter()
+        if cache:
+            components = self.get_components(user_id, index)
+        else:
+            components = self._build_components(user_id, index)
+        chat_engine = PrefixStableContextChatEngine(
+            retriever=components.retriever,
+            llm=llama_index.global_service_context.llm,
+            memory=memory or ChatMemoryBuffer.from_defaults(token_limit=4096),
+            prefix_messages=components.prefix_messages,
+            callback_manager=self.callback_manager,
+        )
+        self.setup_time.observe(time.perf_counter() - start)
+        return chat_engine
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock:
+            self._components.pop(user_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {
+                "users": len(self._components),
+                "hits": self.hits,
+                "builds": self.builds,
+                "setup_time": self.setup_time.stats(),
+                "router_mode": ROUTER_MODE,
+                "router_llm_fallback": ROUTER_LLM_FALLBACK,
+            }
+            if isinstance(self._selector, ConfidentEmbeddingSelector):
+                stats["router"] = self._selector.stats()
+            return stats
+
+
+chat_engine_factory = ChatEngineFactory()
+index_cache.on_evict(chat_engine_factory.invalidate)
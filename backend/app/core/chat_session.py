@@ -0,0 +1,235 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Optional
+
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.llms.llm import LLM
+from llama_index.llms.types import ChatMessage, MessageRole
+from llama_index.memory.types import BaseMemory
+from llama_index.utils import GlobalsHelper
+
+from app.prompts.system import CONVERSATION_SUMMARY_PROMPT
+
+logger = logging.getLogger("uvicorn")
+
+CHAT_SESSION_TTL_SECONDS = float(os.getenv("CHAT_SESSION_TTL_SECONDS", 2 * 60 * 60))
+CHAT_SESSION_MAX_COUNT = int(os.getenv("CHAT_SESSION_MAX_COUNT", 10000))
+# Tokens of history (summary included) sent to the LLM with each turn.
+CHAT_SESSION_TOKEN_BUDGET = int(os.getenv("CHAT_SESSION_TOKEN_BUDGET", 2048))
+# Tokens of recent turns kept verbatim when older turns are compacted.
+CHAT_SESSION_KEEP_TOKENS = int(os.getenv("CHAT_SESSION_KEEP_TOKENS", 1024))
+
+
+def count_tokens(text: str) -> int:
+    # Same tokenizer as the chat engines use for their prefix messages.
+    return len(GlobalsHelper().tokenizer(text))
+
+
+@dataclass
+class SessionTurn:
+    message: ChatMessage
+    tokens: int
+
+
+@dataclass
+class ChatSession:
+    """Conversation kept on the server, with the token count of each message.
+
+    Turns that no longer fit in the token budget are folded into a running summary
+    by `compact`, so the prompt size stays bounded however long the conversation.
+    """
+
+    id: str
+    user_id: str
+    turns: List[SessionTurn] = field(default_factory=list)
+    summary: Optional[str] = None
+    summary_tokens: int = 0
+    total_tokens: int = 0
+    last_used: float = field(default_factory=time.monotonic)
+    _lock: threading.RLock = field(
+        default_factory=threading.RLock, init=False, repr=False)
+
+    def append(self, message: ChatMessage) -> None:
+        tokens = count_tokens(message.content or "")
+        with self._lock:
+            self.turns.append(SessionTurn(message, tokens))
+            self.total_tokens += tokens
+
+    def reset(self, messages: Optional[List[ChatMessage]] = None) -> None:
+        with self._lock:
+            self.turns = []
+            self.summary = None
+            self.summary_tokens = 0
+            self.total_tokens = 0
+            for message in messages or []:
+                self.append(message)
+
+    @property
+    def messages(self) -> List[ChatMessage]:
+        with self._lock:
+            return [turn.message for turn in self.turns]
+
+    def history(self, token_limit: int) -> List[ChatMessage]:
+        """The summary and the most recent turns that fit in `token_limit` tokens."""
+        with self._lock:
+            budget = token_limit - self.summary_tokens
+            start = len(self.turns)
+            while start > 0 and self.turns[start - 1].tokens <= budget:
+                budget -= self.turns[start - 1].tokens
+                start -= 1
+            # The history can't start with an assistant message.
+            while start < len(self.turns) and self.turns[start].message.role == MessageRole.ASSISTANT:
+                start += 1
+            messages = [turn.message for turn in self.turns[start:]]
+            if self.summary:
+                messages.insert(0, ChatMessage(
+                    role=MessageRole.SYSTEM,
+                    content=f"Summary of the earlier conversation: {self.summary}"))
+            return messages
+
+    def needs_compaction(self, token_budget: int = CHAT_SESSION_TOKEN_BUDGET) -> bool:
+        return self.summary_tokens + self.total_tokens > token_budget
+
+    def compact(
+        self,
+        summarize: Callable[[Optional[str], List[ChatMessage]], str],
+        keep_tokens: int = CHAT_SESSION_KEEP_TOKENS,
+    ) -> None:
+        """Fold every turn but the most recent `keep_tokens` into the summary."""
+        with self._lock:
+            keep = 0
+            kept_tokens = 0
+            while keep < len(self.turns) and kept_tokens + self.turns[-keep - 1].tokens <= keep_tokens:
+                kept_tokens += self.turns[-keep - 1].tokens
+                keep += 1
+            old_turns = self.turns[:len(self.turns) - keep]
+            if not old_turns:
+                return
+            summary = self.summary
+        new_summary = summarize(summary, [turn.message for turn in old_turns])
+        with self._lock:
+            # Turns appended meanwhile are after the compacted ones, keep them.
+            self.turns = self.turns[len(old_turns):]
+            self.total_tokens = sum(turn.tokens for turn in self.turns)
+            self.summary = new_summary
+            self.summary_tokens = count_tokens(new_summary)
+
+
+def summarize_with_llm(llm: LLM) -> Callable[[Optional[str], List[ChatMessage]], str]:
+    def summarize(summary: Optional[str], messages: List[ChatMessage]) -> str:
+        conversation = "\n".join(
+            f"{message.role.value}: {message.content}" for message in messages)
+        prompt = CONVERSATION_SUMMARY_PROMPT.format(
+            summary=summary or "(none)", conversation=conversation)
+        return llm.complete(prompt).text.strip()
+    return summarize
+
+
+class SessionMemory(BaseMemory):
+    """Chat memory backed by a `ChatSession`, so token counts are never recomputed."""
+
+    # Limit for the prompt prefix (system prompt and context) plus the history.
+    token_limit: int = 4096
+    # Chat engines count the tokens of their prefix messages with it.
+    tokenizer_fn: Callable[[str], List] = Field(
+        default_factory=lambda: GlobalsHelper().tokenizer, exclude=True)
+    _session: ChatSession = PrivateAttr()
+
+    def __init__(self, session: ChatSession, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._session = session
+
+    @classmethod
+    def from_defaults(
+        cls,
+        chat_history: Optional[List[ChatMessage]] = None,
+        llm: Optional[LLM] = None,
+    ) -> "SessionMemory":
+        session = ChatSession(id=uuid.uuid4().hex, user_id="")
+        session.reset(chat_history)
+        return cls(session)
+
+    @property
+    def session(self) -> ChatSession:
+        return self._session
+
+    def get(self, initial_token_count: int = 0, **kwargs: Any) -> List[ChatMessage]:
+        return self._session.history(self.token_limit - initial_token_count)
+
+    def get_all(self) -> List[ChatMessage]:
+        return self._session.messages
+
+    def put(self, message: ChatMessage) -> None:
+        self._session.append(message)
+
+    def set(self, messages: List[ChatMessage]) -> None:
+        self._session.reset(messages)
+
+    def reset(self) -> None:
+        self._session.reset()
+
+
+class ChatSessionStore:
+    """In-process LRU/TTL store of chat sessions."""
+
+    def __init__(
+        self,
+        max_sessions: int = CHAT_SESSION_MAX_COUNT,
+        ttl: float = CHAT_SESSION_TTL_SECONDS,
+    ) -> None:
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.expired = 0
+        self.compactions = 0
+
+    def create(self, user_id: str, messages: Optional[List[ChatMessage]] = None) -> ChatSession:
+        session = ChatSession(id=uuid.uuid4().hex, user_id=user_id)
+        session.reset(messages)
+        with self._lock:
+            self._sessions[session.id] = session
+            self.created += 1
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.expired += 1
+        return session
+
+    def get(self, session_id: str, user_id: str) -> Optional[ChatSession]:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or session.user_id != user_id:
+                return None
+            if time.monotonic() - session.last_used > self.ttl:
+                del self._sessions[session_id]
+                self.expired += 1
+                return None
+            session.last_used = time.monotonic()
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def compact(self, session: ChatSession, llm: LLM) -> None:
+        """Summarize the old turns of a session if it went over its token budget."""
+        if not session.needs_compaction():
+            return
+        session.compact(summarize_with_llm(llm))
+        with self._lock:
+            self.compactions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "created": self.created,
+                "expired": self.expired,
+                "compactions": self.compactions,
+            }
+
+
+chat_sessions = ChatSessionStore()
@@ -82,6 +82,7 @@ class Settings(PreviewPrefixedSettings):
     LOADER_IO_VERIFICATION_STR: str = "loaderio-e51043c635e0f4656473d3570ae5d9ec"
     SEC_EDGAR_COMPANY_NAME: str = "YourOrgName"
     SEC_EDGAR_EMAIL: EmailStr = "you@example.com"
+    WORKER_COUNT: Optional[int] = None
 
     # BACKEND_CORS_ORIGINS is a JSON-formatted list of origins
     # e.g: '["http://localhost", "http://localhost:4200", "http://localhost:3000", \
@@ -154,6 +155,9 @@ class Settings(PreviewPrefixedSettings):
 
     @property
     def UVICORN_WORKER_COUNT(self) -> int:
+        # Size this from the inference scheduler metrics served at /api/metrics.
+        if self.WORKER_COUNT is not None:
+            return self.WORKER_COUNT
         if self.ENVIRONMENT == AppEnvironment.LOCAL:
             return 1
         # The recommended number of workers is (2 x $num_cores) + 1:
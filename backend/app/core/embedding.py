@@ -0,0 +1,289 @@
+import os
+import re
+import time
+import array
+import queue
+import hashlib
+import sqlite3
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Sequence
+
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.embeddings import HuggingFaceEmbedding
+
+logger = logging.getLogger("uvicorn")
+
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 4096))
+# Optional SQLite file backing the in-memory cache, so it survives restarts.
+QUERY_EMBEDDING_CACHE_PATH = os.getenv("QUERY_EMBEDDING_CACHE_PATH")
+# Texts of concurrent callers submitted within that window share a forward pass.
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", 5))
+EMBED_BATCH_MAX_SIZE = int(os.getenv("EMBED_BATCH_MAX_SIZE", 64))
+# Padded tokens of a forward pass: short texts get larger batches than long ones.
+EMBED_BATCH_MAX_TOKENS = int(os.getenv("EMBED_BATCH_MAX_TOKENS", 16384))
+
+
+def normalize_query(text: str) -> str:
+    """Normalize a query so that trivially different spellings share a cache entry.
+
+    BGE tokenizers are uncased, so lowercasing doesn't change the embedding.
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = re.sub(r"\s+", " ", text)
+    return text.strip(" ?!.")
+
+
+def chunk_key(model_name: str, text: str) -> str:
+    """Key of a chunk in the persistent embedding cache."""
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+
+class QueryEmbeddingCache:
+    """LRU cache of query embeddings keyed by embedding model and normalized query."""
+
+    def __init__(self, max_entries: int, path: Optional[str] = None) -> None:
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings "
+                "(key TEXT PRIMARY KEY, embedding BLOB NOT NULL)")
+            self._db.commit()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model_name: str, query: str) -> str:
+        return hashlib.sha1(
+            f"{model_name}\0{normalize_query(query)}".encode("utf-8")).hexdigest()
+
+    def get(self, model_name: str, query: str) -> Optional[List[float]]:
+        key = self.key(model_name, query)
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return embedding
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT embedding FROM query_embeddings WHERE key = ?",
+                    (key,)).fetchone()
+                if row is not None:
+                    embedding = array.array("f", row[0]).tolist()
+                    self._remember(key, embedding)
+                    self.disk_hits += 1
+                    return embedding
+            self.misses += 1
+            return None
+
+    def put(self, model_name: str, query: str, embedding: List[float]) -> None:
+        key = self.key(model_name, query)
+        with self._lock:
+            self._remember(key, embedding)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?)",
+                    (key, array.array("f", embedding).tobytes()))
+                self._db.commit()
+
+    def _remember(self, key: str, embedding: List[float]) -> None:
+        self._entries[key] = embedding
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "disk": self._db is not None,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+
+query_embedding_cache = QueryEmbeddingCache(
+    QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_PATH)
+
+
+@dataclass
+class EmbeddingRequest:
+    texts: List[str]
+    results: List[Optional[List[float]]]
+    future: Future = field(default_factory=Future)
+
+
+class EmbeddingBatcher:
+    """Merge the texts of concurrent callers into large, length-bucketed batches.
+
+    Callers block in `embed` while a single worker thread collects every text
+    submitted within `max_wait` seconds of the first one. The texts are grouped
+    by token length into buckets, so short chunks aren't padded to the length of
+    the longest one, and each bucket runs in forward passes of at most
+    `max_batch_tokens` padded tokens. Results are handed back to each caller.
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[List[str]], List[List[float]]],
+        count_tokens: Callable[[List[str]], List[int]],
+        max_wait: float = EMBED_BATCH_WAIT_MS / 1000,
+        max_batch_size: int = EMBED_BATCH_MAX_SIZE,
+        max_batch_tokens: int = EMBED_BATCH_MAX_TOKENS,
+        buckets: Sequence[int] = (32, 64, 128, 256, 512),
+    ) -> None:
+        self.embed_fn = embed_fn
+        self.count_tokens = count_tokens
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.buckets = sorted(buckets)
+        self._pending: "queue.Queue[EmbeddingRequest]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.texts = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        request = EmbeddingRequest(texts=texts, results=[None] * len(texts))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="embedding-batcher", daemon=True)
+                self._thread.start()
+        self._pending.put(request)
+        return request.future.result()
+
+    def _collect(self) -> List[EmbeddingRequest]:
+        requests = [self._pending.get()]
+        count = len(requests[0].texts)
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._pending.get(timeout=timeout)
+            except queue.Empty:
+                break
+            requests.append(request)
+            count += len(request.texts)
+        return requests
+
+    def _bucket(self, length: int) -> int:
+        for bucket in self.buckets:
+            if length <= bucket:
+                return bucket
+        return self.buckets[-1]
+
+    def _run(self) -> None:
+        while True:
+            requests = self._collect()
+            try:
+                self._embed_requests(requests)
+            except Exception as e:
+                for request in requests:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def _embed_requests(self, requests: List[EmbeddingRequest]) -> None:
+        items = [
+            (request, i, text)
+            for request in requests for i, text in enumerate(request.texts)
+        ]
+        lengths = self.count_tokens([text for _, _, text in items])
+        buckets: Dict[int, list] = {}
+        for item, length in zip(items, lengths):
+            buckets.setdefault(self._bucket(length), []).append((length, item))
+
+        for bucket, bucket_items in sorted(buckets.items()):
+            # Sorted by length, each batch is padded to a close length.
+            bucket_items.sort(key=lambda length_item: length_item[0])
+            size = max(1, min(self.max_batch_size, self.max_batch_tokens // bucket))
+            for start in range(0, len(bucket_items), size):
+                batch = bucket_items[start:start + size]
+                embeddings = self.embed_fn([text for _, (_, _, text) in batch])
+                for (_, (request, i, _)), embedding in zip(batch, embeddings):
+                    request.results[i] = embedding
+                with self._lock:
+                    self.batches += 1
+                    self.tokens += sum(length for length, _ in batch)
+                    self.padded_tokens += len(batch) * batch[-1][0]
+
+        with self._lock:
+            self.requests += len(requests)
+            self.texts += len(items)
+        for request in requests:
+            request.future.set_result(request.results)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "texts": self.texts,
+                "mean_batch_size": self.texts / self.batches if self.batches else 0.0,
+                "padding_efficiency": (
+                    self.tokens / self.padded_tokens if self.padded_tokens else 1.0),
+                "queued": self._pending.qsize(),
+            }
+
+
+class CachedHuggingFaceEmbedding(HuggingFaceEmbedding):
+    """HuggingFaceEmbedding that skips the forward pass for queries seen before.
+
+    The forward passes of all callers go through a shared `EmbeddingBatcher`.
+    """
+
+    _query_cache: QueryEmbeddingCache = PrivateAttr()
+    _batcher: EmbeddingBatcher = PrivateAttr()
+
+    def __init__(self, *args, query_cache: Optional[QueryEmbeddingCache] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._query_cache = query_cache or query_embedding_cache
+        self._batcher = EmbeddingBatcher(self._forward, self._count_tokens)
+
+    @property
+    def batcher(self) -> EmbeddingBatcher:
+        return self._batcher
+
+    def _count_tokens(self, texts: List[str]) -> List[int]:
+        encoded = self._tokenizer(texts, max_length=self.max_length, truncation=True)
+        return [len(ids) for ids in encoded["input_ids"]]
+
+    def _forward(self, sentences: List[str]) -> List[List[float]]:
+        import torch
+
+        with torch.inference_mode():
+            return super()._embed(sentences)
+
+    def _embed(self, sentences: List[str]) -> List[List[float]]:
+        return self._batcher.embed(sentences)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedHuggingFaceEmbedding"
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        embedding = self._query_cache.get(self.model_name, query)
+        if embedding is None:
+            embedding = super()._get_query_embedding(query)
+            self._query_cache.put(self.model_name, query, embedding)
+        return embedding
@@ -1,34 +1,62 @@
 import logging
 import uuid as uuid_pkg
+from typing import Iterator, List
 
 from app.utils.fs import get_s3_fs
 from app.utils.reader import PDFReader, PyMuPDFReader
 from llama_index.node_parser import UnstructuredElementNodeParser
-from llama_index.schema import IndexNode
+from llama_index.schema import Document, IndexNode
 
 logger = logging.getLogger("uvicorn")
 
 
-def ingest_user_documents(
+# Kept out of the LLM prompts.
+HIDDEN_METADATA_KEYS = ["user_id", "is_active", "doc_uuid", "description", "question"]
+# Identifiers of an upload, kept out of the embedded text so a file uploaded again
+# has the same embeddings. The description and question are embedded: they help
+# retrieval, and a re-upload with other ones is embedded again.
+UPLOAD_METADATA_KEYS = ["user_id", "is_active", "doc_uuid", "file_path"]
+
+
+def tag_user_document(
+    doc: Document,
+    user_document_id: str,
+    description: str,
+    question: str,
+    user_id: str,
+) -> Document:
+    # Add extra metadata on each node.
+    doc.metadata["doc_uuid"] = user_document_id
+    doc.metadata["user_id"] = user_id
+    doc.metadata["description"] = description
+    doc.metadata["question"] = question
+    doc.metadata["is_active"] = True
+    doc.excluded_llm_metadata_keys = list(HIDDEN_METADATA_KEYS)
+    doc.excluded_embed_metadata_keys = list(UPLOAD_METADATA_KEYS)
+    return doc
+
+
+def iter_user_documents(
     # user_document: BinaryIO,
     user_document_id: str,
     user_document_path: str,
     description: str,
     question: str,
     user_id: str,
-):
+) -> Iterator[Document]:
+    """Yield the pages of a user document as they are extracted."""
     # PDFReader = download_loader("PDFReader")
     loader = PyMuPDFReader()
-    documents = loader.load_data(user_document_path, fs=get_s3_fs())
+    for doc in loader.iter_load(user_document_path, fs=get_s3_fs()):
+        yield tag_user_document(doc, user_document_id, description, question, user_id)
 
-    # Add extra metadata on each node.
-    for doc in documents:
-        doc.metadata["doc_uuid"] = user_document_id
-        doc.metadata["user_id"] = user_id
-        doc.metadata["description"] = description
-        doc.metadata["question"] = question
-        doc.metadata["is_active"] = True
-        # Don't let the LLM see these metadata.
-        doc.excluded_llm_metadata_keys = [
-            "user_id", "is_active", "doc_uuid", "description", "question"]
-    return documents
+
+def ingest_user_documents(
+    user_document_id: str,
+    user_document_path: str,
+    description: str,
+    question: str,
+    user_id: str,
+) -> List[Document]:
+    return list(iter_user_documents(
+        user_document_id, user_document_path, description, question, user_id))
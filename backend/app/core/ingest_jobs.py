@@ -0,0 +1,493 @@
+import io
+import os
+import time
+import uuid
+import asyncio
+import logging
+import concurrent.futures
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+import llama_index
+from llama_index import StorageContext, VectorStoreIndex, SummaryIndex
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.ingestion import run_transformations
+from llama_index.schema import BaseNode, Document, MetadataMode
+
+from app.core.answer_cache import answer_cache
+from app.core.chat_engine import chat_engine_factory
+from app.core.embedding import chunk_key
+from app.core.ingest import iter_user_documents
+from app.core.precompute import document_answers, precompute_document_answer
+from app.db.crud import (
+    bump_documents_version,
+    delete_document,
+    delete_ingestion_jobs_before,
+    get_cached_embeddings,
+    get_documents,
+    get_ingestion_job,
+    is_user_existed,
+    save_ingestion_job,
+    store_cached_embeddings,
+    user_ingestion_lock,
+)
+from app.db.pg_vector import get_vector_store_singleton
+from app.utils.fs import get_s3_boto_client
+from app.utils.index import (
+    INDEX_DELTA_COMPACT_THRESHOLD,
+    compact_user_indices,
+    index_cache,
+    load_user_indices,
+    user_persist_dir,
+    write_index_delta,
+)
+from app.utils.metrics import LatencyStats
+
+logger = logging.getLogger("uvicorn")
+
+# Jobs running at once; the others wait in the queue.
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 2))
+# Uploads are refused when that many jobs are already waiting.
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 100))
+# Attempts of each stage before the job fails, with an exponential backoff.
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", 3))
+INGEST_RETRY_BACKOFF_SECONDS = float(os.getenv("INGEST_RETRY_BACKOFF_SECONDS", 2))
+# Finished jobs are kept that long for the status endpoint.
+INGEST_JOB_TTL_SECONDS = float(os.getenv("INGEST_JOB_TTL_SECONDS", 24 * 60 * 60))
+
+
+async def invalidate_user_caches(user_id: str) -> None:
+    """Drop everything cached from the user's documents after they change."""
+    # The other workers find out from the version.
+    await bump_documents_version(user_id)
+    index_cache.invalidate(user_id)
+    chat_engine_factory.invalidate(user_id)
+    answer_cache.invalidate(user_id)
+    document_answers.invalidate(user_id)
+
+
+class IngestionQueueFull(Exception):
+    """Raised when an upload comes in while the ingestion queue is full."""
+
+
+@dataclass
+class UploadedFile:
+    """A file of an upload, read in memory so the request can return right away."""
+
+    document_id: str
+    s3_path: str
+    content: bytes
+    description: str
+    question: str
+
+
+@dataclass
+class StageStatus:
+    name: str
+    status: str = "pending"
+    progress: float = 0.0
+    attempts: int = 0
+    seconds: Optional[float] = None
+    error: Optional[str] = None
+
+
+@dataclass
+class IngestionJob:
+    """Upload of one or more documents going through the ingestion stages."""
+
+    id: str
+    user_id: str
+    files: List[UploadedFile]
+    stages: Dict[str, StageStatus]
+    status: str = "queued"
+    error: Optional[str] = None
+    # Chunks whose embedding was found in the embedding cache.
+    cached_embeddings: int = 0
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    # Outputs of the stages, kept between attempts.
+    persist_dir: Optional[str] = None
+    # Deltas replayed on the user's indices, None when they are built from scratch.
+    delta_paths: Optional[List[str]] = None
+    documents: List[Document] = field(default_factory=list)
+    nodes: List[BaseNode] = field(default_factory=list)
+    # Embeddings of the chunks started while the next pages are parsed.
+    embed_futures: List[concurrent.futures.Future] = field(default_factory=list)
+    storage_context: Optional[StorageContext] = None
+    indices: Dict[str, object] = field(default_factory=dict)
+
+    @property
+    def document_ids(self) -> List[str]:
+        return [file.document_id for file in self.files]
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "document_ids": self.document_ids,
+            "cached_embeddings": self.cached_embeddings,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "stages": [vars(stage) for stage in self.stages.values()],
+        }
+
+
+async def upload_files(job: IngestionJob) -> None:
+    s3 = get_s3_boto_client()
+    for i, file in enumerate(job.files):
+        await asyncio.to_thread(
+            s3.upload_fileobj, io.BytesIO(file.content), "talking-resume", file.s3_path)
+        job.stages["upload"].progress = (i + 1) / len(job.files)
+    # The bytes are in S3 now, don't keep them for the job's lifetime.
+    for file in job.files:
+        file.content = b""
+
+
+async def delete_uploaded_files(job: IngestionJob) -> None:
+    """Remove the objects uploaded by a failed job from S3."""
+    # An earlier document of the user may have been uploaded under the same name.
+    in_use = {document.s3_path for document in await get_documents(job.user_id)}
+    s3 = get_s3_boto_client()
+    for file in job.files:
+        if file.s3_path in in_use:
+            continue
+        try:
+            await asyncio.to_thread(
+                s3.delete_object, Bucket="talking-resume", Key=file.s3_path)
+        except Exception as e:
+            logger.warning(f"Could not delete {file.s3_path} from S3: {e}")
+
+
+async def parse_files(job: IngestionJob) -> None:
+    service_context = llama_index.global_service_context
+    stage = job.stages["parse"]
+    loop = asyncio.get_running_loop()
+    # One group embedded at a time, the cache lookup is batched per group.
+    embed_lock = asyncio.Lock()
+    documents, nodes, pending = [], [], []
+    # Left over by a failed attempt: their chunks are parsed again.
+    for future in job.embed_futures:
+        future.cancel()
+    job.embed_futures = []
+    job.cached_embeddings = 0
+
+    async def embed_group(group: List[BaseNode]) -> None:
+        async with embed_lock:
+            await embed_chunks(job, group, service_context.embed_model)
+
+    def embed_pending() -> None:
+        job.embed_futures.append(
+            asyncio.run_coroutine_threadsafe(embed_group(pending[:]), loop))
+        pending.clear()
+
+    def parse(i: int, file: UploadedFile) -> None:
+        # Pages are chunked as they come out of the reader, and the chunks
+        # embedded, while the next ones are still being extracted.
+        for document in iter_user_documents(
+            file.document_id,
+            f"talking-resume/{file.s3_path}",
+            file.description,
+            file.question,
+            job.user_id,
+        ):
+            documents.append(document)
+            chunks = run_transformations([document], service_context.transformations)
+            nodes.extend(chunks)
+            pending.extend(chunks)
+            if len(pending) >= service_context.embed_model.embed_batch_size:
+                embed_pending()
+            page = int(document.metadata.get("source", 1))
+            pages = document.metadata.get("total_pages") or 1
+            stage.progress = (i + page / pages) / len(job.files)
+
+    for i, file in enumerate(job.files):
+        await asyncio.to_thread(parse, i, file)
+    if pending:
+        embed_pending()
+    job.documents = documents
+    job.nodes = nodes
+
+
+async def embed_chunks(
+    job: IngestionJob,
+    nodes: List[BaseNode],
+    embed_model: BaseEmbedding,
+) -> None:
+    """Set the embeddings of chunks, from the embedding cache or the model."""
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    keys = [chunk_key(embed_model.model_name, text) for text in texts]
+
+    # Chunks unchanged since a previous upload are not embedded again.
+    embeddings = await get_cached_embeddings(list(set(keys)))
+    job.cached_embeddings += sum(key in embeddings for key in keys)
+    missing = list({
+        key: text for key, text in zip(keys, texts) if key not in embeddings
+    }.items())
+    batch_size = embed_model.embed_batch_size
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        batch_embeddings = await asyncio.to_thread(
+            embed_model.get_text_embedding_batch, [text for _, text in batch])
+        new_embeddings = {
+            key: embedding for (key, _), embedding in zip(batch, batch_embeddings)}
+        await store_cached_embeddings(embed_model.model_name, new_embeddings)
+        embeddings.update(new_embeddings)
+
+    for node, key in zip(nodes, keys):
+        node.embedding = embeddings[key]
+
+
+async def embed_nodes(job: IngestionJob) -> None:
+    """Wait for the chunks embedded during parsing, then embed the ones they missed."""
+    results = await asyncio.gather(
+        *[asyncio.wrap_future(future) for future in job.embed_futures],
+        return_exceptions=True)
+    job.embed_futures = []
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.warning(f"Embedding chunks of ingestion job {job.id} failed: {result}")
+    missing = [node for node in job.nodes if node.embedding is None]
+    await embed_chunks(job, missing, llama_index.global_service_context.embed_model)
+
+
+async def build_indices(job: IngestionJob) -> None:
+    vector_store = await get_vector_store_singleton()
+    if job.stages["index"].attempts > 1:
+        # Rows added by the failed attempt would be duplicated.
+        for document_id in job.document_ids:
+            await vector_store.delete_document_rows(job.user_id, document_id)
+
+    def build() -> None:
+        if job.persist_dir is None:
+            storage_context = StorageContext.from_defaults(vector_store=vector_store)
+            # The nodes are already embedded, the index only writes them to the store.
+            vector_index = VectorStoreIndex(
+                nodes=job.nodes, storage_context=storage_context)
+            vector_index.set_index_id(f"vector_{job.user_id}")
+            summary_index = SummaryIndex(
+                nodes=job.nodes, storage_context=storage_context)
+            summary_index.set_index_id(f"summary_{job.user_id}")
+            indices = {"summary": summary_index, "vector": vector_index}
+        else:
+            # Add the nodes to the user's indices instead of rebuilding them.
+            indices, job.delta_paths = load_user_indices(vector_store, job.user_id)
+            for index in indices.values():
+                index.insert_nodes(job.nodes)
+            storage_context = indices["vector"].storage_context
+        for document in job.documents:
+            storage_context.docstore.set_document_hash(
+                document.get_doc_id(), document.hash)
+        job.storage_context = storage_context
+        job.indices = indices
+
+    await asyncio.to_thread(build)
+
+
+async def persist_indices(job: IngestionJob) -> None:
+    if job.delta_paths is None or len(job.delta_paths) >= INDEX_DELTA_COMPACT_THRESHOLD:
+        await asyncio.to_thread(
+            compact_user_indices, job.storage_context, job.user_id, job.delta_paths or [])
+    else:
+        # Named after the job, so a retry overwrites the delta of the failed attempt.
+        await asyncio.to_thread(
+            write_index_delta,
+            job.user_id,
+            f"{int(job.created_at * 1000):013d}-{job.id}",
+            job.nodes,
+            {document.get_doc_id(): document.hash for document in job.documents},
+        )
+    await invalidate_user_caches(job.user_id)
+
+
+INGEST_STAGES: Dict[str, Callable[[IngestionJob], Awaitable[None]]] = {
+    "upload": upload_files,
+    "parse": parse_files,
+    "embed": embed_nodes,
+    "index": build_indices,
+    "persist": persist_indices,
+}
+
+
+class IngestionQueue:
+    """Bounded pool of workers running the ingestion of uploaded documents.
+
+    Each job goes through `INGEST_STAGES` in order; a failed stage is retried with
+    an exponential backoff before the whole job fails and its documents are removed.
+    Jobs of one user run one after the other, since they all rewrite the user's
+    persisted indices: across workers too, with a Postgres advisory lock. A failed
+    job also deletes the files it put in S3. The status of each job is saved to the
+    database at every stage, so any worker can report it, but the jobs themselves
+    are kept in the memory of the worker that queued them: a restart loses the
+    queued ones.
+    """
+
+    def __init__(
+        self,
+        workers: int = INGEST_WORKERS,
+        max_queued: int = INGEST_QUEUE_SIZE,
+        max_attempts: int = INGEST_MAX_ATTEMPTS,
+        backoff: float = INGEST_RETRY_BACKOFF_SECONDS,
+        ttl: float = INGEST_JOB_TTL_SECONDS,
+    ) -> None:
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.ttl = ttl
+        self._queue: "asyncio.Queue[IngestionJob]" = asyncio.Queue(max_queued)
+        self._jobs: Dict[str, IngestionJob] = {}
+        self._user_locks: Dict[str, asyncio.Lock] = {}
+        self._tasks: List[asyncio.Task] = []
+        # Answer precomputations started by finished jobs.
+        self._background: Set[asyncio.Task] = set()
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.stage_time = {name: LatencyStats() for name in INGEST_STAGES}
+        self.job_time = LatencyStats()
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        tasks = [*self._tasks, *self._background]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, user_id: str, files: List[UploadedFile]) -> IngestionJob:
+        self._prune()
+        job = IngestionJob(
+            id=uuid.uuid4().hex,
+            user_id=user_id,
+            files=files,
+            stages={name: StageStatus(name) for name in INGEST_STAGES},
+        )
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise IngestionQueueFull(
+                f"{self._queue.qsize()} ingestion jobs are already waiting.")
+        self._jobs[job.id] = job
+        await self._save(job)
+        return job
+
+    async def status(self, job_id: str, user_id: str) -> Optional[dict]:
+        """Status of a job, from the database if another worker runs it."""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return await get_ingestion_job(job_id, user_id)
+        if job.user_id != user_id:
+            return None
+        return job.to_dict()
+
+    async def _save(self, job: IngestionJob) -> None:
+        try:
+            await save_ingestion_job(job.id, job.user_id, job.to_dict())
+        except Exception as e:
+            # Only the other workers' status reports are behind.
+            logger.warning(f"Could not save the status of ingestion job {job.id}: {e}")
+
+    def _prune(self) -> None:
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished_at is not None and now - job.finished_at > self.ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                lock = self._user_locks.setdefault(job.user_id, asyncio.Lock())
+                # Taken in that order, so no connection is held waiting on this worker.
+                async with lock, user_ingestion_lock(job.user_id):
+                    await self._run(job)
+                await self._save(job)
+                await delete_ingestion_jobs_before(time.time() - self.ttl)
+            except Exception:
+                logger.exception(f"Ingestion job {job.id} crashed.")
+            finally:
+                self._queue.task_done()
+
+    async def _run_stage(self, job: IngestionJob, stage: StageStatus) -> None:
+        stage.status = "running"
+        await self._save(job)
+        start = time.perf_counter()
+        while True:
+            stage.attempts += 1
+            try:
+                await INGEST_STAGES[stage.name](job)
+                break
+            except Exception as e:
+                stage.error = str(e)
+                if stage.attempts >= self.max_attempts:
+                    stage.status = "failed"
+                    stage.seconds = time.perf_counter() - start
+                    raise
+                self.retries += 1
+                logger.warning(
+                    f"Stage {stage.name} of ingestion job {job.id} failed, retrying: {e}")
+                await self._save(job)
+                await asyncio.sleep(self.backoff * 2 ** (stage.attempts - 1))
+        stage.status = "done"
+        stage.progress = 1.0
+        stage.seconds = time.perf_counter() - start
+        self.stage_time[stage.name].observe(stage.seconds)
+
+    async def _run(self, job: IngestionJob) -> None:
+        job.status = "running"
+        start = time.perf_counter()
+        try:
+            # Decided before the first stage: a retried index stage may have added rows.
+            if await is_user_existed(job.user_id):
+                job.persist_dir = user_persist_dir(job.user_id)
+            for stage in job.stages.values():
+                await self._run_stage(job, stage)
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            job.finished_at = time.time()
+            self.failed += 1
+            logger.error(f"Ingestion job {job.id} of {job.user_id} failed: {e}")
+            for future in job.embed_futures:
+                future.cancel()
+            for document_id in job.document_ids:
+                await delete_document(document_id, job.user_id)
+            await delete_uploaded_files(job)
+            await invalidate_user_caches(job.user_id)
+            return
+
+        job.status = "done"
+        job.finished_at = time.time()
+        self.completed += 1
+        self.job_time.observe(time.perf_counter() - start)
+        # Answer the questions the uploader expects to be asked.
+        for file in job.files:
+            task = asyncio.create_task(precompute_document_answer(
+                job.indices, file.document_id, job.user_id, file.question))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+        # The nodes and indices are in the store now, free them.
+        job.documents, job.nodes = [], []
+        job.storage_context, job.indices = None, {}
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize(),
+            "jobs": len(self._jobs),
+            "completed": self.completed,
+            "failed": self.failed,
+            "retries": self.retries,
+            "job_time": self.job_time.stats(),
+            "stage_time": {
+                name: stats.stats() for name, stats in self.stage_time.items()},
+        }
+
+
+ingestion_queue = IngestionQueue()
@@ -1,9 +1,14 @@
+import os
 from llama_index.llms import LlamaCPP
-from llama_index.embeddings import HuggingFaceEmbedding
+from app.core.embedding import EMBED_BATCH_MAX_SIZE, CachedHuggingFaceEmbedding
 from app.utils.prompt import messages_to_prompt_alpaca
 
 MODEL_URL = "https://huggingface.co/TheBloke/SOLAR-10.7B-Instruct-v1.0-GGUF/resolve/main/solar-10.7b-instruct-v1.0.Q5_K_M.gguf"
 EMBEDDING_MODEL_NAME = "BAAI/bge-large-en-v1.5"
+# Memory for llama.cpp KV states kept across turns, 0 (the default) disables the
+# prompt cache. Each state saves the KV cache of the whole context window, several
+# hundred MB with this model: size it from `llm._model.save_state().llama_state_size`.
+LLAMA_PROMPT_CACHE_BYTES = int(os.getenv("LLAMA_PROMPT_CACHE_BYTES", 0))
 
 
 def get_llm(model_url=MODEL_URL):
@@ -17,10 +22,19 @@ def get_llm(model_url=MODEL_URL):
         verbose=False,
         messages_to_prompt=messages_to_prompt_alpaca,
     )
+    if LLAMA_PROMPT_CACHE_BYTES > 0:
+        from llama_cpp import LlamaRAMCache
+
+        # Save the KV state after every generation and restore the saved state
+        # sharing the longest prefix with the next prompt, so a session doesn't
+        # prefill its system prompt and older turns again.
+        llm._model.set_cache(LlamaRAMCache(
+            capacity_bytes=LLAMA_PROMPT_CACHE_BYTES))
     return llm
 
 
 def get_embedding_model(model_name=EMBEDDING_MODEL_NAME):
-    embed_model = HuggingFaceEmbedding(
-        model_name=model_name, embed_batch_size=4)
+    # Callers hand large batches to the batcher, which splits them by length.
+    embed_model = CachedHuggingFaceEmbedding(
+        model_name=model_name, embed_batch_size=EMBED_BATCH_MAX_SIZE)
     return embed_model
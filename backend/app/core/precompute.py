@@ -0,0 +1,137 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+import llama_index
+
+from app.core.answer_cache import SemanticAnswerCache
+from app.core.chat_engine import chat_engine_factory
+from app.core.scheduler import inference_scheduler
+from app.db.crud import (
+    get_documents,
+    is_document_answer_current,
+    update_document_answer,
+)
+
+logger = logging.getLogger("uvicorn")
+
+# Precomputed answers are reloaded from the database after that many seconds, to
+# pick up the changes made through other workers.
+PRECOMPUTED_ANSWERS_TTL_SECONDS = float(
+    os.getenv("PRECOMPUTED_ANSWERS_TTL_SECONDS", 5 * 60))
+
+
+class DocumentAnswers:
+    """Answers generated at ingestion time for the `question` of each document.
+
+    The answers are persisted on the `documents` rows and loaded lazily per user,
+    so they survive restarts and are shared by all workers. Invalidation is only
+    local to a worker: the loaded answers are reloaded after a while, and a hit is
+    only served if the database still has that answer on an active document.
+    """
+
+    def __init__(self, ttl: float = PRECOMPUTED_ANSWERS_TTL_SECONDS) -> None:
+        self.ttl = ttl
+        self._cache = SemanticAnswerCache(ttl=ttl)
+        self._loaded_at: Dict[str, float] = {}
+        # Bumped on invalidation, so a load racing with it doesn't store stale answers.
+        self._generations: Dict[str, int] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.stale_hits = 0
+
+    def _is_loaded(self, user_id: str) -> bool:
+        loaded_at = self._loaded_at.get(user_id)
+        return loaded_at is not None and time.monotonic() - loaded_at <= self.ttl
+
+    async def _load(self, user_id: str) -> None:
+        generation = self._generations.get(user_id, 0)
+        documents = [
+            document for document in await get_documents(user_id)
+            if document.is_active and document.answer
+        ]
+        embed_model = llama_index.global_service_context.embed_model
+
+        def embed_questions() -> List[list]:
+            return [embed_model.get_query_embedding(document.question)
+                    for document in documents]
+
+        embeddings = await asyncio.to_thread(embed_questions)
+        if self._generations.get(user_id, 0) != generation:
+            return
+        self._cache.invalidate(user_id)
+        for document, embedding in zip(documents, embeddings):
+            self._cache.store(
+                user_id, document.question, document.answer, embedding)
+        self._loaded_at[user_id] = time.monotonic()
+
+    async def lookup(self, user_id: str, question_embedding: list) -> Optional[str]:
+        """Return the stored answer of a document question similar to the given one.
+
+        Loads the user's answers from the database the first time they are looked up,
+        and again once they are older than the TTL.
+        """
+        if not self._is_loaded(user_id):
+            lock = self._locks.setdefault(user_id, asyncio.Lock())
+            async with lock:
+                if not self._is_loaded(user_id):
+                    await self._load(user_id)
+            if not lock.locked():
+                self._locks.pop(user_id, None)
+        cached = self._cache.lookup(user_id, question_embedding)
+        if cached is None:
+            return None
+        # Another worker may have changed the documents since they were loaded.
+        if not await is_document_answer_current(user_id, cached.question, cached.answer):
+            self.stale_hits += 1
+            self.invalidate(user_id)
+            return None
+        return cached.answer
+
+    def invalidate(self, user_id: str) -> None:
+        self._generations[user_id] = self._generations.get(user_id, 0) + 1
+        self._loaded_at.pop(user_id, None)
+        self._cache.invalidate(user_id)
+
+    def stats(self) -> dict:
+        return dict(
+            self._cache.stats(),
+            loaded_users=len(self._loaded_at),
+            stale_hits=self.stale_hits,
+        )
+
+
+document_answers = DocumentAnswers()
+
+
+def generate_answer(index: dict, user_id: str, question: str) -> str:
+    """Answer a question from the user's documents, without streaming."""
+    # The indices of an ingestion job: caching components for them would replace
+    # the ones of the cached indices, and keep the job's indices alive.
+    chat_engine = chat_engine_factory.build(user_id, index, cache=False)
+    return str(chat_engine.chat(question)).strip()
+
+
+async def precompute_document_answer(
+    index: dict,
+    document_id: str,
+    user_id: str,
+    question: str,
+) -> None:
+    """Generate and store the answer to a document question.
+
+    Meant to run as a background task once the document is indexed. It takes an LLM
+    slot like any chat request, waiting as long as needed instead of being shed.
+    """
+    if not question.strip():
+        return
+    try:
+        async with inference_scheduler.slot(user_id, wait=True):
+            answer = await asyncio.to_thread(
+                generate_answer, index, user_id, question)
+        await update_document_answer(document_id, answer)
+    except Exception as e:
+        logger.warning(f"Could not precompute answer of {document_id}: {e}")
+        return
+    document_answers.invalidate(user_id)
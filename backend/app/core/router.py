@@ -0,0 +1,125 @@
+import os
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.prompts.mixin import PromptDictType, PromptMixinType
+from llama_index.schema import QueryBundle
+from llama_index.selectors.types import (
+    BaseSelector,
+    SelectorResult,
+    SingleSelection,
+)
+from llama_index.tools.types import ToolMetadata
+
+logger = logging.getLogger("uvicorn")
+
+# "none": always use the vector retriever, "embedding": route between the vector
+# and summary retrievers with the embedding selector, "llm": always ask the LLM.
+ROUTER_MODE = os.getenv("ROUTER_MODE", "none")
+# In "embedding" mode, ask the LLM when the embeddings can't tell the tools apart.
+# Each such query costs an extra LLM call before the answer is generated.
+ROUTER_LLM_FALLBACK = os.getenv("ROUTER_LLM_FALLBACK", "false").lower() == "true"
+# Minimum gap between the best and second best choice scores to trust the embeddings.
+ROUTER_CONFIDENCE_MARGIN = float(os.getenv("ROUTER_CONFIDENCE_MARGIN", 0.03))
+
+
+class ConfidentEmbeddingSelector(BaseSelector):
+    """Select a tool by embedding similarity, optionally asking the LLM when unsure.
+
+    Each choice is scored by the best cosine similarity between the query and the
+    choice description or one of its example queries. When the best score doesn't
+    beat the runner-up by `margin`, the decision is delegated to `fallback` if any;
+    without one, the best scored choice is taken anyway.
+
+    Args:
+        embed_model (BaseEmbedding): the embedding model, query embeddings are cached.
+        fallback (Optional[BaseSelector]): selector used for low-confidence queries.
+        examples (Optional[Dict[str, List[str]]]): example queries per tool description.
+        margin (float): minimum score gap to trust the embedding decision.
+    """
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        fallback: Optional[BaseSelector] = None,
+        examples: Optional[Dict[str, List[str]]] = None,
+        margin: float = ROUTER_CONFIDENCE_MARGIN,
+    ) -> None:
+        self._embed_model = embed_model
+        self._fallback = fallback
+        self._examples = examples or {}
+        self._margin = margin
+        # Description -> matrix of unit embeddings (description + examples).
+        self._anchors: Dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+        self.embedding_selections = 0
+        self.fallback_selections = 0
+
+    def _get_prompts(self) -> Dict[str, Any]:
+        """Get prompts."""
+        return {}
+
+    def _update_prompts(self, prompts: PromptDictType) -> None:
+        """Update prompts."""
+
+    def _get_prompt_modules(self) -> PromptMixinType:
+        """Get prompt sub-modules."""
+        return {"fallback": self._fallback} if self._fallback else {}
+
+    def _get_anchors(self, description: str) -> np.ndarray:
+        with self._lock:
+            anchors = self._anchors.get(description)
+            if anchors is None:
+                texts = [description, *self._examples.get(description, [])]
+                matrix = np.asarray(
+                    self._embed_model.get_text_embedding_batch(texts), dtype=np.float32)
+                anchors = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+                self._anchors[description] = anchors
+            return anchors
+
+    def _score(
+        self, choices: Sequence[ToolMetadata], query: QueryBundle
+    ) -> Tuple[int, float, float]:
+        embedding = query.embedding or self._embed_model.get_query_embedding(
+            query.query_str)
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector / np.linalg.norm(vector)
+        scores = np.array([
+            float(np.max(self._get_anchors(choice.description) @ vector))
+            for choice in choices
+        ])
+        order = np.argsort(-scores)
+        best = int(order[0])
+        runner_up = float(scores[order[1]]) if len(scores) > 1 else -1.0
+        return best, float(scores[best]), runner_up
+
+    def _select(
+        self, choices: Sequence[ToolMetadata], query: QueryBundle
+    ) -> SelectorResult:
+        best, score, runner_up = self._score(choices, query)
+        if self._fallback is not None and score - runner_up < self._margin:
+            self.fallback_selections += 1
+            return self._fallback.select(choices, query)
+        self.embedding_selections += 1
+        reason = f"Embedding match: {score:.2f} (runner-up {runner_up:.2f})"
+        return SelectorResult(selections=[SingleSelection(index=best, reason=reason)])
+
+    async def _aselect(
+        self, choices: Sequence[ToolMetadata], query: QueryBundle
+    ) -> SelectorResult:
+        best, score, runner_up = self._score(choices, query)
+        if self._fallback is not None and score - runner_up < self._margin:
+            self.fallback_selections += 1
+            return await self._fallback.aselect(choices, query)
+        self.embedding_selections += 1
+        reason = f"Embedding match: {score:.2f} (runner-up {runner_up:.2f})"
+        return SelectorResult(selections=[SingleSelection(index=best, reason=reason)])
+
+    def stats(self) -> dict:
+        return {
+            "embedding_selections": self.embedding_selections,
+            "fallback_selections": self.fallback_selections,
+        }
@@ -0,0 +1,187 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Optional
+
+from app.utils.metrics import LatencyStats
+
+logger = logging.getLogger("uvicorn")
+
+# A single llama.cpp model is not safe to call from several threads at once.
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 1))
+# "fifo": first come first served, "fair": round-robin between users.
+LLM_QUEUE_POLICY = os.getenv("LLM_QUEUE_POLICY", "fifo")
+# Requests whose estimated queue wait is above this budget are rejected.
+LLM_MAX_QUEUE_WAIT_SECONDS = float(os.getenv("LLM_MAX_QUEUE_WAIT_SECONDS", 60))
+# Service time assumed until the first generations have been measured.
+LLM_SERVICE_TIME_PRIOR_SECONDS = float(
+    os.getenv("LLM_SERVICE_TIME_PRIOR_SECONDS", 10))
+
+
+class SchedulerOverloaded(Exception):
+    """Raised when a request would wait longer than the queue wait budget."""
+
+    def __init__(self, estimated_wait: float) -> None:
+        super().__init__(
+            f"Estimated queue wait of {estimated_wait:.1f}s exceeds the budget.")
+        self.estimated_wait = estimated_wait
+
+    @property
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.estimated_wait))
+
+
+class InferenceScheduler:
+    """Admission control in front of the LLM.
+
+    At most `concurrency` generations run at once, the others wait in a FIFO queue
+    or, with the "fair" policy, in per-user queues served round-robin so one user
+    sending many messages can't starve the others. The expected wait is estimated
+    from the queue length and a moving average of the service time; requests that
+    would wait more than `max_wait` seconds are rejected right away.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = LLM_CONCURRENCY,
+        policy: str = LLM_QUEUE_POLICY,
+        max_wait: float = LLM_MAX_QUEUE_WAIT_SECONDS,
+        service_time_prior: float = LLM_SERVICE_TIME_PRIOR_SECONDS,
+    ) -> None:
+        if policy not in ("fifo", "fair"):
+            raise ValueError(f"Unknown queue policy: {policy}")
+        self.concurrency = concurrency
+        self.policy = policy
+        self.max_wait = max_wait
+        self._running = 0
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._queued = 0
+        self._avg_service_time = service_time_prior
+        self.rejected = 0
+        self.max_queue_depth = 0
+        self.wait_time = LatencyStats()
+        self.service_time = LatencyStats()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queued
+
+    def estimate_wait(self) -> float:
+        """Expected time a new request spends in the queue before it runs."""
+        if self._running < self.concurrency and not self._queued:
+            return 0.0
+        # Every `concurrency` requests ahead of us cost one service time.
+        rounds = (self._queued + 1) / self.concurrency
+        return rounds * self._avg_service_time
+
+    def check_admission(self) -> None:
+        """Reject a new request right away if it would wait more than the budget.
+
+        Raises:
+            SchedulerOverloaded: if the estimated wait exceeds the budget.
+        """
+        estimated_wait = self.estimate_wait()
+        if estimated_wait > self.max_wait:
+            self.rejected += 1
+            raise SchedulerOverloaded(estimated_wait)
+
+    async def acquire(self, user_id: str, wait: bool = False) -> None:
+        """Take a generation slot, queueing if none is free.
+
+        Args:
+            user_id (str): the user the generation is for.
+            wait (bool, optional): queue regardless of the wait budget, for background
+                work that has no client waiting on it. Defaults to False.
+
+        Raises:
+            SchedulerOverloaded: if the estimated wait exceeds the budget.
+        """
+        if self._running < self.concurrency and not self._queued:
+            self._running += 1
+            self.wait_time.observe(0.0)
+            return
+
+        if not wait:
+            self.check_admission()
+
+        key = user_id if self.policy == "fair" else ""
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(waiter)
+        self._queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._queued)
+        start = time.perf_counter()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over right before the cancellation.
+                self.release()
+            else:
+                self._remove(key, waiter)
+            raise
+        self.wait_time.observe(time.perf_counter() - start)
+
+    def release(self) -> None:
+        waiter = self._next_waiter()
+        if waiter is None:
+            self._running -= 1
+            return
+        # Hand the slot over directly, so `_running` stays the same.
+        waiter.set_result(None)
+
+    def record_service_time(self, seconds: float) -> None:
+        self.service_time.observe(seconds)
+        self._avg_service_time = 0.8 * self._avg_service_time + 0.2 * seconds
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, wait: bool = False) -> AsyncIterator[None]:
+        await self.acquire(user_id, wait=wait)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_service_time(time.perf_counter() - start)
+            self.release()
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        while self._queues:
+            key, waiters = next(iter(self._queues.items()))
+            waiter = waiters.popleft()
+            self._queued -= 1
+            if waiters:
+                # Round-robin: this user goes to the back of the line.
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if not waiter.done():
+                return waiter
+        return None
+
+    def _remove(self, key: str, waiter: asyncio.Future) -> None:
+        waiters = self._queues.get(key)
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        self._queued -= 1
+        if not waiters:
+            del self._queues[key]
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "policy": self.policy,
+            "running": self._running,
+            "queue_depth": self._queued,
+            "max_queue_depth": self.max_queue_depth,
+            "estimated_wait": self.estimate_wait(),
+            "rejected": self.rejected,
+            "wait_time": self.wait_time.stats(),
+            "service_time": self.service_time.stats(),
+        }
+
+
+inference_scheduler = InferenceScheduler()
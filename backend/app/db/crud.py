@@ -1,26 +1,24 @@
+import time
+import array
+import asyncio
 import uuid as uuid_pkg
 
-from typing import List
-from sqlalchemy import text
-from sqlmodel import select, delete
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
+from sqlalchemy import insert, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import select, delete, update
 
 from app.db.pg_vector import get_vector_store_singleton
-from app.orm_models import Document
-from app.db.session import SessionLocal
+from app.orm_models import Document, DocumentsVersion, EmbeddingCacheEntry, IngestionJobState
+from app.db.session import AsyncSessionLocal, VectorAsyncSessionLocal, async_engine
 
 
 async def is_user_existed(
     user_id: str,
 ) -> bool:
     vector_store = await get_vector_store_singleton()
-
-    async with vector_store._async_session() as session, session.begin():
-        stmt = text(
-            f"SELECT id FROM {vector_store.schema_name}.data_{vector_store.table_name} where "
-            f"(metadata_->>'user_id')::text = '{user_id}'"
-        )
-        result = await session.execute(stmt)
-    return result.first() is not None
+    return await vector_store.has_user_rows(user_id)
 
 
 async def is_document_existed(
@@ -28,69 +26,237 @@ async def is_document_existed(
     user_id: str,
 ) -> bool:
     vector_store = await get_vector_store_singleton()
-
-    async with vector_store._async_session() as session, session.begin():
-        stmt = text(
-            f"SELECT id FROM {vector_store.schema_name}.data_{vector_store.table_name} where "
-            f"(metadata_->>'document_id')::text = '{document_id}' and"
-            f"(metadata_->>'user_id')::text = '{user_id}'"
-        )
-        result = await session.execute(stmt)
-    return result.first() is not None
+    return await vector_store.has_document_rows(user_id, str(document_id))
 
 
 async def delete_all_documents_from_user(
     user_id: str
 ) -> None:
     vector_store = await get_vector_store_singleton()
-
-    async with vector_store._async_session() as session, session.begin():
-        stmt = text(
-            f"DELETE FROM {vector_store.schema_name}.data_{vector_store.table_name} where "
-            # f"(metadata_->>'file_name')::text = '{document_name}' and"
-            f"(metadata_->>'user_id')::text = '{user_id}'"
-        )
-        await session.execute(stmt)
-        await session.commit()
+    await vector_store.delete_user_rows(user_id)
 
 
-def create_documents(
+async def create_documents(
     documents: List[Document],
 ) -> List[Document]:
-    with SessionLocal() as session:
-        for document in documents:
-            session.add(document)
-            session.commit()
-            session.refresh(document)
-    return documents
+    """Insert the documents in a single statement and return the stored rows."""
+    if not documents:
+        return []
+    # The rows are handed back to the endpoints after the session is closed.
+    async with AsyncSessionLocal(expire_on_commit=False) as session, session.begin():
+        result = await session.scalars(
+            insert(Document).returning(Document),
+            [document.dict() for document in documents],
+        )
+        return result.all()
 
 
-def get_documents(
+async def get_documents(
     user_id: str
-) -> List[Document] | None:
-    with SessionLocal() as session:
+) -> List[Document]:
+    async with AsyncSessionLocal() as session:
         stmt = select(Document).where(Document.user_id == user_id)
-        documents = session.execute(stmt).scalars().all()
-        return documents
+        result = await session.scalars(stmt)
+        return result.all()
 
 
-async def delete_document(
+async def is_document_answer_current(
+    user_id: str,
+    question: str,
+    answer: str,
+) -> bool:
+    """Whether an active document of the user still has this precomputed answer."""
+    async with AsyncSessionLocal() as session:
+        stmt = select(Document.id).where(
+            Document.user_id == user_id,
+            Document.is_active == True,  # noqa: E712
+            Document.question == question,
+            Document.answer == answer,
+        ).limit(1)
+        result = await session.scalars(stmt)
+        return result.first() is not None
+
+
+async def update_document_answer(
+    document_id: uuid_pkg.UUID,
+    answer: str,
+) -> None:
+    async with AsyncSessionLocal() as session, session.begin():
+        stmt = update(Document).where(
+            Document.id == document_id).values(answer=answer)
+        await session.execute(stmt)
+
+
+async def get_documents_version(
+    user_id: str,
+) -> int:
+    async with AsyncSessionLocal() as session:
+        stmt = select(DocumentsVersion.version).where(DocumentsVersion.user_id == user_id)
+        result = await session.scalars(stmt)
+        return result.first() or 0
+
+
+async def bump_documents_version(
+    user_id: str,
+) -> int:
+    """Mark the user's documents as changed, for the caches of every worker."""
+    async with AsyncSessionLocal() as session, session.begin():
+        stmt = pg_insert(DocumentsVersion).values(user_id=user_id, version=1)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["user_id"],
+            set_={"version": DocumentsVersion.version + 1},
+        ).returning(DocumentsVersion.version)
+        result = await session.scalars(stmt)
+        return result.one()
+
+
+async def set_documents_active(
+    document_ids: List[uuid_pkg.UUID],
+    user_id: str,
+    is_active: bool,
+) -> List[Document]:
+    """Activate or deactivate documents, in the documents table and their nodes at once."""
+
+    async def update_rows() -> List[Document]:
+        async with AsyncSessionLocal(expire_on_commit=False) as session, session.begin():
+            stmt = (
+                update(Document)
+                .where((Document.user_id == user_id) & (Document.id.in_(document_ids)))
+                .values(is_active=is_active)
+                .returning(Document)
+            )
+            result = await session.scalars(stmt)
+            return result.all()
+
+    vector_store = await get_vector_store_singleton()
+    documents, _ = await asyncio.gather(
+        update_rows(),
+        vector_store.set_documents_active(
+            user_id, [str(document_id) for document_id in document_ids], is_active),
+    )
+    return documents
+
+
+async def delete_document_row(
     document_id: uuid_pkg.UUID,
     user_id: str,
 ) -> None:
-    with SessionLocal() as session:
+    async with AsyncSessionLocal() as session, session.begin():
         stmt = delete(Document).where(
             (Document.user_id == user_id)
             & (Document.id == document_id))
-        session.execute(stmt)
-        session.commit()
+        await session.execute(stmt)
+
 
+async def delete_document_nodes(
+    document_id: uuid_pkg.UUID,
+    user_id: str,
+) -> None:
     vector_store = await get_vector_store_singleton()
-    async with vector_store._async_session() as session, session.begin():
-        stmt = text(
-            f"DELETE FROM {vector_store.schema_name}.data_{vector_store.table_name} where "
-            f"(metadata_->>'doc_uuid')::text = '{document_id}' and"
-            f"(metadata_->>'user_id')::text = '{user_id}'"
+    await vector_store.delete_document_rows(user_id, str(document_id))
+
+
+async def delete_document(
+    document_id: uuid_pkg.UUID,
+    user_id: str,
+) -> None:
+    """Delete the document row and its nodes, on two connections at once."""
+    await asyncio.gather(
+        delete_document_row(document_id, user_id),
+        delete_document_nodes(document_id, user_id),
+    )
+
+
+# The embedding cache is only used by ingestion, it goes through the vector pools
+# so ingestion bursts don't hold the connections of the documents queries.
+
+
+async def get_cached_embeddings(
+    keys: List[str],
+) -> Dict[str, List[float]]:
+    """Look up the embeddings of many chunk hashes in a single query."""
+    if not keys:
+        return {}
+    async with VectorAsyncSessionLocal() as session:
+        stmt = select(EmbeddingCacheEntry.key, EmbeddingCacheEntry.embedding).where(
+            EmbeddingCacheEntry.key.in_(keys))
+        result = await session.execute(stmt)
+        return {
+            key: array.array("f", embedding).tolist()
+            for key, embedding in result.all()
+        }
+
+
+async def store_cached_embeddings(
+    model_name: str,
+    embeddings: Dict[str, List[float]],
+) -> None:
+    if not embeddings:
+        return
+    async with VectorAsyncSessionLocal() as session, session.begin():
+        stmt = pg_insert(EmbeddingCacheEntry).on_conflict_do_nothing(
+            index_elements=["key"])
+        await session.execute(stmt, [
+            {
+                "key": key,
+                "model_name": model_name,
+                "embedding": array.array("f", embedding).tobytes(),
+            }
+            for key, embedding in embeddings.items()
+        ])
+
+
+async def save_ingestion_job(
+    job_id: str,
+    user_id: str,
+    state: dict,
+) -> None:
+    async with AsyncSessionLocal() as session, session.begin():
+        stmt = pg_insert(IngestionJobState).values(
+            id=job_id, user_id=user_id, state=state, updated_at=time.time())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["id"],
+            set_={"state": stmt.excluded.state, "updated_at": stmt.excluded.updated_at},
         )
         await session.execute(stmt)
-        await session.commit()
+
+
+async def get_ingestion_job(
+    job_id: str,
+    user_id: str,
+) -> Optional[dict]:
+    async with AsyncSessionLocal() as session:
+        stmt = select(IngestionJobState.state).where(
+            (IngestionJobState.id == job_id)
+            & (IngestionJobState.user_id == user_id))
+        result = await session.scalars(stmt)
+        return result.first()
+
+
+async def delete_ingestion_jobs_before(
+    updated_at: float,
+) -> None:
+    async with AsyncSessionLocal() as session, session.begin():
+        stmt = delete(IngestionJobState).where(
+            IngestionJobState.updated_at < updated_at)
+        await session.execute(stmt)
+
+
+@asynccontextmanager
+async def user_ingestion_lock(
+    user_id: str,
+) -> AsyncIterator[None]:
+    """Hold a Postgres advisory lock on the user's indices, shared by every worker.
+
+    The lock is taken on a connection of its own, kept for as long as it is held.
+    """
+    params = {"key": f"ingest:{user_id}"}
+    async with async_engine.connect() as conn:
+        await conn.execute(text("SELECT pg_advisory_lock(hashtext(:key))"), params)
+        # The lock belongs to the session: don't stay idle in a transaction.
+        await conn.commit()
+        try:
+            yield
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(hashtext(:key))"), params)
+            await conn.commit()
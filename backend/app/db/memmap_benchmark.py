@@ -0,0 +1,113 @@
+"""Benchmark of the memmap vector store, without Postgres or any other service.
+
+Run from the backend folder:
+
+    python -m app.db.memmap_benchmark --users 10 --rows 5000 --queries 200
+"""
+import json
+import time
+import uuid
+import argparse
+import tempfile
+
+import numpy as np
+from llama_index.schema import TextNode
+from llama_index.vector_stores.types import (
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+)
+
+from app.db.memmap_vector import MemmapVectorStore
+
+
+def random_nodes(rng: np.random.Generator, user_id: str, rows: int, dim: int, docs: int):
+    doc_uuids = [str(uuid.uuid4()) for _ in range(docs)]
+    embeddings = rng.standard_normal((rows, dim), dtype=np.float32)
+    return [
+        TextNode(
+            text=f"chunk {i}",
+            embedding=embedding.tolist(),
+            metadata={"user_id": user_id, "doc_uuid": doc_uuids[i % docs], "is_active": True},
+        )
+        for i, embedding in enumerate(embeddings)
+    ], doc_uuids
+
+
+def percentile(samples, q: float) -> float:
+    return float(np.percentile(samples, q)) if samples else 0.0
+
+
+def benchmark(
+    path: str,
+    users: int = 10,
+    rows: int = 5000,
+    dim: int = 1024,
+    docs: int = 5,
+    queries: int = 200,
+    top_k: int = 3,
+) -> dict:
+    """Ingest, query and delete timings of the memmap store on random embeddings."""
+    rng = np.random.default_rng(0)
+    vector_store = MemmapVectorStore(path=path, embed_dim=dim)
+    user_ids = [f"user-{i}" for i in range(users)]
+    user_docs = {}
+
+    start = time.perf_counter()
+    for user_id in user_ids:
+        nodes, user_docs[user_id] = random_nodes(rng, user_id, rows, dim, docs)
+        vector_store.add(nodes)
+    add_time = time.perf_counter() - start
+
+    latencies = []
+    for i in range(queries):
+        user_id = user_ids[i % users]
+        query = VectorStoreQuery(
+            query_embedding=rng.standard_normal(dim).tolist(),
+            similarity_top_k=top_k,
+            filters=MetadataFilters(filters=[
+                MetadataFilter(key="user_id", operator=FilterOperator.EQ, value=user_id),
+                MetadataFilter(key="is_active", operator=FilterOperator.EQ, value="true"),
+            ]),
+        )
+        start = time.perf_counter()
+        vector_store.query(query)
+        latencies.append(1000 * (time.perf_counter() - start))
+
+    start = time.perf_counter()
+    for user_id in user_ids:
+        user = vector_store._user(user_id)
+        with user.lock:
+            user.keep(user.column("doc_uuid") != user_docs[user_id][0])
+    delete_time = time.perf_counter() - start
+
+    return {
+        "users": users,
+        "rows_per_user": rows,
+        "dim": dim,
+        "add_rows_per_second": users * rows / add_time,
+        "query_p50_ms": percentile(latencies, 50),
+        "query_p95_ms": percentile(latencies, 95),
+        "delete_document_ms": 1000 * delete_time / users,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--docs", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        report = benchmark(
+            path, args.users, args.rows, args.dim, args.docs, args.queries, args.top_k)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+import os
+import json
+import shutil
+import asyncio
+import hashlib
+import logging
+import operator
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.schema import BaseNode, MetadataMode, TextNode
+from llama_index.vector_stores.types import (
+    BasePydanticVectorStore,
+    FilterOperator,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from llama_index.vector_stores.utils import metadata_dict_to_node, node_to_metadata_dict
+
+logger = logging.getLogger("uvicorn")
+
+VECTOR_STORE_MEMMAP_DIR = os.getenv("VECTOR_STORE_MEMMAP_DIR", "./data/vectors")
+
+_OPERATORS = {
+    FilterOperator.EQ: operator.eq,
+    FilterOperator.NE: operator.ne,
+    FilterOperator.GT: operator.gt,
+    FilterOperator.LT: operator.lt,
+    FilterOperator.GTE: operator.ge,
+    FilterOperator.LTE: operator.le,
+}
+
+
+def metadata_text(value: Any) -> Optional[str]:
+    """Text form of a metadata value, like Postgres' `metadata_->>'key'`."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+class UserVectors:
+    """Vectors of one user: a float32 matrix file and a JSON sidecar of its rows.
+
+    The embeddings are stored normalized, so dot products are cosine similarities.
+    Appends write at the end of the matrix file; deletions rewrite both files.
+    """
+
+    def __init__(self, path: Path, user_id: str, dim: int) -> None:
+        self.path = path
+        self.user_id = user_id
+        self.dim = dim
+        self.lock = threading.RLock()
+        self._matrix_path = path / "embeddings.f32"
+        self._rows_path = path / "rows.json"
+        self.rows: List[dict] = []
+        if self._rows_path.exists():
+            self.rows = json.loads(self._rows_path.read_text())
+        self._matrix: Optional[np.ndarray] = None
+        self._columns: Dict[str, np.ndarray] = {}
+
+    @property
+    def matrix(self) -> np.ndarray:
+        if self._matrix is None:
+            if not self.rows:
+                return np.empty((0, self.dim), dtype=np.float32)
+            # Rows past the sidecar (an interrupted append) are ignored.
+            self._matrix = np.memmap(
+                self._matrix_path, dtype=np.float32, mode="r", shape=(len(self.rows), self.dim))
+        return self._matrix
+
+    def column(self, key: str) -> np.ndarray:
+        """Text values of a metadata key for every row, for vectorized filtering."""
+        values = self._columns.get(key)
+        if values is None:
+            # Rows written before the flag existed are active, as in Postgres.
+            default = "true" if key == "is_active" else None
+            values = np.array(
+                [metadata_text(row["metadata"].get(key, default)) for row in self.rows],
+                dtype=object)
+            self._columns[key] = values
+        return values
+
+    def _changed(self) -> None:
+        self._matrix = None
+        self._columns = {}
+        self.path.mkdir(parents=True, exist_ok=True)
+        # The folder is named after a hash of the user id, keep the id to list users.
+        (self.path / "user_id").write_text(self.user_id)
+        tmp_path = self._rows_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.rows))
+        os.replace(tmp_path, self._rows_path)
+
+    def append(self, rows: List[dict], embeddings: np.ndarray) -> None:
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = (embeddings / np.maximum(norms, 1e-12)).astype(np.float32)
+        with self.lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(self._matrix_path, "ab") as f:
+                # Drop rows of an interrupted append so the matrix matches the sidecar.
+                f.truncate(len(self.rows) * self.dim * 4)
+                f.write(embeddings.tobytes())
+            self.rows.extend(rows)
+            self._changed()
+
+    def keep(self, mask: np.ndarray) -> int:
+        """Keep the rows where `mask` is true; returns the number of rows removed."""
+        with self.lock:
+            removed = int(len(mask) - mask.sum())
+            if not removed:
+                return 0
+            matrix = np.array(self.matrix[mask])
+            tmp_path = self._matrix_path.with_suffix(".tmp")
+            matrix.tofile(tmp_path)
+            self._matrix = None
+            os.replace(tmp_path, self._matrix_path)
+            self.rows = [row for row, kept in zip(self.rows, mask) if kept]
+            self._changed()
+            return removed
+
+    def remove(self) -> None:
+        """Delete the user's files once the searches and writes in flight are done."""
+        with self.lock:
+            shutil.rmtree(self.path, True)
+            self.rows = []
+            self._matrix = None
+            self._columns = {}
+
+    def set_metadata(self, mask: np.ndarray, key: str, value: Any) -> None:
+        with self.lock:
+            for row, selected in zip(self.rows, mask):
+                if not selected:
+                    continue
+                metadata = row["metadata"]
+                metadata[key] = value
+                # Query results are rebuilt from the serialized node, update it too.
+                if "_node_content" in metadata:
+                    node_content = json.loads(metadata["_node_content"])
+                    node_content.setdefault("metadata", {})[key] = value
+                    metadata["_node_content"] = json.dumps(node_content)
+            self._changed()
+
+    def filter_mask(self, filters: Optional[MetadataFilters]) -> np.ndarray:
+        mask = np.ones(len(self.rows), dtype=bool)
+        if not filters or not filters.filters:
+            return mask
+        masks = []
+        for filter_ in filters.filters:
+            compare = _OPERATORS.get(filter_.operator)
+            if compare is None:
+                raise ValueError(f"Unsupported filter operator: {filter_.operator}")
+            values = self.column(filter_.key)
+            expected = metadata_text(filter_.value)
+            masks.append(np.array(
+                [value is not None and compare(value, expected) for value in values],
+                dtype=bool))
+        if filters.condition == "or":
+            return np.logical_or.reduce(masks)
+        return np.logical_and.reduce(masks)
+
+    def search(
+        self, embedding: np.ndarray, top_k: int, filters: Optional[MetadataFilters]
+    ) -> List[Tuple[float, dict]]:
+        with self.lock:
+            if not self.rows:
+                return []
+            mask = self.filter_mask(filters)
+            candidates = np.flatnonzero(mask)
+            if not len(candidates):
+                return []
+            scores = self.matrix[candidates] @ embedding
+            if len(candidates) > top_k:
+                best = np.argpartition(-scores, top_k)[:top_k]
+            else:
+                best = np.arange(len(candidates))
+            best = best[np.argsort(-scores[best])]
+            return [(float(scores[i]), self.rows[candidates[i]]) for i in best]
+
+
+class MemmapVectorStore(BasePydanticVectorStore):
+    """In-process vector store keeping each user's embeddings in a memory-mapped file.
+
+    Drop-in replacement for `CustomPGVectorStore` for small tenants, tests and local
+    development: top k is an exact, vectorized dot product over the user's rows.
+    """
+
+    stores_text: bool = True
+    flat_metadata: bool = False
+    path: str
+    embed_dim: int
+
+    _users: Dict[str, UserVectors] = PrivateAttr(default_factory=dict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(self, path: str = VECTOR_STORE_MEMMAP_DIR, embed_dim: int = 1024) -> None:
+        super().__init__(path=path, embed_dim=embed_dim)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MemmapVectorStore"
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    def _user_path(self, user_id: str) -> Path:
+        return Path(self.path) / hashlib.sha1(user_id.encode()).hexdigest()
+
+    def _user(self, user_id: str) -> UserVectors:
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                user = UserVectors(self._user_path(user_id), user_id, self.embed_dim)
+                self._users[user_id] = user
+            return user
+
+    def _all_users(self) -> List[UserVectors]:
+        root = Path(self.path)
+        if not root.exists():
+            return []
+        return [
+            self._user((path / "user_id").read_text())
+            for path in root.iterdir() if (path / "user_id").exists()
+        ]
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        by_user: Dict[str, List[BaseNode]] = {}
+        for node in nodes:
+            by_user.setdefault(node.metadata["user_id"], []).append(node)
+        for user_id, user_nodes in by_user.items():
+            rows = [
+                {
+                    "node_id": node.node_id,
+                    "text": node.get_content(metadata_mode=MetadataMode.NONE),
+                    "metadata": node_to_metadata_dict(
+                        node, remove_text=True, flat_metadata=self.flat_metadata),
+                }
+                for node in user_nodes
+            ]
+            embeddings = np.asarray(
+                [node.get_embedding() for node in user_nodes], dtype=np.float32)
+            self._user(user_id).append(rows, embeddings)
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        for user in self._all_users():
+            with user.lock:
+                user.keep(user.column("doc_id") != ref_doc_id)
+
+    def _filtered_users(self, filters: Optional[MetadataFilters]) -> List[UserVectors]:
+        # Queries scoped to a user only open that user's files.
+        if filters is not None and filters.condition != "or":
+            for filter_ in filters.filters:
+                if filter_.key == "user_id" and filter_.operator == FilterOperator.EQ:
+                    return [self._user(str(filter_.value))]
+        return self._all_users()
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        # ANN tuning kwargs of the Postgres store are meaningless for exact search.
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Unsupported query mode: {query.mode}")
+        embedding = np.asarray(query.query_embedding, dtype=np.float32)
+        embedding = embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+        hits: List[Tuple[float, dict]] = []
+        for user in self._filtered_users(query.filters):
+            hits.extend(user.search(embedding, query.similarity_top_k, query.filters))
+        hits = sorted(hits, key=lambda hit: -hit[0])[:query.similarity_top_k]
+
+        nodes = []
+        for _, row in hits:
+            try:
+                node = metadata_dict_to_node(row["metadata"])
+                node.set_content(row["text"])
+            except Exception:
+                node = TextNode(
+                    id_=row["node_id"], text=row["text"], metadata=row["metadata"])
+            nodes.append(node)
+        return VectorStoreQueryResult(
+            nodes=nodes,
+            similarities=[score for score, _ in hits],
+            ids=[row["node_id"] for _, row in hits],
+        )
+
+    # Same app-facing methods as CustomPGVectorStore.
+
+    async def run_setup(self) -> None:
+        Path(self.path).mkdir(parents=True, exist_ok=True)
+
+    async def close(self) -> None:
+        pass
+
+    async def has_user_rows(self, user_id: str) -> bool:
+        return bool(self._user(user_id).rows)
+
+    async def has_document_rows(self, user_id: str, doc_uuid: str) -> bool:
+        user = self._user(user_id)
+        with user.lock:
+            return bool((user.column("doc_uuid") == doc_uuid).any())
+
+    async def delete_document_rows(self, user_id: str, doc_uuid: str) -> None:
+        user = self._user(user_id)
+
+        def delete() -> None:
+            with user.lock:
+                user.keep(user.column("doc_uuid") != doc_uuid)
+        await asyncio.to_thread(delete)
+
+    async def delete_user_rows(self, user_id: str) -> None:
+        with self._lock:
+            user = self._users.pop(user_id, None)
+        path = self._user_path(user_id)
+
+        def delete() -> None:
+            if user is not None:
+                user.remove()
+            else:
+                shutil.rmtree(path, True)
+        # The user's lock is waited for on a worker thread, not on the event loop.
+        await asyncio.to_thread(delete)
+
+    async def set_documents_active(
+        self,
+        user_id: str,
+        doc_uuids: List[str],
+        is_active: bool,
+    ) -> None:
+        user = self._user(user_id)
+
+        def update() -> None:
+            with user.lock:
+                mask = np.isin(user.column("doc_uuid"), doc_uuids)
+                user.set_metadata(mask, "is_active", is_active)
+        await asyncio.to_thread(update)
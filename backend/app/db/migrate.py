@@ -0,0 +1,48 @@
+"""Apply the schema changes of the vector store configuration to the database.
+
+The app only creates the schema of a new database at startup. On an existing one
+it refuses to start while columns are missing, and warns about missing indexes. Run from the backend folder, with the
+same environment as the app:
+
+    python -m app.db.migrate
+    python -m app.db.migrate --check
+    python -m app.db.migrate --rebuild-vector-index
+"""
+import asyncio
+import argparse
+
+from app.db.pg_vector import VECTOR_STORE_BACKEND, get_vector_store_singleton
+from app.db.session import create_metadata_tables
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--check", action="store_true",
+        help="only list the pending changes, exit with 1 if there are any")
+    parser.add_argument(
+        "--rebuild-vector-index", action="store_true",
+        help="also rebuild the ANN index, e.g. to recluster IVFFlat lists")
+    args = parser.parse_args()
+
+    if VECTOR_STORE_BACKEND != "pgvector":
+        raise SystemExit(f"Nothing to migrate with the {VECTOR_STORE_BACKEND} backend.")
+    vector_store = await get_vector_store_singleton()
+    try:
+        pending = await vector_store.pending_migrations()
+        for change in pending:
+            print(f"Pending: {change}")
+        if args.check:
+            raise SystemExit(1 if pending else 0)
+
+        await create_metadata_tables()
+        await vector_store.migrate()
+        if args.rebuild_vector_index:
+            await vector_store.rebuild_vector_index()
+        print("Vector store schema is up to date.")
+    finally:
+        await vector_store.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,17 +1,31 @@
+import io
 import os
+import json
+import hashlib
 import logging
 import sqlalchemy
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 from dotenv import find_dotenv, load_dotenv
-from llama_index.vector_stores.postgres import PGVectorStore
+from llama_index.schema import BaseNode, MetadataMode
+from llama_index.vector_stores.postgres import DBEmbeddingRow, PGVectorStore
+from llama_index.vector_stores.utils import node_to_metadata_dict
+from llama_index.vector_stores.types import (
+    BasePydanticVectorStore,
+    MetadataFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+)
+from llama_index.bridge.pydantic import PrivateAttr
+from sqlalchemy.dialects.postgresql import TSQUERY, VARCHAR
 from sqlalchemy.engine import make_url
-from sqlmodel import SQLModel
+from sqlalchemy.types import UserDefinedType
 
 # from app.orm_models import Base
 from app.db.session import (
-    AsyncSessionLocal as AppAsyncSessionLocal,
-    async_engine as app_async_engine,
-    SessionLocal as AppSessionLocal,
-    engine as app_engine
+    VectorAsyncSessionLocal,
+    vector_async_engine,
+    VectorSessionLocal,
+    vector_engine,
 )
 
 
@@ -22,18 +36,169 @@ load_dotenv(find_dotenv())
 singleton_instance = None
 did_run_setup = False
 
+# Metadata keys copied into generated columns of the data table, so the tenant
+# filters of every query and delete can use btree indexes instead of scanning
+# the JSON of every row.
+TENANT_COLUMNS = {
+    "user_id": (sqlalchemy.String, "metadata_->>'user_id'"),
+    "doc_uuid": (sqlalchemy.String, "metadata_->>'doc_uuid'"),
+    # Rows ingested before the flag existed are active.
+    "is_active": (sqlalchemy.Boolean, "COALESCE((metadata_->>'is_active')::boolean, true)"),
+}
+
+# Partitioning of the data table by user: "none", "hash" (a fixed number of
+# partitions created by the migration) or "list" (one partition per user, created on
+# the first write of the user).
+VECTOR_TABLE_PARTITIONING = os.getenv("VECTOR_TABLE_PARTITIONING", "none")
+VECTOR_TABLE_HASH_PARTITIONS = int(os.getenv("VECTOR_TABLE_HASH_PARTITIONS", 16))
+
+# Approximate nearest neighbour index on the embeddings: "hnsw", "ivfflat" or
+# "none" for exact search. The index hands out its candidates before the tenant
+# filters are applied, so on a table shared by all users a small user may get
+# fewer than k rows: it is only the default with one partition per user.
+# Changing the type or its parameters rebuilds the index at the next migration.
+VECTOR_INDEX_TYPE = os.getenv(
+    "VECTOR_INDEX_TYPE", "hnsw" if VECTOR_TABLE_PARTITIONING == "list" else "none")
+HNSW_M = int(os.getenv("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 64))
+IVFFLAT_LISTS = int(os.getenv("IVFFLAT_LISTS", 100))
+# Query time defaults, higher values trade latency for recall.
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", 40))
+IVFFLAT_PROBES = int(os.getenv("IVFFLAT_PROBES", 10))
+# Keep scanning the ANN index until enough rows pass the filters: "off",
+# "relaxed_order" or "strict_order". Needs pgvector 0.8.
+VECTOR_ITERATIVE_SCAN = os.getenv("VECTOR_ITERATIVE_SCAN", "off")
+
+# Hybrid search fuses full text and vector rankings with reciprocal rank fusion.
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
+TEXT_SEARCH_CONFIG = os.getenv("TEXT_SEARCH_CONFIG", "english")
+# Candidates taken from each ranking before fusing them.
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 20))
+# RRF damping constant, the score of a row is sum(1 / (RRF_K + rank)).
+RRF_K = int(os.getenv("RRF_K", 60))
+
+# Quantized copy of the embeddings searched first: "none", "halfvec" (16 bit
+# floats) or "binary" (one bit per dimension). The candidates are reranked with
+# the full precision embeddings; needs pgvector 0.7.
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "none")
+# Candidates fetched from the quantized search for each result returned.
+VECTOR_RERANK_FACTOR = int(os.getenv("VECTOR_RERANK_FACTOR", 4))
+
+# "pgvector", or "memmap" for the in-process store of app.db.memmap_vector.
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "pgvector")
+
+
+def copy_escape(value: str) -> str:
+    """Escape a value for the text format of COPY."""
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+        # Postgres text can't hold NUL characters, PDF extraction sometimes yields them.
+        .replace("\x00", "")
+    )
+
+
+def quote_literal(value: str) -> str:
+    """Quote a string for DDL statements, which don't take bound parameters."""
+    return "'" + value.replace("'", "''") + "'"
+
+
+def vector_literal(embedding: List[float], quantization: str = "none") -> str:
+    """Text form of an embedding for a vector, halfvec or bit column."""
+    if quantization == "binary":
+        # Same as pgvector's binary_quantize: one bit set per positive dimension.
+        return "".join("1" if x > 0 else "0" for x in embedding)
+    return "[" + ",".join(str(float(x)) for x in embedding) + "]"
+
+
+class QuantizedVector(UserDefinedType):
+    """halfvec or bit column written from a list of floats."""
+
+    cache_ok = True
+
+    def __init__(self, quantization: str, dim: int) -> None:
+        if quantization not in ("halfvec", "binary"):
+            raise ValueError(f"Unknown vector quantization: {quantization}")
+        self.quantization = quantization
+        self.dim = dim
+
+    def get_col_spec(self, **kw: Any) -> str:
+        if self.quantization == "binary":
+            return f"bit({self.dim})"
+        return f"halfvec({self.dim})"
+
+    def bind_processor(self, dialect: Any) -> Any:
+        to_bits = None
+        if self.quantization == "binary" and dialect.driver == "asyncpg":
+            # asyncpg encodes bit parameters from BitString only.
+            from asyncpg import BitString
+            to_bits = BitString
+
+        def process(value: Any) -> Any:
+            if value is None:
+                return None
+            text = vector_literal(value, self.quantization)
+            return to_bits(text) if to_bits is not None else text
+        return process
+
+
+class REGCONFIG(UserDefinedType):
+    cache_ok = True
+
+    def get_col_spec(self, **kw: Any) -> str:
+        return "regconfig"
+
+
+def vector_search_kwargs(
+    ef_search: Optional[int] = None,
+    probes: Optional[int] = None,
+) -> dict:
+    """Vector store query kwargs tuning the configured ANN index.
+
+    Meant for the `vector_store_kwargs` of a `VectorIndexRetriever`.
+
+    Args:
+        ef_search (Optional[int], optional): HNSW candidate list size. Defaults to HNSW_EF_SEARCH.
+        probes (Optional[int], optional): IVFFlat lists to scan. Defaults to IVFFLAT_PROBES.
+    """
+    if VECTOR_INDEX_TYPE == "hnsw":
+        return {"hnsw_ef_search": ef_search or HNSW_EF_SEARCH}
+    if VECTOR_INDEX_TYPE == "ivfflat":
+        return {"ivfflat_probes": probes or IVFFLAT_PROBES}
+    return {}
+
 
 class CustomPGVectorStore(PGVectorStore):
     """
-    Custom PGVectorStore that uses the same connection pool as the FastAPI app.
+    Custom PGVectorStore that uses the connection pools of the FastAPI app
+    dedicated to vector search.
     """
 
+    # Users whose list partition is known to exist.
+    _partitions: Set[str] = PrivateAttr(default_factory=set)
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        if VECTOR_TABLE_PARTITIONING != "none":
+            # The partition key is written by the app: Postgres doesn't allow
+            # partitioning on a generated column.
+            self._table_class.user_id = sqlalchemy.Column(VARCHAR, nullable=False)
+        if VECTOR_QUANTIZATION != "none":
+            self._table_class.embedding_q = sqlalchemy.Column(
+                QuantizedVector(VECTOR_QUANTIZATION, self.embed_dim))
+
+    @property
+    def partitioned(self) -> bool:
+        return VECTOR_TABLE_PARTITIONING != "none"
+
     def _connect(self) -> None:
-        # Use our existing app engine and session so we can use the same connection pool
-        self._engine = app_engine
-        self._session = AppSessionLocal
-        self._async_engine = app_async_engine
-        self._async_session = AppAsyncSessionLocal
+        # Use the app's vector engines and sessions so we share their connection pools
+        self._engine = vector_engine
+        self._session = VectorSessionLocal
+        self._async_engine = vector_async_engine
+        self._async_session = VectorAsyncSessionLocal
 
     async def close(self) -> None:
         self._session.close_all()
@@ -47,34 +212,826 @@ class CustomPGVectorStore(PGVectorStore):
     def _create_extension(self) -> None:
         pass
 
-    async def run_setup(self) -> None:
-        global did_run_setup
-        if did_run_setup:
+    @property
+    def data_table_name(self) -> str:
+        return f"{self.schema_name}.data_{self.table_name}"
+
+    def _node_to_row(self, node: BaseNode) -> dict:
+        row = {
+            "node_id": node.node_id,
+            "text": node.get_content(metadata_mode=MetadataMode.NONE),
+            "metadata_": node_to_metadata_dict(
+                node,
+                remove_text=True,
+                flat_metadata=self.flat_metadata,
+            ),
+            "embedding": node.get_embedding(),
+        }
+        if self.partitioned:
+            row["user_id"] = node.metadata["user_id"]
+        if VECTOR_QUANTIZATION != "none":
+            row["embedding_q"] = row["embedding"]
+        return row
+
+    def _row_to_copy_line(self, row: dict) -> str:
+        fields = []
+        for column, value in row.items():
+            if column == "metadata_":
+                value = json.dumps(value)
+            elif column == "embedding":
+                value = vector_literal(value)
+            elif column == "embedding_q":
+                value = vector_literal(value, VECTOR_QUANTIZATION)
+            fields.append(copy_escape(str(value)))
+        return "\t".join(fields) + "\n"
+
+    def _partition_name(self, user_id: str) -> str:
+        digest = hashlib.md5(user_id.encode()).hexdigest()[:16]
+        return f"{self.schema_name}.data_{self.table_name}_u{digest}"
+
+    def _missing_partitions(self, user_ids: Iterable[str]) -> List[str]:
+        """DDL creating the list partitions of the given users not created yet."""
+        if VECTOR_TABLE_PARTITIONING != "list":
+            return []
+        return [
+            f"CREATE TABLE IF NOT EXISTS {self._partition_name(user_id)} "
+            f"PARTITION OF {self.data_table_name} FOR VALUES IN ({quote_literal(user_id)})"
+            for user_id in sorted(set(user_ids) - self._partitions)
+        ]
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        """Write the nodes with a single COPY, in one transaction."""
+        self._initialize()
+        if not nodes:
+            return []
+        rows = [self._node_to_row(node) for node in nodes]
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write(self._row_to_copy_line(row))
+        buffer.seek(0)
+
+        partitions = self._missing_partitions(row.get("user_id") for row in rows)
+        # Generated columns (tenant keys, tsvector) are filled in by Postgres.
+        with self._engine.begin() as conn:
+            for statement in partitions:
+                conn.execute(sqlalchemy.text(statement))
+            cursor = conn.connection.cursor()
+            try:
+                cursor.copy_expert(
+                    f"COPY {self.data_table_name} ({', '.join(rows[0])}) FROM STDIN",
+                    buffer,
+                )
+            finally:
+                cursor.close()
+        self._partitions.update(row["user_id"] for row in rows if "user_id" in row)
+        return [node.node_id for node in nodes]
+
+    async def async_add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        """Write the nodes with batched multi-row INSERTs, in one transaction."""
+        self._initialize()
+        if not nodes:
+            return []
+        rows = [self._node_to_row(node) for node in nodes]
+        partitions = self._missing_partitions(row.get("user_id") for row in rows)
+        async with self._async_session() as session, session.begin():
+            for statement in partitions:
+                await session.execute(sqlalchemy.text(statement))
+            await session.execute(sqlalchemy.insert(self._table_class), rows)
+        self._partitions.update(row["user_id"] for row in rows if "user_id" in row)
+        return [node.node_id for node in nodes]
+
+    def _filter_clause(self, filter_: MetadataFilter) -> Any:
+        operator = self._to_postgres_operator(filter_.operator)
+        if filter_.key in TENANT_COLUMNS:
+            column_type, _ = TENANT_COLUMNS[filter_.key]
+            value = filter_.value
+            if column_type is sqlalchemy.Boolean:
+                value = str(value).lower() == "true"
+            else:
+                value = str(value)
+            return sqlalchemy.column(filter_.key, column_type).op(operator)(value)
+        return self._table_class.metadata_[filter_.key].astext.op(operator)(
+            str(filter_.value))
+
+    def _apply_filters_and_limit(
+        self,
+        stmt: Any,
+        limit: int,
+        metadata_filters: Optional[MetadataFilters] = None,
+    ) -> Any:
+        # Same as the parent class, but with bound parameters and the tenant columns.
+        sqlalchemy_conditions = {
+            "or": sqlalchemy.sql.or_,
+            "and": sqlalchemy.sql.and_,
+        }
+
+        if metadata_filters:
+            if metadata_filters.condition not in sqlalchemy_conditions:
+                raise ValueError(
+                    f"Invalid condition: {metadata_filters.condition}. "
+                    f"Must be one of {list(sqlalchemy_conditions.keys())}"
+                )
+            stmt = stmt.where(
+                sqlalchemy_conditions[metadata_filters.condition](
+                    *(self._filter_clause(filter_)
+                      for filter_ in metadata_filters.filters)
+                )
+            )
+        return stmt.limit(limit)
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        self._initialize()
+        with self._session() as session, session.begin():
+            stmt = sqlalchemy.text(
+                f"DELETE FROM {self.data_table_name} "
+                "WHERE metadata_->>'doc_id' = :ref_doc_id"
+            )
+            session.execute(stmt, {"ref_doc_id": ref_doc_id})
+
+    async def has_user_rows(self, user_id: str) -> bool:
+        self._initialize()
+        async with self._async_session() as session, session.begin():
+            result = await session.execute(
+                sqlalchemy.text(
+                    f"SELECT id FROM {self.data_table_name} "
+                    "WHERE user_id = :user_id LIMIT 1"),
+                {"user_id": user_id},
+            )
+        return result.first() is not None
+
+    async def has_document_rows(self, user_id: str, doc_uuid: str) -> bool:
+        self._initialize()
+        async with self._async_session() as session, session.begin():
+            result = await session.execute(
+                sqlalchemy.text(
+                    f"SELECT id FROM {self.data_table_name} "
+                    "WHERE doc_uuid = :doc_uuid AND user_id = :user_id LIMIT 1"),
+                {"doc_uuid": doc_uuid, "user_id": user_id},
+            )
+        return result.first() is not None
+
+    async def delete_document_rows(self, user_id: str, doc_uuid: str) -> None:
+        self._initialize()
+        async with self._async_session() as session, session.begin():
+            await session.execute(
+                sqlalchemy.text(
+                    f"DELETE FROM {self.data_table_name} "
+                    "WHERE doc_uuid = :doc_uuid AND user_id = :user_id"),
+                {"doc_uuid": doc_uuid, "user_id": user_id},
+            )
+
+    async def set_documents_active(
+        self,
+        user_id: str,
+        doc_uuids: List[str],
+        is_active: bool,
+    ) -> None:
+        """Flip the `is_active` metadata of the nodes of some documents.
+
+        The generated `is_active` column follows, so no node is re-embedded.
+        """
+        self._initialize()
+        metadata_type = "jsonb" if self.use_jsonb else "json"
+        async with self._async_session() as session, session.begin():
+            await session.execute(
+                sqlalchemy.text(
+                    f"UPDATE {self.data_table_name} SET metadata_ = jsonb_set("
+                    "metadata_::jsonb, '{is_active}', to_jsonb(CAST(:is_active AS boolean))"
+                    f")::{metadata_type} "
+                    "WHERE user_id = :user_id AND doc_uuid = ANY(:doc_uuids)"
+                ),
+                {"is_active": is_active, "user_id": user_id, "doc_uuids": doc_uuids},
+            )
+
+    async def delete_user_rows(self, user_id: str) -> None:
+        """Delete every row of a user, only touching the user's partition."""
+        self._initialize()
+        async with self._async_session() as session, session.begin():
+            if VECTOR_TABLE_PARTITIONING == "list":
+                # Emptying the partition only locks this user's rows.
+                if await self._partition_exists(session, user_id):
+                    await session.execute(sqlalchemy.text(
+                        f"TRUNCATE {self._partition_name(user_id)}"))
+                return
+            await session.execute(
+                sqlalchemy.text(
+                    f"DELETE FROM {self.data_table_name} WHERE user_id = :user_id"),
+                {"user_id": user_id},
+            )
+
+    async def _partition_exists(self, session: Any, user_id: str) -> bool:
+        result = await session.execute(
+            sqlalchemy.text("SELECT to_regclass(:name) IS NOT NULL"),
+            {"name": self._partition_name(user_id)},
+        )
+        return bool(result.scalar())
+
+    async def _create_partitioned_table(self, conn: Any) -> None:
+        """Create the data table partitioned by user, migrating an unpartitioned one.
+
+        Only the base columns are declared here, the generated columns and the
+        indexes are added to the parent table, hence to every partition, by the
+        rest of the migration.
+        """
+        table = self.data_table_name
+        kind = await self._relkind(conn)
+        if kind == "p":
             return
+
+        legacy_table = None
+        if kind is not None:
+            legacy_table = f"data_{self.table_name}_unpartitioned"
+            logger.info(f"Migrating {table} to a partitioned table")
+            await conn.execute(sqlalchemy.text(
+                f"ALTER TABLE {table} RENAME TO {legacy_table}"))
+            legacy_table = f"{self.schema_name}.{legacy_table}"
+
+        strategy = VECTOR_TABLE_PARTITIONING.upper()
+        if strategy not in ("HASH", "LIST"):
+            raise ValueError(
+                f"Unknown partitioning: {VECTOR_TABLE_PARTITIONING}")
+        metadata_type = "JSONB" if self.use_jsonb else "JSON"
+        await conn.execute(sqlalchemy.text(
+            f"CREATE TABLE {table} ("
+            "id BIGSERIAL, "
+            "text VARCHAR NOT NULL, "
+            f"metadata_ {metadata_type}, "
+            "node_id VARCHAR, "
+            f"embedding vector({self.embed_dim}), "
+            "user_id VARCHAR NOT NULL, "
+            "PRIMARY KEY (id, user_id)"
+            f") PARTITION BY {strategy} (user_id)"
+        ))
+        if VECTOR_TABLE_PARTITIONING == "hash":
+            for remainder in range(VECTOR_TABLE_HASH_PARTITIONS):
+                await conn.execute(sqlalchemy.text(
+                    f"CREATE TABLE {table}_p{remainder} PARTITION OF {table} "
+                    f"FOR VALUES WITH (MODULUS {VECTOR_TABLE_HASH_PARTITIONS}, "
+                    f"REMAINDER {remainder})"
+                ))
+
+        if legacy_table is not None:
+            if VECTOR_TABLE_PARTITIONING == "list":
+                user_ids = (await conn.execute(sqlalchemy.text(
+                    f"SELECT DISTINCT metadata_->>'user_id' FROM {legacy_table} "
+                    "WHERE metadata_->>'user_id' IS NOT NULL"
+                ))).scalars().all()
+                for statement in self._missing_partitions(user_ids):
+                    await conn.execute(sqlalchemy.text(statement))
+            await conn.execute(sqlalchemy.text(
+                f"INSERT INTO {table} (text, metadata_, node_id, embedding, user_id) "
+                "SELECT text, metadata_, node_id, embedding, metadata_->>'user_id' "
+                f"FROM {legacy_table} WHERE metadata_->>'user_id' IS NOT NULL"
+            ))
+            # Dropping it frees the index names for the indexes of the new table.
+            await conn.execute(sqlalchemy.text(f"DROP TABLE {legacy_table}"))
+
+    async def _create_tenant_columns(self, conn: Any) -> None:
+        """Add the generated tenant columns to the data table.
+
+        Adding a stored generated column rewrites the table once, which backfills
+        the existing rows; new rows are filled in by Postgres on insert.
+        """
+        table = self.data_table_name
+        for name, (column_type, expression) in TENANT_COLUMNS.items():
+            await conn.execute(sqlalchemy.text(
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {name} "
+                f"{column_type().compile()} GENERATED ALWAYS AS ({expression}) STORED"
+            ))
+
+    def _index_definitions(self) -> Dict[str, str]:
+        """Indexes of the data table other than the vector index, by name."""
+        indexes = {
+            f"data_{self.table_name}_user_id_idx": "(user_id, is_active)",
+            f"data_{self.table_name}_doc_uuid_idx": "(doc_uuid, user_id)",
+        }
+        if self.hybrid_search:
+            # Same name as the index create_all makes for new hybrid tables.
+            indexes[f"{self.table_name}_idx"] = "USING gin (text_search_tsv)"
+        return indexes
+
+    async def _index_is_valid(self, conn: Any, name: str) -> Optional[bool]:
+        """None if the index doesn't exist, else whether it is valid."""
+        return (await conn.execute(
+            sqlalchemy.text(
+                "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+            {"name": f"{self.schema_name}.{name}"},
+        )).scalar()
+
+    async def _drop_index(self, conn: Any, name: str) -> None:
+        # Partitioned indexes can't be dropped concurrently.
+        concurrently = "" if self.partitioned else "CONCURRENTLY "
+        await conn.execute(sqlalchemy.text(
+            f"DROP INDEX {concurrently}IF EXISTS {self.schema_name}.{name}"))
+
+    async def _create_index(self, conn: Any, name: str, definition: str) -> None:
+        """Build an index without blocking the writes to the data table.
+
+        `conn` must be in autocommit mode, CREATE INDEX CONCURRENTLY can't run in a
+        transaction. A build interrupted midway leaves an invalid index, which is
+        dropped and built again.
+        """
+        table = self.data_table_name
+        valid = await self._index_is_valid(conn, name)
+        if valid:
+            return
+        logger.info(f"Building index {name}")
+        if not self.partitioned:
+            if valid is not None:
+                await self._drop_index(conn, name)
+            await conn.execute(sqlalchemy.text(
+                f"CREATE INDEX CONCURRENTLY {name} ON {table} {definition}"))
+            return
+
+        # Partitioned tables can't be indexed concurrently: create the index on the
+        # parent only, build it on each partition concurrently, then attach them.
+        await conn.execute(sqlalchemy.text(
+            f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} {definition}"))
+        partitions = (await conn.execute(
+            sqlalchemy.text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = to_regclass(:table) AND NOT EXISTS ("
+                "SELECT 1 FROM pg_inherits ii JOIN pg_index x ON x.indexrelid = ii.inhrelid "
+                "WHERE ii.inhparent = to_regclass(:index) AND x.indrelid = i.inhrelid)"),
+            {"table": table, "index": f"{self.schema_name}.{name}"},
+        )).scalars().all()
+        for partition in partitions:
+            digest = hashlib.md5(partition.encode()).hexdigest()[:8]
+            partition_index = f"{name}_{digest}"
+            if await self._index_is_valid(conn, partition_index) is False:
+                await conn.execute(sqlalchemy.text(
+                    f"DROP INDEX CONCURRENTLY {self.schema_name}.{partition_index}"))
+            await conn.execute(sqlalchemy.text(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {partition_index} "
+                f"ON {self.schema_name}.{partition} {definition}"))
+            await conn.execute(sqlalchemy.text(
+                f"ALTER INDEX {self.schema_name}.{name} "
+                f"ATTACH PARTITION {self.schema_name}.{partition_index}"))
+
+    def _quantized_distance(self, embedding: List[float]) -> Any:
+        query = sqlalchemy.bindparam(
+            None, embedding, type_=QuantizedVector(VECTOR_QUANTIZATION, self.embed_dim))
+        if VECTOR_QUANTIZATION == "binary":
+            return self._table_class.embedding_q.op("<~>")(query)
+        return self._table_class.embedding_q.op("<=>")(query)
+
+    def _build_query(
+        self,
+        embedding: Optional[List[float]],
+        limit: int = 10,
+        metadata_filters: Optional[MetadataFilters] = None,
+    ) -> Any:
+        table = self._table_class
+        distance = table.embedding.cosine_distance(embedding).label("distance")
+        # Named columns in both cases: the query methods and the hybrid query
+        # read the rows by column name.
+        columns = (table.id, table.node_id, table.text, table.metadata_, distance)
+        if VECTOR_QUANTIZATION == "none":
+            return self._apply_filters_and_limit(
+                sqlalchemy.select(*columns).order_by(distance), limit, metadata_filters)
+        # First pass on the (indexed) quantized vectors, then rerank the
+        # candidates by their exact cosine distance.
+        candidates = self._apply_filters_and_limit(
+            sqlalchemy.select(table.id).order_by(self._quantized_distance(embedding)),
+            limit * VECTOR_RERANK_FACTOR,
+            metadata_filters,
+        ).subquery("candidates")
+        return (
+            sqlalchemy.select(*columns)
+            .join(candidates, table.id == candidates.c.id)
+            .order_by(distance)
+            .limit(limit)
+        )
+
+    def _search_settings(self, limit: int, **kwargs: Any) -> List[str]:
+        # SET LOCAL only lasts for the transaction, so the settings of one query
+        # don't leak into the next user of the pooled connection.
+        statements = []
+        if kwargs.get("hnsw_ef_search"):
+            # An ef_search below the number of rows fetched from the index
+            # would return fewer rows than asked.
+            if VECTOR_QUANTIZATION != "none":
+                limit *= VECTOR_RERANK_FACTOR
+            ef_search = max(int(kwargs["hnsw_ef_search"]), limit)
+            statements.append(f"SET LOCAL hnsw.ef_search = {ef_search}")
+        if kwargs.get("ivfflat_probes"):
+            statements.append(
+                f"SET LOCAL ivfflat.probes = {int(kwargs['ivfflat_probes'])}")
+        if VECTOR_ITERATIVE_SCAN != "off" and statements:
+            if VECTOR_ITERATIVE_SCAN not in ("relaxed_order", "strict_order"):
+                raise ValueError(f"Unknown iterative scan: {VECTOR_ITERATIVE_SCAN}")
+            index_type = "hnsw" if kwargs.get("hnsw_ef_search") else "ivfflat"
+            statements.append(
+                f"SET LOCAL {index_type}.iterative_scan = {VECTOR_ITERATIVE_SCAN}")
+        return statements
+
+    def _query_with_score(
+        self,
+        embedding: Optional[List[float]],
+        limit: int = 10,
+        metadata_filters: Optional[MetadataFilters] = None,
+        **kwargs: Any,
+    ) -> List[DBEmbeddingRow]:
+        stmt = self._build_query(embedding, limit, metadata_filters)
+        with self._session() as session, session.begin():
+            for setting in self._search_settings(limit, **kwargs):
+                session.execute(sqlalchemy.text(setting))
+            res = session.execute(stmt)
+            return [
+                DBEmbeddingRow(
+                    node_id=item.node_id,
+                    text=item.text,
+                    metadata=item.metadata_,
+                    similarity=(1 - item.distance) if item.distance is not None else 0,
+                )
+                for item in res.all()
+            ]
+
+    async def _aquery_with_score(
+        self,
+        embedding: Optional[List[float]],
+        limit: int = 10,
+        metadata_filters: Optional[MetadataFilters] = None,
+        **kwargs: Any,
+    ) -> List[DBEmbeddingRow]:
+        stmt = self._build_query(embedding, limit, metadata_filters)
+        async with self._async_session() as session, session.begin():
+            for setting in self._search_settings(limit, **kwargs):
+                await session.execute(sqlalchemy.text(setting))
+            res = await session.execute(stmt)
+            return [
+                DBEmbeddingRow(
+                    node_id=item.node_id,
+                    text=item.text,
+                    metadata=item.metadata_,
+                    similarity=(1 - item.distance) if item.distance is not None else 0,
+                )
+                for item in res.all()
+            ]
+
+    def _text_search_query(self, query_str: str) -> Any:
+        """Full text query matching the chunks that contain any word of the query.
+
+        plainto_tsquery ANDs the lexemes, so a question would only match chunks
+        containing all of its words; they are ORed and ts_rank favours the chunks
+        that match more of them.
+        """
+        ts_query = sqlalchemy.func.plainto_tsquery(
+            sqlalchemy.type_coerce(self.text_search_config, REGCONFIG), query_str)
+        # The lexemes are already normalized and quoted in the text form.
+        return sqlalchemy.cast(
+            sqlalchemy.func.replace(
+                sqlalchemy.cast(ts_query, sqlalchemy.Text), " & ", " | "),
+            TSQUERY,
+        )
+
+    @staticmethod
+    def _dense_limit(query: VectorStoreQuery) -> int:
+        """Rows fetched by the vector ranking of a hybrid query."""
+        return max(query.similarity_top_k, HYBRID_CANDIDATES)
+
+    def _build_hybrid_query(self, query: VectorStoreQuery) -> Any:
+        """Fuse the vector and full text rankings of a query in one statement.
+
+        Each ranking keeps its best `HYBRID_CANDIDATES` rows (or the top k if
+        larger); rows are scored by reciprocal rank fusion over both rankings.
+        """
+        if query.query_str is None:
+            raise ValueError("query_str must be specified for a hybrid query.")
+        table = self._table_class
+        dense_limit = self._dense_limit(query)
+        sparse_limit = max(
+            query.sparse_top_k or query.similarity_top_k, HYBRID_CANDIDATES)
+
+        dense_hits = self._build_query(
+            query.query_embedding, dense_limit, query.filters).subquery("dense_hits")
+        dense = sqlalchemy.select(
+            dense_hits.c.id,
+            sqlalchemy.func.row_number().over(
+                order_by=dense_hits.c.distance).label("rank"),
+        ).cte("dense")
+
+        ts_query = self._text_search_query(query.query_str)
+        text_rank = sqlalchemy.func.ts_rank(table.text_search_tsv, ts_query)
+        sparse_hits = self._apply_filters_and_limit(
+            sqlalchemy.select(table.id, text_rank.label("text_rank"))
+            .where(table.text_search_tsv.op("@@")(ts_query))
+            .order_by(text_rank.desc()),
+            sparse_limit,
+            query.filters,
+        ).subquery("sparse_hits")
+        sparse = sqlalchemy.select(
+            sparse_hits.c.id,
+            sqlalchemy.func.row_number().over(
+                order_by=sparse_hits.c.text_rank.desc()).label("rank"),
+        ).cte("sparse")
+
+        score = (
+            sqlalchemy.func.coalesce(1.0 / (RRF_K + dense.c.rank), 0.0)
+            + sqlalchemy.func.coalesce(1.0 / (RRF_K + sparse.c.rank), 0.0)
+        ).label("score")
+        fused = (
+            sqlalchemy.select(
+                sqlalchemy.func.coalesce(dense.c.id, sparse.c.id).label("id"), score)
+            .select_from(dense.join(sparse, dense.c.id == sparse.c.id, full=True))
+            .order_by(score.desc())
+            .limit(query.similarity_top_k)
+            .cte("fused")
+        )
+        return (
+            sqlalchemy.select(
+                table.node_id, table.text, table.metadata_, fused.c.score)
+            .join(fused, table.id == fused.c.id)
+            .order_by(fused.c.score.desc())
+        )
+
+    def _hybrid_query(
+        self, query: VectorStoreQuery, **kwargs: Any
+    ) -> List[DBEmbeddingRow]:
+        stmt = self._build_hybrid_query(query)
+        with self._session() as session, session.begin():
+            for setting in self._search_settings(self._dense_limit(query), **kwargs):
+                session.execute(sqlalchemy.text(setting))
+            res = session.execute(stmt)
+            return [
+                DBEmbeddingRow(
+                    node_id=item.node_id,
+                    text=item.text,
+                    metadata=item.metadata_,
+                    similarity=item.score,
+                )
+                for item in res.all()
+            ]
+
+    async def _async_hybrid_query(
+        self, query: VectorStoreQuery, **kwargs: Any
+    ) -> List[DBEmbeddingRow]:
+        stmt = self._build_hybrid_query(query)
+        async with self._async_session() as session, session.begin():
+            for setting in self._search_settings(self._dense_limit(query), **kwargs):
+                await session.execute(sqlalchemy.text(setting))
+            res = await session.execute(stmt)
+            return [
+                DBEmbeddingRow(
+                    node_id=item.node_id,
+                    text=item.text,
+                    metadata=item.metadata_,
+                    similarity=item.score,
+                )
+                for item in res.all()
+            ]
+
+    async def _create_text_search_column(self, conn: Any) -> None:
+        """Add the tsvector column to a table created without it."""
+        await conn.execute(sqlalchemy.text(
+            f"ALTER TABLE {self.data_table_name} ADD COLUMN IF NOT EXISTS text_search_tsv "
+            f"tsvector GENERATED ALWAYS AS (to_tsvector('{self.text_search_config}', text)) STORED"
+        ))
+
+    async def _create_quantized_column(self, conn: Any) -> None:
+        """Add the quantized vector column, filled by the write paths and `backfill_quantized`."""
+        column_type = QuantizedVector(VECTOR_QUANTIZATION, self.embed_dim)
+        await conn.execute(sqlalchemy.text(
+            f"ALTER TABLE {self.data_table_name} "
+            f"ADD COLUMN IF NOT EXISTS embedding_q {column_type.get_col_spec()}"
+        ))
+
+    async def backfill_quantized(self, batch_size: int = 1000) -> int:
+        """Quantize the embeddings of rows written before quantization was enabled.
+
+        Rows are updated in batches, each in its own transaction, so the table is
+        never locked for long and the backfill can be interrupted and resumed.
+
+        Returns:
+            int: number of rows updated.
+        """
+        self._initialize()
+        column_type = QuantizedVector(VECTOR_QUANTIZATION, self.embed_dim)
+        if VECTOR_QUANTIZATION == "binary":
+            expression = f"binary_quantize(embedding)::{column_type.get_col_spec()}"
+        else:
+            expression = f"embedding::{column_type.get_col_spec()}"
+        stmt = sqlalchemy.text(
+            f"UPDATE {self.data_table_name} SET embedding_q = {expression} "
+            f"WHERE id IN (SELECT id FROM {self.data_table_name} "
+            "WHERE embedding_q IS NULL AND embedding IS NOT NULL LIMIT :batch_size)"
+        )
+        updated = 0
+        while True:
+            async with self._async_session() as session, session.begin():
+                result = await session.execute(stmt, {"batch_size": batch_size})
+            updated += result.rowcount
+            if result.rowcount < batch_size:
+                return updated
+
+    def _vector_index_definition(self) -> Optional[str]:
+        # Written the way pg_indexes shows it, to detect configuration changes.
+        # With quantization only the quantized vectors are indexed.
+        column = {
+            "none": "embedding vector_cosine_ops",
+            "halfvec": "embedding_q halfvec_cosine_ops",
+            "binary": "embedding_q bit_hamming_ops",
+        }[VECTOR_QUANTIZATION]
+        if VECTOR_INDEX_TYPE == "hnsw":
+            return (
+                f"USING hnsw ({column}) "
+                f"WITH (m='{HNSW_M}', ef_construction='{HNSW_EF_CONSTRUCTION}')"
+            )
+        if VECTOR_INDEX_TYPE == "ivfflat":
+            return (
+                f"USING ivfflat ({column}) "
+                f"WITH (lists='{IVFFLAT_LISTS}')"
+            )
+        if VECTOR_INDEX_TYPE == "none":
+            return None
+        raise ValueError(f"Unknown vector index type: {VECTOR_INDEX_TYPE}")
+
+    async def _vector_index(self, conn: Any) -> Optional[str]:
+        """Definition of the existing vector index, as shown by pg_indexes."""
+        return (await conn.execute(
+            sqlalchemy.text(
+                "SELECT indexdef FROM pg_indexes "
+                "WHERE schemaname = :schema AND indexname = :name"),
+            {"schema": self.schema_name, "name": f"data_{self.table_name}_embedding_idx"},
+        )).scalar()
+
+    async def _create_vector_index(self, conn: Any, rebuild: bool = False) -> None:
+        """Create the ANN index, or rebuild it if asked or if its configuration changed.
+
+        `conn` must be in autocommit mode, see `_create_index`. Without partitions,
+        the new index is built next to the old one, which keeps serving queries.
+        """
+        index_name = f"data_{self.table_name}_embedding_idx"
+        definition = self._vector_index_definition()
+        existing = await self._vector_index(conn)
+
+        if definition is None:
+            if existing is not None:
+                logger.info(f"Dropping vector index {index_name}")
+                await self._drop_index(conn, index_name)
+            return
+        if existing is not None and not rebuild and existing.endswith(definition):
+            # Rebuilt if a previous build was interrupted.
+            await self._create_index(conn, index_name, definition)
+            return
+
+        if VECTOR_INDEX_TYPE == "ivfflat":
+            # IVFFlat clusters the rows present at build time, an index built on a
+            # near empty table has useless lists. Wait for a rebuild with data.
+            rows = (await conn.execute(sqlalchemy.text(
+                f"SELECT count(*) FROM (SELECT 1 FROM {self.data_table_name} "
+                "LIMIT :lists) AS sample"), {"lists": IVFFLAT_LISTS})).scalar()
+            if rows < IVFFLAT_LISTS:
+                logger.info(
+                    f"Not enough rows to build {index_name}, using exact search")
+                if existing is not None:
+                    await self._drop_index(conn, index_name)
+                return
+
+        if existing is None:
+            await self._create_index(conn, index_name, definition)
+        elif self.partitioned:
+            logger.info(f"Dropping vector index {index_name}")
+            await self._drop_index(conn, index_name)
+            await self._create_index(conn, index_name, definition)
+        else:
+            new_index_name = f"{index_name}_new"
+            await self._create_index(conn, new_index_name, definition)
+            logger.info(f"Replacing vector index {index_name}")
+            await self._drop_index(conn, index_name)
+            await conn.execute(sqlalchemy.text(
+                f"ALTER INDEX {self.schema_name}.{new_index_name} RENAME TO {index_name}"))
+
+    async def rebuild_vector_index(self) -> None:
+        """Rebuild the ANN index, e.g. to recluster IVFFlat lists once the table grew."""
         self._initialize()
+        async with self._async_engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await self._create_vector_index(conn, rebuild=True)
+
+    async def _relkind(self, conn: Any) -> Optional[str]:
+        return (await conn.execute(
+            sqlalchemy.text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"),
+            {"name": self.data_table_name},
+        )).scalar()
+
+    async def _pending_changes(self, conn: Any) -> Tuple[List[str], List[str]]:
+        """Schema changes and index builds that `migrate` would make.
+
+        The queries need the schema changes; without the indexes they are only slower.
+        """
+        kind = await self._relkind(conn)
+        if kind is None:
+            return [f"create {self.data_table_name}"], []
+        schema_changes = []
+        if self.partitioned and kind != "p":
+            schema_changes.append(f"partition {self.data_table_name}")
+        columns = set((await conn.execute(
+            sqlalchemy.text(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_schema = :schema AND table_name = :table"),
+            {"schema": self.schema_name, "table": f"data_{self.table_name}"},
+        )).scalars().all())
+        expected = list(TENANT_COLUMNS)
+        if self.hybrid_search:
+            expected.append("text_search_tsv")
+        if VECTOR_QUANTIZATION != "none":
+            expected.append("embedding_q")
+        schema_changes.extend(
+            f"add column {column}" for column in expected if column not in columns)
 
+        index_builds = []
+        for name in self._index_definitions():
+            if not await self._index_is_valid(conn, name):
+                index_builds.append(f"build index {name}")
+        definition = self._vector_index_definition()
+        existing = await self._vector_index(conn)
+        if existing is not None and (definition is None or not existing.endswith(definition)):
+            index_builds.append("replace the vector index")
+        elif existing is None and definition is not None:
+            index_builds.append(f"build the {VECTOR_INDEX_TYPE} vector index")
+        return schema_changes, index_builds
+
+    async def pending_migrations(self) -> List[str]:
+        """Schema changes and index builds that `migrate` would make to the data table."""
+        self._initialize()
+        async with self._async_engine.connect() as conn:
+            schema_changes, index_builds = await self._pending_changes(conn)
+        return schema_changes + index_builds
+
+    async def migrate(self) -> None:
+        """Bring the data table up to date with the configuration.
+
+        Run by `python -m app.db.migrate`, not at startup: partitioning or adding the
+        generated columns rewrites the table, and building the indexes of a large
+        table takes a while, even though they are built concurrently.
+        """
+        self._initialize()
         async with self._async_session() as session:
             async with session.begin():
-                statement = sqlalchemy.text(
-                    "CREATE EXTENSION IF NOT EXISTS vector")
-                await session.execute(statement)
-                await session.commit()
+                await session.execute(sqlalchemy.text(
+                    "CREATE EXTENSION IF NOT EXISTS vector"))
 
         async with self._async_session() as session:
             async with session.begin():
                 conn = await session.connection()
+                if self.partitioned:
+                    await self._create_partitioned_table(conn)
                 # Create vector tables.
                 await conn.run_sync(self._base.metadata.create_all)
-                # Create all non-vector tables.
-                await conn.run_sync(SQLModel.metadata.create_all)
+                await self._create_tenant_columns(conn)
+                if self.hybrid_search:
+                    await self._create_text_search_column(conn)
+                if VECTOR_QUANTIZATION != "none":
+                    await self._create_quantized_column(conn)
+
+        async with self._async_engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            for name, definition in self._index_definitions().items():
+                await self._create_index(conn, name, definition)
+            await self._create_vector_index(conn)
+
+    async def run_setup(self) -> None:
+        """Create the schema of a new database, only check an existing one.
+
+        Raises:
+            RuntimeError: an existing database misses columns the queries need.
+        """
+        global did_run_setup
+        if did_run_setup:
+            return
+        self._initialize()
+
+        async with self._async_engine.connect() as conn:
+            exists = await self._relkind(conn) is not None
+            if exists:
+                schema_changes, index_builds = await self._pending_changes(conn)
+        if not exists:
+            # Nothing to rewrite or index yet.
+            await self.migrate()
+        elif schema_changes:
+            # Rewriting a large table at startup would hold it locked for minutes,
+            # and the queries can't run without the new columns.
+            raise RuntimeError(
+                f"The vector store schema is out of date ({'; '.join(schema_changes)}), "
+                "run `python -m app.db.migrate` before starting the app")
+        elif index_builds:
+            logger.warning(
+                f"Vector store indexes are missing ({'; '.join(index_builds)}), "
+                "queries will be slow until `python -m app.db.migrate` is run")
 
         did_run_setup = True
 
 
-async def get_vector_store_singleton() -> PGVectorStore:
+async def get_vector_store_singleton() -> BasePydanticVectorStore:
     global singleton_instance
     if singleton_instance is not None:
         return singleton_instance
+    if VECTOR_STORE_BACKEND == "memmap":
+        from app.db.memmap_vector import MemmapVectorStore
+        singleton_instance = MemmapVectorStore(embed_dim=1024)
+        return singleton_instance
     url = make_url(os.environ["POSTGRE_CONNECTION_STRING"])
     singleton_instance = CustomPGVectorStore.from_params(
         url.host,
@@ -84,7 +1041,7 @@ async def get_vector_store_singleton() -> PGVectorStore:
         url.password,
         os.environ["VECTOR_STORE_TABLE_NAME"],
         embed_dim=1024,
-        # hybrid_search=True,
-        # text_search_config="english"
+        hybrid_search=HYBRID_SEARCH,
+        text_search_config=TEXT_SEARCH_CONFIG,
     )
     return singleton_instance
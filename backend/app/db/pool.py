@@ -0,0 +1,99 @@
+import time
+import threading
+from contextvars import ContextVar
+from typing import Dict, Type
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import Pool
+
+from app.utils.metrics import Histogram, LatencyStats
+
+# Endpoint the current task works for, set by the HTTP middleware. Checkouts done
+# outside of a request (startup, background jobs) keep the default tag.
+current_endpoint: ContextVar[str] = ContextVar("current_endpoint", default="background")
+
+
+class EndpointPoolStats:
+    def __init__(self) -> None:
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = LatencyStats()
+        self.wait_histogram = Histogram()
+
+    def stats(self) -> dict:
+        return {
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_time": self.wait_time.stats(),
+            "wait_histogram": self.wait_histogram.stats(),
+        }
+
+
+class PoolMetrics:
+    """Checkout metrics of a connection pool, tagged by the calling endpoint."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.pool: Pool = None
+        self.max_checked_out = 0
+        self.max_overflow_used = 0
+        self._endpoints: Dict[str, EndpointPoolStats] = {}
+        self._lock = threading.Lock()
+
+    def _endpoint(self, endpoint: str) -> EndpointPoolStats:
+        stats = self._endpoints.get(endpoint)
+        if stats is None:
+            stats = self._endpoints[endpoint] = EndpointPoolStats()
+        return stats
+
+    def observe_checkout(self, pool: Pool, seconds: float) -> None:
+        with self._lock:
+            self.pool = pool
+            stats = self._endpoint(current_endpoint.get())
+            stats.checkouts += 1
+            stats.wait_time.observe(seconds)
+            stats.wait_histogram.observe(seconds)
+            self.max_checked_out = max(self.max_checked_out, pool.checkedout())
+            self.max_overflow_used = max(self.max_overflow_used, pool.overflow())
+
+    def observe_timeout(self, pool: Pool) -> None:
+        with self._lock:
+            self.pool = pool
+            self._endpoint(current_endpoint.get()).timeouts += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {
+                "max_checked_out": self.max_checked_out,
+                "max_overflow_used": self.max_overflow_used,
+                "endpoints": {
+                    endpoint: endpoint_stats.stats()
+                    for endpoint, endpoint_stats in self._endpoints.items()
+                },
+            }
+            if self.pool is not None:
+                stats.update(
+                    size=self.pool.size(),
+                    checked_out=self.pool.checkedout(),
+                    # Negative while the pool isn't full yet.
+                    overflow=max(0, self.pool.overflow()),
+                )
+            return stats
+
+
+def instrumented_pool(pool_class: Type[Pool], metrics: PoolMetrics) -> Type[Pool]:
+    """Subclass of a queue pool class that times checkouts into `metrics`."""
+
+    class InstrumentedPool(pool_class):
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                connection = super()._do_get()
+            except PoolTimeoutError:
+                metrics.observe_timeout(self)
+                raise
+            metrics.observe_checkout(self, time.perf_counter() - start)
+            return connection
+
+    InstrumentedPool.__name__ = f"Instrumented{pool_class.__name__}"
+    return InstrumentedPool
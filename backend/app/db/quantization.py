@@ -0,0 +1,129 @@
+"""Backfill and benchmark of the quantized vector column.
+
+Run from the backend folder with VECTOR_QUANTIZATION set, once the quantized
+column was added by `python -m app.db.migrate`:
+
+    python -m app.db.quantization backfill
+    python -m app.db.quantization benchmark --queries 100 --top-k 3
+"""
+import json
+import time
+import asyncio
+import argparse
+
+import sqlalchemy
+
+from app.db.pg_vector import (
+    VECTOR_QUANTIZATION,
+    VECTOR_RERANK_FACTOR,
+    CustomPGVectorStore,
+    get_vector_store_singleton,
+)
+
+
+async def storage_stats(vector_store: CustomPGVectorStore) -> dict:
+    """Average bytes per row of the full precision and quantized vectors."""
+    async with vector_store._async_session() as session:
+        row = (await session.execute(sqlalchemy.text(
+            "SELECT count(*) AS rows, avg(pg_column_size(embedding)) AS full_bytes, "
+            "avg(pg_column_size(embedding_q)) AS quantized_bytes, "
+            "count(embedding_q) AS quantized_rows "
+            f"FROM {vector_store.data_table_name}"
+        ))).one()
+    full_bytes = float(row.full_bytes or 0)
+    quantized_bytes = float(row.quantized_bytes or 0)
+    return {
+        "rows": row.rows,
+        "quantized_rows": row.quantized_rows,
+        "full_bytes_per_row": full_bytes,
+        "quantized_bytes_per_row": quantized_bytes,
+        "saved_ratio": 1 - quantized_bytes / full_bytes if full_bytes else 0.0,
+    }
+
+
+async def recall_stats(
+    vector_store: CustomPGVectorStore,
+    queries: int = 100,
+    top_k: int = 3,
+) -> dict:
+    """Recall@k of the quantized search, with and without the rerank.
+
+    Embeddings of random rows are used as queries; the exact top k by full
+    precision cosine distance is the ground truth.
+    """
+    table = vector_store._table_class
+    async with vector_store._async_session() as session:
+        samples = (await session.execute(
+            sqlalchemy.select(table.embedding)
+            .where(table.embedding_q.is_not(None))
+            .order_by(sqlalchemy.func.random())
+            .limit(queries)
+        )).scalars().all()
+
+        first_pass_hits = reranked_hits = 0
+        exact_time = reranked_time = 0.0
+        for embedding in samples:
+            embedding = [float(x) for x in embedding]
+            start = time.perf_counter()
+            exact = set((await session.execute(
+                sqlalchemy.select(table.id)
+                .order_by(table.embedding.cosine_distance(embedding))
+                .limit(top_k)
+            )).scalars().all())
+            exact_time += time.perf_counter() - start
+
+            first_pass = set((await session.execute(
+                sqlalchemy.select(table.id)
+                .order_by(vector_store._quantized_distance(embedding))
+                .limit(top_k)
+            )).scalars().all())
+
+            start = time.perf_counter()
+            reranked = set((await session.execute(
+                vector_store._build_query(embedding, top_k)
+            )).scalars().all())
+            reranked_time += time.perf_counter() - start
+
+            first_pass_hits += len(exact & first_pass)
+            reranked_hits += len(exact & reranked)
+
+    total = max(len(samples) * top_k, 1)
+    return {
+        "queries": len(samples),
+        "top_k": top_k,
+        "rerank_factor": VECTOR_RERANK_FACTOR,
+        "first_pass_recall": first_pass_hits / total,
+        "reranked_recall": reranked_hits / total,
+        "exact_latency_ms": 1000 * exact_time / max(len(samples), 1),
+        "reranked_latency_ms": 1000 * reranked_time / max(len(samples), 1),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["backfill", "benchmark"])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=3)
+    args = parser.parse_args()
+
+    if VECTOR_QUANTIZATION == "none":
+        raise SystemExit("Set VECTOR_QUANTIZATION to halfvec or binary first.")
+    vector_store = await get_vector_store_singleton()
+    await vector_store.run_setup()
+
+    if args.command == "backfill":
+        updated = await vector_store.backfill_quantized(args.batch_size)
+        print(f"Quantized {updated} rows.")
+    else:
+        report = {
+            "quantization": VECTOR_QUANTIZATION,
+            "storage": await storage_stats(vector_store),
+            "recall": await recall_stats(vector_store, args.queries, args.top_k),
+        }
+        print(json.dumps(report, indent=2))
+    await vector_store.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,31 +1,81 @@
 import os
 from dotenv import find_dotenv, load_dotenv
-from sqlmodel import create_engine
+from sqlmodel import SQLModel, create_engine
+from sqlalchemy import text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 
+from app.db.pool import PoolMetrics, instrumented_pool
+
 load_dotenv(find_dotenv())
 
-async_engine = create_async_engine(
-    os.environ["POSTGRE_ASYNC_ENGINE"],
-    pool_pre_ping=True,
-    pool_size=4,  # Number of connections to keep open in the pool
-    max_overflow=4,  # Number of connections that can be opened beyond the pool_size
-    pool_recycle=3600,  # Recycle connections after 1 hour
-    # Raise an exception after 2 minutes if no connection is available from the pool
-    pool_timeout=120,
-)
+# Pools of the metadata engines (documents, users).
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 4))
+# Pools of the vector store engines, so vector search can't starve the CRUD queries.
+VECTOR_DB_POOL_SIZE = int(os.getenv("VECTOR_DB_POOL_SIZE", 4))
+VECTOR_DB_MAX_OVERFLOW = int(os.getenv("VECTOR_DB_MAX_OVERFLOW", 4))
+# Raise an exception if no connection is available from the pool after that long.
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+
+pool_metrics = {
+    name: PoolMetrics(name)
+    for name in ["async", "sync", "vector_async", "vector_sync"]
+}
+
+
+def _create_async_engine(name: str, pool_size: int, max_overflow: int):
+    return create_async_engine(
+        os.environ["POSTGRE_ASYNC_ENGINE"],
+        poolclass=instrumented_pool(AsyncAdaptedQueuePool, pool_metrics[name]),
+        pool_pre_ping=True,
+        pool_size=pool_size,  # Number of connections to keep open in the pool
+        max_overflow=max_overflow,  # Number of connections that can be opened beyond the pool_size
+        pool_recycle=3600,  # Recycle connections after 1 hour
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+
+
+def _create_engine(name: str, pool_size: int, max_overflow: int):
+    return create_engine(
+        os.environ["POSTGRE_ENGINE"],
+        poolclass=instrumented_pool(QueuePool, pool_metrics[name]),
+        pool_pre_ping=True,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_recycle=3600,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+
+
+async_engine = _create_async_engine("async", DB_POOL_SIZE, DB_MAX_OVERFLOW)
 AsyncSessionLocal = async_sessionmaker(
     autocommit=False, autoflush=False, bind=async_engine)
 
-engine = create_engine(
-    os.environ["POSTGRE_ENGINE"],
-    pool_pre_ping=True,
-    pool_size=4,
-    max_overflow=4,
-    pool_recycle=3600,
-    pool_timeout=120,
-)
-
+engine = _create_engine("sync", DB_POOL_SIZE, DB_MAX_OVERFLOW)
 SessionLocal = sessionmaker(
     autocommit=False, autoflush=False, bind=engine)
+
+vector_async_engine = _create_async_engine(
+    "vector_async", VECTOR_DB_POOL_SIZE, VECTOR_DB_MAX_OVERFLOW)
+VectorAsyncSessionLocal = async_sessionmaker(
+    autocommit=False, autoflush=False, bind=vector_async_engine)
+
+vector_engine = _create_engine(
+    "vector_sync", VECTOR_DB_POOL_SIZE, VECTOR_DB_MAX_OVERFLOW)
+VectorSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, bind=vector_engine)
+
+
+def pool_stats() -> dict:
+    return {name: metrics.stats() for name, metrics in pool_metrics.items()}
+
+
+async def create_metadata_tables() -> None:
+    """Create the non-vector tables, whichever vector store backend is used."""
+    async with async_engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+        # Columns added after the tables were first created.
+        await conn.execute(text(
+            "ALTER TABLE documents ADD COLUMN IF NOT EXISTS answer VARCHAR"))
@@ -1,2 +1,5 @@
 from .base import Base
 from .documents import Document
+from .documents_version import DocumentsVersion
+from .embedding_cache import EmbeddingCacheEntry
+from .ingestion_job import IngestionJobState
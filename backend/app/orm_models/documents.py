@@ -13,4 +13,5 @@ class Document(SQLModel, table=True):
     is_active: bool
     description: str
     question: str
+    answer: Optional[str] = None  # Answer to `question`, generated after ingestion
     user_id: str
@@ -0,0 +1,10 @@
+from sqlmodel import Field, SQLModel
+
+
+class DocumentsVersion(SQLModel, table=True):
+    """Bumped whenever the documents of a user change, by any worker."""
+
+    __tablename__ = "documents_versions"
+
+    user_id: str = Field(primary_key=True)
+    version: int = 0
@@ -0,0 +1,11 @@
+from sqlalchemy import Column, LargeBinary
+from sqlmodel import Field, SQLModel
+
+
+class EmbeddingCacheEntry(SQLModel, table=True):
+    __tablename__ = "embedding_cache"
+
+    key: str = Field(primary_key=True)  # Hash of the model name and chunk text
+    model_name: str
+    # float32 values, as the query embedding cache stores them.
+    embedding: bytes = Field(sa_column=Column(LargeBinary, nullable=False))
@@ -0,0 +1,14 @@
+from sqlalchemy import JSON, Column
+from sqlmodel import Field, SQLModel
+
+
+class IngestionJobState(SQLModel, table=True):
+    """Last saved status of an ingestion job, so every worker can report it."""
+
+    __tablename__ = "ingestion_jobs"
+
+    id: str = Field(primary_key=True)
+    user_id: str = Field(index=True)
+    # What `IngestionJob.to_dict` returned when the job was last saved.
+    state: dict = Field(sa_column=Column(JSON, nullable=False))
+    updated_at: float = Field(index=True)  # Unix time
@@ -34,3 +34,27 @@ MULTI_SELECT_PROMPT_TEMPLATE = (
 SELECTOR_PROMPT = PromptTemplate(
     template=SINGLE_SELECTOR_PROMPT_TEMPLATE, prompt_type=PromptType.SINGLE_SELECT
 )
+
+VECTOR_TOOL_DESCRIPTION = "Useful for retrieving specific context from uploaded documents."
+SUMMARY_TOOL_DESCRIPTION = (
+    "Useful to retrieve all context from uploaded documents and summary tasks. "
+    "Don't use if the question only requires more specific context."
+)
+
+# Typical recruiter questions for each tool, used by the embedding router.
+ROUTER_EXAMPLE_QUERIES = {
+    VECTOR_TOOL_DESCRIPTION: [
+        "What programming languages do you know?",
+        "How many years of experience do you have with Python?",
+        "Where did you study?",
+        "What was your role at your last company?",
+        "Do you have any certifications?",
+    ],
+    SUMMARY_TOOL_DESCRIPTION: [
+        "Summarize your resume.",
+        "Give me an overview of your background.",
+        "Tell me about yourself.",
+        "What are your main strengths overall?",
+        "Describe your whole career so far.",
+    ],
+}
@@ -3,3 +3,16 @@ LLM_SYSTEM_MESSAGE = (
     "Use the following pieces of retrieved context to answer the question. "
     "If you don't know the answer, just say that you don't know. Keep the answer concise."
 )
+
+CONVERSATION_SUMMARY_PROMPT = (
+    "### System:\n"
+    "You are a helpful assistant. Summarize the conversation between a recruiter (user) "
+    "and an assistant answering questions about a candidate's documents. "
+    "Extend the existing summary with the new messages. Keep every fact and name that "
+    "was asked about or answered, drop pleasantries. Answer with the summary only.\n"
+    "### User:\n"
+    "Existing summary: {summary}\n"
+    "New messages:\n"
+    "{conversation}\n"
+    "### Assistant:\n"
+)
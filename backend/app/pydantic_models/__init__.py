@@ -1,2 +1,2 @@
-from .documents import Document
+from .documents import Document, DocumentActivation
 from .chat import ChatData, Message
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel
 from llama_index.llms.types import MessageRole
 
@@ -9,4 +9,7 @@ class Message(BaseModel):
 
 
 class ChatData(BaseModel):
+    # With a known session_id, only the new user message needs to be sent. An expired
+    # session is answered with 409: send the whole conversation again, without session_id.
     messages: List[Message]
+    session_id: Optional[str] = None
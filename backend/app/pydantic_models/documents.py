@@ -1,3 +1,5 @@
+import uuid as uuid_pkg
+from typing import List
 from pydantic import BaseModel
 
 
@@ -8,3 +10,8 @@ class Document(BaseModel):
     description: str
     question: str
     user_id: str
+
+
+class DocumentActivation(BaseModel):
+    document_ids: List[uuid_pkg.UUID]
+    is_active: bool
@@ -1,6 +1,12 @@
+import os
+import json
+import time
+import asyncio
 import logging
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from typing import Annotated
+from typing import Annotated, Callable, Dict, List, Optional, Sequence, Tuple
 from fastapi import Depends
 from llama_index import (
     StorageContext,
@@ -8,32 +14,259 @@ from llama_index import (
     VectorStoreIndex,
     SummaryIndex,
 )
+from llama_index.schema import BaseNode
+from llama_index.storage.docstore.utils import doc_to_json, json_to_doc
+from llama_index.vector_stores.types import BasePydanticVectorStore
 
 from app.db.pg_vector import get_vector_store_singleton
 from app.utils.fs import get_s3_fs
 from app.utils.auth import decode_access_token
-from app.db.crud import is_user_existed
+from app.db.crud import get_documents, is_user_existed
 
 DATA_DIR = Path("./data")  # directory containing the documents to index
 logger = logging.getLogger("uvicorn")
 
+INDEX_CACHE_MAX_BYTES = int(
+    os.getenv("INDEX_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+INDEX_CACHE_TTL_SECONDS = float(os.getenv("INDEX_CACHE_TTL_SECONDS", 30 * 60))
+# Rough per-node overhead (python objects, relationships, metadata) on top of the text.
+NODE_OVERHEAD_BYTES = 2048
+# An embedding is a list of Python floats: an 8 byte pointer and a 24 byte object each.
+EMBEDDING_FLOAT_BYTES = 32
+# Uploads append a delta file next to the user's persisted indices, which are
+# persisted in full again once that many deltas have piled up.
+INDEX_DELTA_COMPACT_THRESHOLD = int(os.getenv("INDEX_DELTA_COMPACT_THRESHOLD", 8))
+
+
+def _estimate_index_size(indices: dict) -> int:
+    """Estimate the memory used by a pair of loaded indices.
+
+    Both indices share the same docstore, so the nodes are only counted once.
+    The docstore keeps the embedding of every uploaded node as well.
+    """
+    docstore = indices["summary"].docstore
+    return sum(
+        len(node.get_content())
+        + len(node.embedding or ()) * EMBEDDING_FLOAT_BYTES
+        + NODE_OVERHEAD_BYTES
+        for node in docstore.docs.values()
+    )
+
+
+class IndexCache:
+    """Process-wide LRU cache of the loaded summary/vector indices of each user.
+
+    Entries are evicted when they are older than `ttl` seconds or when the total
+    estimated size goes above `max_bytes`. Uploads and deletions must call
+    `invalidate` so the next chat turn reloads the indices from storage. Whatever
+    holds on to the indices can register with `on_evict` to let go of them too.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._size = 0
+        # Bumped on every invalidation so in-flight loads don't store stale indices.
+        self._generations: Dict[str, int] = {}
+        self._load_locks: Dict[str, asyncio.Lock] = {}
+        self._eviction_callbacks: List[Callable[[str], None]] = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def generation(self, user_id: str) -> int:
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def load_lock(self, user_id: str) -> asyncio.Lock:
+        return self._load_locks.setdefault(user_id, asyncio.Lock())
+
+    def on_evict(self, callback: Callable[[str], None]) -> None:
+        """Call `callback(user_id)` whenever the indices of a user leave the cache."""
+        self._eviction_callbacks.append(callback)
+
+    def get(self, user_id: str, record: bool = True) -> Optional[dict]:
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.monotonic() - entry[2] > self.ttl:
+                self._pop(user_id)
+                self.evictions += 1
+                evicted.append(user_id)
+                entry = None
+            if entry is None:
+                self.misses += record
+            else:
+                self._entries.move_to_end(user_id)
+                self.hits += record
+        self._evicted(evicted)
+        return entry[0] if entry is not None else None
+
+    def put(self, user_id: str, indices: dict, generation: int) -> None:
+        size = _estimate_index_size(indices)
+        with self._lock:
+            if self._generations.get(user_id, 0) != generation:
+                # The user's documents changed while we were loading.
+                return
+            if size > self.max_bytes:
+                logger.warning(
+                    f"Indices of {user_id} ({size} bytes) exceed the cache budget.")
+                return
+            self._pop(user_id)
+            self._entries[user_id] = (indices, size, time.monotonic())
+            self._size += size
+            evicted = []
+            while self._size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._pop(oldest)
+                self.evictions += 1
+                evicted.append(oldest)
+        self._evicted(evicted)
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            if self._pop(user_id):
+                self.invalidations += 1
+        self._evicted([user_id])
+
+    def _evicted(self, user_ids: List[str]) -> None:
+        # Outside of the cache lock: the callbacks take their own locks.
+        for user_id in user_ids:
+            lock = self._load_locks.get(user_id)
+            if lock is not None and not lock.locked():
+                del self._load_locks[user_id]
+            for callback in self._eviction_callbacks:
+                callback(user_id)
+
+    def _pop(self, user_id: str) -> bool:
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return False
+        self._size -= entry[1]
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "load_locks": len(self._load_locks),
+            }
+
+
+index_cache = IndexCache(INDEX_CACHE_MAX_BYTES, INDEX_CACHE_TTL_SECONDS)
+
+
+def user_persist_dir(user_id: str) -> str:
+    return f"talking-resume/{user_id}"
+
+
+def _delta_paths(fs, user_id: str) -> List[str]:
+    delta_dir = f"{user_persist_dir(user_id)}/deltas"
+    if not fs.exists(delta_dir):
+        return []
+    # Delta names start with their creation time.
+    return sorted(fs.ls(delta_dir, detail=False))
+
+
+def load_user_indices(
+    vector_store: BasePydanticVectorStore,
+    user_id: str,
+) -> Tuple[dict, List[str]]:
+    """Load the persisted indices of a user and replay the deltas appended since.
+
+    Returns the summary and vector indices, and the paths of the replayed deltas.
+    """
+    fs = get_s3_fs()
+    storage_context = StorageContext.from_defaults(
+        vector_store=vector_store,
+        persist_dir=user_persist_dir(user_id),
+        fs=fs)
+    indices = {}
+    for prefix in ["summary", "vector"]:
+        indices[prefix] = load_index_from_storage(
+            storage_context, index_id=f'{prefix}_{user_id}')
+
+    delta_paths = _delta_paths(fs, user_id)
+    for path in delta_paths:
+        with fs.open(path, "r") as f:
+            delta = json.load(f)
+        summary_index = indices["summary"]
+        # A delta is replayed again if a compaction stopped before deleting it.
+        known = set(summary_index.index_struct.nodes)
+        nodes = [json_to_doc(node) for node in delta["nodes"]]
+        # The vector store already has these nodes, only the summary index needs them.
+        summary_index.insert_nodes(
+            [node for node in nodes if node.node_id not in known])
+        for doc_id, doc_hash in delta["doc_hashes"].items():
+            storage_context.docstore.set_document_hash(doc_id, doc_hash)
+    return indices, delta_paths
+
+
+def write_index_delta(
+    user_id: str,
+    name: str,
+    nodes: Sequence[BaseNode],
+    doc_hashes: Dict[str, str],
+) -> None:
+    """Persist the nodes added to a user's indices without rewriting the whole store."""
+    fs = get_s3_fs()
+    with fs.open(f"{user_persist_dir(user_id)}/deltas/{name}.json", "w") as f:
+        json.dump({
+            "nodes": [doc_to_json(node) for node in nodes],
+            "doc_hashes": doc_hashes,
+        }, f)
+
+
+def compact_user_indices(
+    storage_context: StorageContext,
+    user_id: str,
+    delta_paths: List[str],
+) -> None:
+    """Persist the indices in full and drop the deltas they now include."""
+    fs = get_s3_fs()
+    storage_context.persist(persist_dir=user_persist_dir(user_id), fs=fs)
+    if delta_paths:
+        fs.rm(delta_paths)
+
 
 async def get_index(
     token_payload: Annotated[dict, Depends(decode_access_token)]
 ) -> Annotated[dict, {"summary": SummaryIndex, "vector": VectorStoreIndex}]:
-    vector_store = await get_vector_store_singleton()
     user_id = token_payload["user_id"]
-    s3 = get_s3_fs()
-
-    if await is_user_existed(user_id):
-        logger.info(
-            f"{user_id} already in storage. Loading it into storage context.")
-        storage_context = StorageContext.from_defaults(
-            vector_store=vector_store,
-            persist_dir=f"talking-resume/{user_id}",
-            fs=s3)
-        indices = {}
-        for prefix in ["summary", "vector"]:
-            indices[prefix] = load_index_from_storage(
-                storage_context, index_id=f'{prefix}_{user_id}')
+
+    indices = index_cache.get(user_id)
+    if indices is not None:
         return indices
+
+    # Only one coroutine loads a given user's indices, the others wait for the cache.
+    async with index_cache.load_lock(user_id):
+        indices = index_cache.get(user_id, record=False)
+        if indices is not None:
+            return indices
+
+        generation = index_cache.generation(user_id)
+        if await is_user_existed(user_id):
+            logger.info(
+                f"{user_id} already in storage. Loading it into storage context.")
+            vector_store = await get_vector_store_singleton()
+            indices, _ = await asyncio.to_thread(
+                load_user_indices, vector_store, user_id)
+            # The summary index can't filter in SQL, its retriever drops these instead.
+            indices["inactive_doc_uuids"] = frozenset(
+                str(document.id) for document in await get_documents(user_id)
+                if not document.is_active)
+            # Lets callers tell whether the documents changed since the load.
+            indices["generation"] = generation
+            index_cache.put(user_id, indices, generation)
+            return indices
@@ -0,0 +1,62 @@
+import bisect
+import threading
+from collections import deque
+from typing import Sequence
+
+
+class LatencyStats:
+    """Keep count/sum/max of observed durations plus percentiles over a recent window."""
+
+    def __init__(self, window: int = 1000) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self._recent.append(seconds)
+
+    def _percentile(self, ordered: list, q: float) -> float:
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self) -> dict:
+        with self._lock:
+            ordered = sorted(self._recent)
+            return {
+                "count": self.count,
+                "mean": self.total / self.count if self.count else 0.0,
+                "max": self.max,
+                "p50": self._percentile(ordered, 0.50),
+                "p95": self._percentile(ordered, 0.95),
+                "p99": self._percentile(ordered, 0.99),
+            }
+
+
+class Histogram:
+    """Count observations per bucket, buckets being given by their upper bounds."""
+
+    def __init__(
+        self,
+        bounds: Sequence[float] = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30),
+    ) -> None:
+        self.bounds = list(bounds)
+        self._counts = [0] * (len(self.bounds) + 1)
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self._counts[bisect.bisect_left(self.bounds, value)] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            buckets = {f"le_{bound:g}": count for bound,
+                       count in zip(self.bounds, self._counts)}
+            buckets["inf"] = self._counts[-1]
+            return buckets
@@ -1,15 +1,52 @@
+import os
+import shutil
 import fsspec
+import tempfile
+import threading
+import multiprocessing
 
 from pathlib import Path
-from typing import Dict, List, Optional, Union
-from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 from llama_index.readers.base import BaseReader
 from llama_index.schema import Document
 
+# PDFs with at least that many pages are extracted in parallel worker processes.
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", 32))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", 16))
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", min(4, os.cpu_count() or 1)))
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_pdf_executor() -> ProcessPoolExecutor:
+    """Process pool shared by all the PDF extractions."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Forking a process running torch and llama.cpp threads isn't safe.
+            _executor = ProcessPoolExecutor(
+                max_workers=PDF_EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def extract_pages(path: str, start: int, stop: int) -> List[Tuple[int, str]]:
+    """Text of the pages `start` to `stop` of a PDF file, run in a worker process."""
+    import fitz
+
+    with fitz.open(path) as doc:
+        return [(number, doc[number].get_text()) for number in range(start, stop)]
+
 
 class PyMuPDFReader(BaseReader):
-    """Read PDF files using PyMuPDF library."""
+    """Read PDF files using PyMuPDF library.
+
+    Large PDFs are extracted by ranges of pages in a process pool, and `iter_load`
+    yields the pages in order as soon as their range is extracted.
+    """
 
     def load_data(
         self,
@@ -42,49 +79,75 @@ class PyMuPDFReader(BaseReader):
         Returns:
             List[Document]: list of documents.
         """
+        return list(self.iter_load(file_path, metadata=metadata, extra_info=extra_info, fs=fs))
+
+    def iter_load(
+        self,
+        file_path: Union[Path, str],
+        metadata: bool = True,
+        extra_info: Optional[Dict] = None,
+        fs: Optional[fsspec.AbstractFileSystem] = None
+    ) -> Iterator[Document]:
+        """Same as `load`, but yields the documents of the pages as they are extracted."""
         import fitz
 
         # check if file_path is a string or Path
         if not isinstance(file_path, str) and not isinstance(file_path, Path):
             raise TypeError("file_path must be a string or Path.")
 
-        # open PDF file
-        with fs.open(file_path, "rb") as fp:
-            doc = fitz.open("pdf", stream=BytesIO(fp.read()))
-
         # if extra_info is not None, check if it is a dictionary
         if extra_info:
             if not isinstance(extra_info, dict):
                 raise TypeError("extra_info must be a dictionary.")
-
-        # if metadata is True, add metadata to each document
-        if metadata:
-            if not extra_info:
-                extra_info = {}
-            extra_info["total_pages"] = len(doc)
-            extra_info["file_path"] = file_path
-
-            # return list of documents
-            return [
-                Document(
-                    text=page.get_text().encode("utf-8"),
-                    extra_info=dict(
-                        extra_info,
-                        **{
-                            "source": f"{page.number+1}",
-                        },
-                    ),
-                )
-                for page in doc
-            ]
-
-        else:
-            return [
-                Document(
-                    text=page.get_text().encode("utf-8"), extra_info=extra_info or {}
-                )
-                for page in doc
+        extra_info = dict(extra_info or {})
+
+        fs = fs or fsspec.filesystem("file")
+        # Stream the file to disk, so worker processes can open it by path.
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+            with fs.open(file_path, "rb") as fp:
+                shutil.copyfileobj(fp, tmp)
+            tmp.flush()
+
+            with fitz.open(tmp.name) as doc:
+                total_pages = len(doc)
+                if metadata:
+                    extra_info["total_pages"] = total_pages
+                    extra_info["file_path"] = file_path
+
+                if total_pages < PDF_PARALLEL_MIN_PAGES:
+                    for page in doc:
+                        yield self._page_document(
+                            page.number, page.get_text(), metadata, extra_info)
+                    return
+
+            executor = get_pdf_executor()
+            futures = [
+                executor.submit(
+                    extract_pages, tmp.name, start, min(start + PDF_PAGES_PER_TASK, total_pages))
+                for start in range(0, total_pages, PDF_PAGES_PER_TASK)
             ]
+            try:
+                for future in futures:
+                    for number, text in future.result():
+                        yield self._page_document(number, text, metadata, extra_info)
+            finally:
+                # The temporary file goes away, don't let queued ranges open it.
+                for future in futures:
+                    future.cancel()
+
+    def _page_document(
+        self,
+        number: int,
+        text: str,
+        metadata: bool,
+        extra_info: Dict,
+    ) -> Document:
+        if metadata:
+            return Document(
+                text=text,
+                extra_info=dict(extra_info, source=f"{number + 1}"),
+            )
+        return Document(text=text, extra_info=dict(extra_info))
 
 
 class PDFReader(BaseReader):
@@ -0,0 +1,114 @@
+import os
+import re
+import queue
+import asyncio
+import threading
+import contextvars
+import concurrent.futures
+from typing import AsyncGenerator, Callable, Iterator, Optional, TypeVar
+
+from llama_index.chat_engine.types import StreamingAgentChatResponse
+
+T = TypeVar("T")
+
+# Max number of tokens buffered between the generating thread and the client.
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", 32))
+
+_DONE = object()
+
+
+class _Error:
+    def __init__(self, exc: BaseException) -> None:
+        self.exc = exc
+
+
+def response_tokens(response: StreamingAgentChatResponse) -> Iterator[str]:
+    """Yield the tokens of a streaming chat response.
+
+    Same as `response.response_gen` but blocks on the queue instead of spinning,
+    which would otherwise burn a CPU core next to the LLM for the whole generation.
+    """
+    while not response._is_done or not response._queue.empty():
+        try:
+            token = response._queue.get(timeout=0.05)
+        except queue.Empty:
+            continue
+        response._unformatted_response += token
+        yield token
+    response.response = response._unformatted_response.strip()
+
+
+async def iterate_in_thread(
+    make_iterator: Callable[[], Iterator[T]],
+    maxsize: int = STREAM_QUEUE_SIZE,
+    on_done: Optional[Callable[[], None]] = None,
+) -> AsyncGenerator[T, None]:
+    """Run a blocking iterator on a worker thread and consume it asynchronously.
+
+    Items go through a bounded asyncio queue: when the consumer is slower than the
+    producer, the worker thread blocks until there is room again (backpressure).
+    When the consumer stops early (e.g. the client disconnected), the worker is told
+    to stop at its next item and closes the iterator.
+
+    Args:
+        make_iterator (Callable[[], Iterator[T]]): called on the worker thread, so any
+            blocking setup (retrieval, prompt building) also stays off the event loop.
+        maxsize (int, optional): size of the queue. Defaults to STREAM_QUEUE_SIZE.
+        on_done (Optional[Callable[[], None]], optional): called on the event loop once
+            the worker thread returned, which may be after the consumer stopped.
+    """
+    loop = asyncio.get_running_loop()
+    items: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+
+    def put(item) -> None:
+        future = asyncio.run_coroutine_threadsafe(items.put(item), loop)
+        while True:
+            try:
+                return future.result(timeout=0.05)
+            except concurrent.futures.TimeoutError:
+                # Nobody will make room in the queue anymore.
+                if stopped.is_set():
+                    future.cancel()
+                    return
+
+    def produce() -> None:
+        iterator = None
+        try:
+            iterator = make_iterator()
+            for item in iterator:
+                if stopped.is_set():
+                    break
+                put(item)
+        except BaseException as e:
+            put(_Error(e))
+        else:
+            put(_DONE)
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    # Keep the request's context variables (e.g. the endpoint tag of DB metrics).
+    producer = loop.run_in_executor(None, contextvars.copy_context().run, produce)
+    if on_done is not None:
+        producer.add_done_callback(lambda _: on_done())
+    try:
+        while True:
+            item = await items.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Error):
+                raise item.exc
+            yield item
+    finally:
+        # No await here: when the request is cancelled, it would be cancelled too.
+        stopped.set()
+
+
+async def replay_text(text: str) -> AsyncGenerator[str, None]:
+    """Stream an already generated answer word by word, like the LLM would."""
+    for token in re.findall(r"\s*\S+", text):
+        yield token
+        # Let other requests run between tokens.
+        await asyncio.sleep(0)
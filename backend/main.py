@@ -2,7 +2,6 @@ import uvicorn
 import os
 import logging
 import llama_index
-from typing import cast
 from pathlib import Path
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import FastAPI
@@ -10,9 +9,11 @@ from dotenv import load_dotenv
 from contextlib import asynccontextmanager
 from firebase_admin import credentials, initialize_app
 
-from app.db.pg_vector import CustomPGVectorStore, get_vector_store_singleton
+from app.db.pg_vector import get_vector_store_singleton
+from app.db.session import create_metadata_tables
 from app.db.wait_for_db import check_database_connection
 from app.api.api import api_router
+from app.core.ingest_jobs import ingestion_queue
 from app.setup.service_context import initialize_llamaindex_service_context
 from app.setup.tracing import initialize_tracing_service
 
@@ -29,9 +30,9 @@ async def lifespan(app: FastAPI):
     # First wait for DB to be connectable.
     await check_database_connection()
 
-    # Initialize pg vector store singleton.
+    # Create the documents tables, then initialize the vector store singleton.
+    await create_metadata_tables()
     vector_store = await get_vector_store_singleton()
-    vector_store = cast(CustomPGVectorStore, vector_store)
     await vector_store.run_setup()
 
     # Initialize firebase admin for authentication.
@@ -45,9 +46,13 @@ async def lifespan(app: FastAPI):
     # Set global ServiceContext for LlamaIndex.
     initialize_llamaindex_service_context(environment)
 
+    # Workers of the document ingestion jobs.
+    ingestion_queue.start()
+
     yield
 
     # This section is run on app shutdown.
+    await ingestion_queue.stop()
     await vector_store.close()
 
 app = FastAPI(lifespan=lifespan)
@@ -65,6 +70,7 @@ if environment == "dev":
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Session-Id"],
     )
 
 app.include_router(api_router, prefix="/api")
@@ -0,0 +1,47 @@
+import time
+
+from app.core.answer_cache import SemanticAnswerCache
+
+
+def test_similar_question_gets_the_cached_answer():
+    cache = SemanticAnswerCache(threshold=0.95, max_entries_per_user=8, ttl=60)
+    cache.store("a", "Where did you work?", "At Acme.", [1.0, 0.0])
+    cache.store("a", "What did you study?", "Physics.", [0.0, 1.0])
+
+    assert cache.lookup("a", [2.0, 0.1]).answer == "At Acme."
+    assert cache.lookup("a", [1.0, 1.0]) is None
+    # Answers come from the user's own documents.
+    assert cache.lookup("b", [1.0, 0.0]) is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_oldest_entries_are_dropped():
+    cache = SemanticAnswerCache(threshold=0.95, max_entries_per_user=1, ttl=60)
+    cache.store("a", "Where did you work?", "At Acme.", [1.0, 0.0])
+    cache.store("a", "What did you study?", "Physics.", [0.0, 1.0])
+    assert cache.lookup("a", [1.0, 0.0]) is None
+    assert cache.lookup("a", [0.0, 1.0]).answer == "Physics."
+
+
+def test_expired_entries_are_not_served():
+    cache = SemanticAnswerCache(threshold=0.95, max_entries_per_user=8, ttl=0.05)
+    cache.store("a", "Where did you work?", "At Acme.", [1.0, 0.0])
+    time.sleep(0.1)
+    assert cache.lookup("a", [1.0, 0.0]) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_answers_from_another_documents_version_are_dropped():
+    cache = SemanticAnswerCache(threshold=0.95, max_entries_per_user=8, ttl=60)
+    cache.store("a", "Where did you work?", "At Acme.", [1.0, 0.0], version=1)
+    assert cache.lookup("a", [1.0, 0.0], version=1).answer == "At Acme."
+
+    # Another worker changed the documents: nothing was invalidated here.
+    assert cache.lookup("a", [1.0, 0.0], version=2) is None
+    assert cache.stats()["stale"] == 1
+    assert cache.lookup("a", [1.0, 0.0], version=1) is None
+
+    cache.store("a", "Where did you work?", "At Initech.", [1.0, 0.0], version=2)
+    assert cache.lookup("a", [1.0, 0.0], version=2).answer == "At Initech."
+    cache.invalidate("a")
+    assert cache.lookup("a", [1.0, 0.0], version=2) is None
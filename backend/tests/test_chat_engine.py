@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+pytest.importorskip("llama_index")
+
+import llama_index
+from llama_index import MockEmbedding, ServiceContext, StorageContext, VectorStoreIndex
+from llama_index.llms.types import ChatMessage, ChatResponse, MessageRole
+from llama_index.memory import ChatMemoryBuffer
+from llama_index.core import BaseRetriever
+from llama_index.schema import NodeWithScore, TextNode
+
+from app.core.chat_engine import (
+    ActiveDocumentsRetriever,
+    ChatEngineFactory,
+    StoppableChatResponse,
+)
+from app.utils.stream import response_tokens
+
+
+def test_stop_closes_the_llm_stream():
+    closed = threading.Event()
+    resume = threading.Event()
+
+    def llm_stream():
+        text = ""
+        try:
+            for n in range(1000):
+                text += f" t{n}"
+                yield ChatResponse(
+                    message=ChatMessage(role=MessageRole.ASSISTANT, content=text),
+                    delta=f" t{n}")
+                if n == 1:
+                    resume.wait(5)
+        finally:
+            closed.set()
+
+    memory = ChatMemoryBuffer.from_defaults()
+    response = StoppableChatResponse(chat_stream=llm_stream())
+    writer = threading.Thread(target=response.write_response_to_history, args=(memory,))
+    writer.start()
+
+    tokens = response_tokens(response)
+    assert next(tokens) == " t0"
+    response.stop()
+    resume.set()
+
+    assert response.finished.wait(5)
+    writer.join(5)
+    assert closed.is_set()
+    assert list(tokens) == [" t1"]
+    # Only the part that was generated goes to the history.
+    assert memory.get_all()[-1].content == "t0 t1"
+
+
+def test_uncached_engines_leave_the_components_alone(monkeypatch):
+    monkeypatch.setattr(
+        llama_index, "global_service_context",
+        ServiceContext.from_defaults(llm=None, embed_model=MockEmbedding(embed_dim=2)))
+    cached = {"vector": VectorStoreIndex(nodes=[], storage_context=StorageContext.from_defaults())}
+    job = {"vector": VectorStoreIndex(nodes=[], storage_context=StorageContext.from_defaults())}
+    factory = ChatEngineFactory()
+
+    factory.build("user", cached)
+    factory.build("user", job, cache=False)
+    assert factory.get_components("user", cached).vector_index is cached["vector"]
+    assert factory.stats()["builds"] == 1 and factory.stats()["hits"] == 1
+
+
+def test_nodes_of_inactive_documents_are_dropped():
+    nodes = [
+        NodeWithScore(node=TextNode(text=doc_uuid, metadata={"doc_uuid": doc_uuid}))
+        for doc_uuid in ["doc-1", "doc-2"]
+    ]
+
+    class StaticRetriever(BaseRetriever):
+        def _retrieve(self, query_bundle):
+            return nodes
+
+    retriever = ActiveDocumentsRetriever(StaticRetriever(), frozenset({"doc-1"}))
+    assert [node.node.text for node in retriever.retrieve("where")] == ["doc-2"]
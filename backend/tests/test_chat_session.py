@@ -0,0 +1,72 @@
+import time
+from typing import List, Optional
+
+import pytest
+
+pytest.importorskip("llama_index")
+
+from llama_index.llms.types import ChatMessage, MessageRole
+
+from app.core import chat_session
+from app.core.chat_session import ChatSessionStore
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(chat_session, "count_tokens", lambda text: len(text.split()))
+
+
+def user(content: str) -> ChatMessage:
+    return ChatMessage(role=MessageRole.USER, content=content)
+
+
+def assistant(content: str) -> ChatMessage:
+    return ChatMessage(role=MessageRole.ASSISTANT, content=content)
+
+
+def test_sessions_are_kept_per_user_until_they_expire():
+    store = ChatSessionStore(max_sessions=10, ttl=0.05)
+    session = store.create("a", [user("hi there"), assistant("hello")])
+    assert session.total_tokens == 3
+    assert store.get(session.id, "a") is session
+    # Another user can't continue it.
+    assert store.get(session.id, "b") is None
+
+    time.sleep(0.1)
+    assert store.get(session.id, "a") is None
+    assert store.stats()["expired"] == 1
+
+
+def test_least_recently_used_session_is_dropped():
+    store = ChatSessionStore(max_sessions=2, ttl=60)
+    first, second = store.create("a"), store.create("a")
+    store.get(first.id, "a")
+    store.create("a")
+    assert store.get(second.id, "a") is None
+    assert store.get(first.id, "a") is first
+
+
+def test_compaction_folds_old_turns_into_the_summary():
+    session = ChatSessionStore().create("a", [
+        user("one two three"), assistant("four five"), user("six seven"), assistant("eight"),
+    ])
+    summarized: List[List[str]] = []
+
+    def summarize(summary: Optional[str], messages: List[ChatMessage]) -> str:
+        assert summary is None
+        summarized.append([message.content for message in messages])
+        return "counting"
+
+    assert session.needs_compaction(token_budget=5)
+    session.compact(summarize, keep_tokens=3)
+    assert summarized == [["one two three", "four five"]]
+    assert session.summary == "counting" and session.summary_tokens == 1
+    assert session.messages == [user("six seven"), assistant("eight")]
+    assert session.total_tokens == 3
+    assert not session.needs_compaction(token_budget=5)
+
+    history = session.history(token_limit=3)
+    assert history[0].role == MessageRole.SYSTEM
+    assert history[0].content.endswith("counting")
+    # "six seven" doesn't fit with the summary; the history can't start with the answer.
+    assert history[1:] == []
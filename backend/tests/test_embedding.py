@@ -0,0 +1,64 @@
+import threading
+from typing import List
+
+import pytest
+
+pytest.importorskip("llama_index")
+
+from app.core.embedding import EmbeddingBatcher
+
+
+def count_words(texts: List[str]) -> List[int]:
+    return [len(text.split()) for text in texts]
+
+
+def run_concurrently(batcher: EmbeddingBatcher, calls: List[List[str]]) -> list:
+    results = [None] * len(calls)
+    start = threading.Barrier(len(calls))
+
+    def call(n: int) -> None:
+        start.wait()
+        try:
+            results[n] = batcher.embed(calls[n])
+        except Exception as e:
+            results[n] = e
+
+    threads = [threading.Thread(target=call, args=(n,)) for n in range(len(calls))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_each_caller_gets_the_embeddings_of_its_own_texts():
+    passes = []
+
+    def embed(texts: List[str]) -> List[List[float]]:
+        passes.append(texts)
+        # The "embedding" tells which text it was computed from.
+        return [[text] for text in texts]
+
+    batcher = EmbeddingBatcher(
+        embed, count_words, max_wait=0.2, max_batch_tokens=8, buckets=(2, 8))
+    calls = [
+        ["a b c d e", "f"],
+        ["g h", "i j k l m n o", "p"],
+        ["q r s"],
+    ]
+    results = run_concurrently(batcher, calls)
+
+    assert results == [[[text] for text in texts] for texts in calls]
+    # Texts of different callers share passes, grouped by length bucket.
+    assert [sorted(texts) for texts in passes] == [
+        ["f", "g h", "p"], ["q r s"], ["a b c d e"], ["i j k l m n o"]]
+    assert batcher.stats()["requests"] == 3
+
+
+def test_a_failed_pass_fails_every_caller_of_the_batch():
+    def embed(texts: List[str]) -> List[List[float]]:
+        raise RuntimeError("out of memory")
+
+    batcher = EmbeddingBatcher(embed, count_words, max_wait=0.2)
+    results = run_concurrently(batcher, [["a"], ["b c"]])
+    assert [str(result) for result in results] == ["out of memory"] * 2
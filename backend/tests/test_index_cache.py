@@ -0,0 +1,147 @@
+import time
+import asyncio
+from typing import List
+
+import pytest
+
+pytest.importorskip("llama_index")
+pytest.importorskip("fsspec")
+
+import fsspec
+import llama_index
+from llama_index import (
+    MockEmbedding,
+    ServiceContext,
+    StorageContext,
+    SummaryIndex,
+    VectorStoreIndex,
+)
+from llama_index.schema import TextNode
+from llama_index.vector_stores import SimpleVectorStore
+
+from app.utils import index as index_utils
+from app.utils.index import (
+    EMBEDDING_FLOAT_BYTES,
+    NODE_OVERHEAD_BYTES,
+    IndexCache,
+    _estimate_index_size,
+    load_user_indices,
+    user_persist_dir,
+    write_index_delta,
+)
+
+
+@pytest.fixture(autouse=True)
+def service_context(monkeypatch):
+    monkeypatch.setattr(
+        llama_index, "global_service_context",
+        ServiceContext.from_defaults(llm=None, embed_model=MockEmbedding(embed_dim=2)))
+
+
+def make_nodes(*texts: str, embedding: List[float] = None) -> List[TextNode]:
+    return [TextNode(text=text, id_=text, embedding=embedding) for text in texts]
+
+
+def make_indices(nodes: List[TextNode]) -> dict:
+    storage_context = StorageContext.from_defaults()
+    return {
+        "summary": SummaryIndex(nodes=nodes, storage_context=storage_context),
+        "vector": None,
+    }
+
+
+def node_size(text: str, dim: int = 0) -> int:
+    return len(text) + dim * EMBEDDING_FLOAT_BYTES + NODE_OVERHEAD_BYTES
+
+
+def test_size_estimate_counts_embeddings():
+    assert _estimate_index_size(make_indices(make_nodes("abc"))) == node_size("abc")
+    # Uploaded nodes are stored in the docstore with their embedding.
+    indices = make_indices(make_nodes("abc", embedding=[0.0] * 1536))
+    assert _estimate_index_size(indices) == node_size("abc", 1536)
+
+
+def test_least_recently_used_user_is_evicted():
+    cache = IndexCache(max_bytes=2 * node_size("a"), ttl=60)
+    evicted = []
+    cache.on_evict(evicted.append)
+    for user_id in ["a", "b"]:
+        cache.put(user_id, make_indices(make_nodes(user_id)), cache.generation(user_id))
+    assert cache.get("a") is not None
+
+    cache.put("c", make_indices(make_nodes("c")), cache.generation("c"))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert evicted == ["b"]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_expired_entries_are_evicted():
+    cache = IndexCache(max_bytes=10 ** 6, ttl=0.05)
+    evicted = []
+    cache.on_evict(evicted.append)
+    cache.put("a", make_indices(make_nodes("a")), cache.generation("a"))
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert evicted == ["a"]
+    assert cache.stats()["size_bytes"] == 0
+
+
+def test_indices_loaded_before_an_invalidation_are_not_cached():
+    cache = IndexCache(max_bytes=10 ** 6, ttl=60)
+    generation = cache.generation("a")
+    # An upload finished while the indices were being loaded.
+    cache.invalidate("a")
+    cache.put("a", make_indices(make_nodes("a")), generation)
+    assert cache.get("a") is None
+
+    cache.put("a", make_indices(make_nodes("a")), cache.generation("a"))
+    assert cache.get("a") is not None
+
+
+def test_load_locks_are_dropped_with_their_entries():
+    cache = IndexCache(max_bytes=10 ** 6, ttl=60)
+
+    async def main():
+        async with cache.load_lock("a"):
+            cache.put("a", make_indices(make_nodes("a")), cache.generation("a"))
+            # Held by a loader: it must stay so the waiters share it.
+            cache.invalidate("a")
+            assert cache.stats()["load_locks"] == 1
+        cache.invalidate("a")
+        assert cache.stats()["load_locks"] == 0
+
+    asyncio.run(main())
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    fs = fsspec.filesystem("memory")
+    fs.store.clear()
+    monkeypatch.setattr(index_utils, "get_s3_fs", lambda: fs)
+    return fs
+
+
+def test_replayed_deltas_add_each_node_once(storage):
+    user_id = "user"
+    vector_store = SimpleVectorStore()
+    storage_context = StorageContext.from_defaults(vector_store=vector_store)
+    nodes = make_nodes("first", embedding=[1.0, 0.0])
+    VectorStoreIndex(nodes=nodes, storage_context=storage_context).set_index_id(
+        f"vector_{user_id}")
+    SummaryIndex(nodes=nodes, storage_context=storage_context).set_index_id(
+        f"summary_{user_id}")
+    storage_context.persist(persist_dir=user_persist_dir(user_id), fs=storage)
+
+    write_index_delta(user_id, "0001-job", make_nodes("second"), {"doc": "hash"})
+    # A compaction that stopped before deleting the deltas it already included.
+    indices, delta_paths = load_user_indices(vector_store, user_id)
+    storage_context = indices["vector"].storage_context
+    storage_context.persist(persist_dir=user_persist_dir(user_id), fs=storage)
+    write_index_delta(user_id, "0002-job", make_nodes("third"), {})
+
+    for _ in range(2):
+        indices, delta_paths = load_user_indices(vector_store, user_id)
+        assert len(delta_paths) == 2
+        assert indices["summary"].index_struct.nodes == ["first", "second", "third"]
+        assert indices["summary"].docstore.get_document_hash("doc") == "hash"
@@ -0,0 +1,222 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import Dict, List
+
+import pytest
+
+pytest.importorskip("llama_index")
+pytest.importorskip("sqlalchemy")
+
+import llama_index
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.text_splitter import TokenTextSplitter
+from llama_index.schema import Document, TextNode
+
+from app.core import ingest_jobs
+from app.core.ingest import tag_user_document
+from app.core.ingest_jobs import (
+    IngestionJob,
+    StageStatus,
+    UploadedFile,
+    embed_chunks,
+    embed_nodes,
+    parse_files,
+)
+
+
+class CountingEmbedding(BaseEmbedding):
+    calls: int = 0
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._get_text_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_text_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        self.calls += 1
+        return [float(len(text)), 1.0]
+
+
+@pytest.fixture
+def embedding_cache(monkeypatch) -> Dict[str, List[float]]:
+    cache: Dict[str, List[float]] = {}
+
+    async def get_cached_embeddings(keys):
+        return {key: cache[key] for key in keys if key in cache}
+
+    async def store_cached_embeddings(model_name, embeddings):
+        cache.update(embeddings)
+
+    monkeypatch.setattr(ingest_jobs, "get_cached_embeddings", get_cached_embeddings)
+    monkeypatch.setattr(ingest_jobs, "store_cached_embeddings", store_cached_embeddings)
+    return cache
+
+
+def upload(document_id: str, description: str) -> List[TextNode]:
+    """Chunks of the same two pages, uploaded as a new document."""
+    nodes = []
+    for page, text in enumerate(["Worked at Acme as an engineer.", "Studied physics."]):
+        document = Document(
+            text=text, metadata={"source": str(page + 1), "file_path": f"{document_id}.pdf"})
+        document = tag_user_document(document, document_id, description, "Where?", "user")
+        nodes.append(TextNode(
+            text=document.text,
+            metadata=document.metadata,
+            excluded_embed_metadata_keys=document.excluded_embed_metadata_keys,
+        ))
+    return nodes
+
+
+def new_job() -> IngestionJob:
+    return IngestionJob(
+        id="job", user_id="user", files=[], stages={"embed": StageStatus("embed")})
+
+
+def test_second_upload_of_same_file_is_served_from_cache(embedding_cache):
+    embed_model = CountingEmbedding(model_name="test-model")
+
+    first_job = new_job()
+    first = upload("doc-1", "My resume")
+    asyncio.run(embed_chunks(first_job, first, embed_model))
+    assert embed_model.calls == 2
+    assert first_job.cached_embeddings == 0
+
+    # Different document id and path: the embedded text is the same.
+    second_job = new_job()
+    second = upload("doc-2", "My resume")
+    asyncio.run(embed_chunks(second_job, second, embed_model))
+    assert embed_model.calls == 2
+    assert second_job.cached_embeddings == len(second)
+    assert [node.embedding for node in second] == [node.embedding for node in first]
+
+    # The description is embedded with the chunks.
+    third_job = new_job()
+    asyncio.run(embed_chunks(
+        third_job, upload("doc-3", "My resume, edited description"), embed_model))
+    assert embed_model.calls == 4
+    assert third_job.cached_embeddings == 0
+
+
+def test_chunks_are_embedded_while_the_next_pages_are_parsed(embedding_cache, monkeypatch):
+    embedded = threading.Event()
+    parsed_after_embedding = []
+
+    class SignalingEmbedding(CountingEmbedding):
+        def _get_text_embedding(self, text: str) -> List[float]:
+            embedded.set()
+            return super()._get_text_embedding(text)
+
+    def iter_user_documents(document_id, path, description, question, user_id):
+        for page, text in enumerate(["Worked at Acme.", "Studied physics."]):
+            if page:
+                parsed_after_embedding.append(embedded.wait(5))
+            document = Document(
+                text=text, metadata={"source": str(page + 1), "total_pages": 2})
+            yield tag_user_document(document, document_id, description, question, user_id)
+
+    embed_model = SignalingEmbedding(model_name="test-model", embed_batch_size=1)
+    monkeypatch.setattr(ingest_jobs, "iter_user_documents", iter_user_documents)
+    monkeypatch.setattr(
+        llama_index, "global_service_context",
+        SimpleNamespace(embed_model=embed_model, transformations=[TokenTextSplitter()]))
+
+    job = IngestionJob(
+        id="job", user_id="user", stages={
+            "parse": StageStatus("parse"), "embed": StageStatus("embed")},
+        files=[UploadedFile("doc-1", "user/doc-1.pdf", b"", "My resume", "Where?")])
+
+    async def main():
+        await parse_files(job)
+        await embed_nodes(job)
+
+    asyncio.run(main())
+    assert parsed_after_embedding == [True]
+    assert embed_model.calls == 2
+    assert all(node.embedding is not None for node in job.nodes)
+
+
+def test_failed_job_deletes_its_uploaded_files(monkeypatch):
+    deleted = []
+
+    async def failing_stage(job):
+        raise RuntimeError("parser crashed")
+
+    async def get_documents(user_id):
+        # The rows of the job are gone, an older document has the same name.
+        return [SimpleNamespace(s3_path="user/old.pdf")]
+
+    async def noop(*args):
+        return False
+
+    monkeypatch.setitem(ingest_jobs.INGEST_STAGES, "upload", failing_stage)
+    monkeypatch.setattr(ingest_jobs, "is_user_existed", noop)
+    monkeypatch.setattr(ingest_jobs, "delete_document", noop)
+    monkeypatch.setattr(ingest_jobs, "get_documents", get_documents)
+    monkeypatch.setattr(ingest_jobs, "invalidate_user_caches", noop)
+    monkeypatch.setattr(ingest_jobs, "get_s3_boto_client", lambda: SimpleNamespace(
+        delete_object=lambda Bucket, Key: deleted.append(Key)))
+
+    monkeypatch.setattr(ingest_jobs, "save_ingestion_job", noop)
+
+    async def main():
+        queue = ingest_jobs.IngestionQueue(max_attempts=1)
+        job = await queue.submit("user", [
+            UploadedFile("doc-1", "user/new.pdf", b"", "My resume", "Where?"),
+            UploadedFile("doc-2", "user/old.pdf", b"", "Old resume", "Where?"),
+        ])
+        await queue._run(job)
+        return job
+
+    job = asyncio.run(main())
+    assert job.status == "failed"
+    assert deleted == ["user/new.pdf"]
+
+
+def test_any_worker_reports_the_saved_status(monkeypatch):
+    saved: Dict[str, tuple] = {}
+    locked: List[str] = []
+
+    async def save_ingestion_job(job_id, user_id, state):
+        saved[job_id] = (user_id, state)
+
+    async def get_ingestion_job(job_id, user_id):
+        owner, state = saved.get(job_id, (None, None))
+        return state if owner == user_id else None
+
+    @asynccontextmanager
+    async def user_ingestion_lock(user_id):
+        locked.append(user_id)
+        yield
+
+    async def noop(*args):
+        return False
+
+    async def done_stage(job):
+        pass
+
+    for name in ingest_jobs.INGEST_STAGES:
+        monkeypatch.setitem(ingest_jobs.INGEST_STAGES, name, done_stage)
+    monkeypatch.setattr(ingest_jobs, "save_ingestion_job", save_ingestion_job)
+    monkeypatch.setattr(ingest_jobs, "get_ingestion_job", get_ingestion_job)
+    monkeypatch.setattr(ingest_jobs, "user_ingestion_lock", user_ingestion_lock)
+    monkeypatch.setattr(ingest_jobs, "delete_ingestion_jobs_before", noop)
+    monkeypatch.setattr(ingest_jobs, "is_user_existed", noop)
+    monkeypatch.setattr(ingest_jobs, "precompute_document_answer", noop)
+
+    async def main():
+        queue, other_worker = ingest_jobs.IngestionQueue(), ingest_jobs.IngestionQueue()
+        job = await queue.submit("user", [])
+        assert (await other_worker.status(job.id, "user"))["status"] == "queued"
+        queue.start()
+        await queue._queue.join()
+        await queue.stop()
+        assert await other_worker.status(job.id, "user") == job.to_dict()
+        assert await other_worker.status(job.id, "someone else") is None
+        return job
+
+    job = asyncio.run(main())
+    assert job.status == "done"
+    assert locked == ["user"]
@@ -0,0 +1,68 @@
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("llama_index")
+
+from llama_index.schema import TextNode
+from llama_index.vector_stores.types import (
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+)
+
+from app.db.memmap_vector import MemmapVectorStore
+
+
+def user_filters(user_id: str) -> MetadataFilters:
+    return MetadataFilters(filters=[
+        MetadataFilter(key="user_id", operator=FilterOperator.EQ, value=user_id)])
+
+
+@pytest.fixture
+def vector_store(tmp_path) -> MemmapVectorStore:
+    store = MemmapVectorStore(path=str(tmp_path), embed_dim=2)
+    store.add([
+        TextNode(
+            text=f"Chunk {n}", id_=f"node-{n}", embedding=[1.0, float(n)],
+            metadata={"user_id": "user", "doc_uuid": f"doc-{n}", "is_active": True})
+        for n in range(2)
+    ])
+    return store
+
+
+def test_deactivated_nodes_are_returned_with_their_new_metadata(vector_store):
+    asyncio.run(vector_store.set_documents_active("user", ["doc-0"], False))
+    result = vector_store.query(VectorStoreQuery(
+        query_embedding=[1.0, 0.0], similarity_top_k=2, filters=user_filters("user")))
+    is_active = {node.node_id: node.metadata["is_active"] for node in result.nodes}
+    assert is_active == {"node-0": False, "node-1": True}
+
+
+def test_deleting_a_user_waits_for_its_lock_off_the_event_loop(vector_store, tmp_path):
+    user = vector_store._user("user")
+    locked, release = threading.Event(), threading.Event()
+
+    def search_in_flight():
+        with user.lock:
+            locked.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=search_in_flight)
+    thread.start()
+    locked.wait(5)
+
+    async def main():
+        delete = asyncio.create_task(vector_store.delete_user_rows("user"))
+        # The event loop keeps running while the deletion waits for the lock.
+        await asyncio.sleep(0.05)
+        assert not delete.done()
+        release.set()
+        await delete
+
+    asyncio.run(main())
+    thread.join(5)
+    assert not any(tmp_path.iterdir())
+    assert not asyncio.run(vector_store.has_user_rows("user"))
@@ -0,0 +1,413 @@
+import re
+import json
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+from types import SimpleNamespace
+from typing import List
+
+import pytest
+
+pytest.importorskip("llama_index")
+pytest.importorskip("sqlalchemy")
+
+import sqlalchemy
+from llama_index.schema import TextNode
+from llama_index.vector_stores import FilterOperator, MetadataFilter, MetadataFilters
+from llama_index.vector_stores.types import VectorStoreQuery, VectorStoreQueryMode
+from sqlalchemy.dialects import postgresql
+
+from app.db import pg_vector
+from app.db.pg_vector import CustomPGVectorStore
+
+
+def make_vector_store() -> CustomPGVectorStore:
+    # Nothing connects to the database until the store is used.
+    return CustomPGVectorStore.from_params(
+        "localhost", 5432, "test", "test", "test", "vectors",
+        embed_dim=4, hybrid_search=True, text_search_config="english")
+
+
+@pytest.fixture
+def vector_store() -> CustomPGVectorStore:
+    return make_vector_store()
+
+
+@pytest.fixture(params=["none", "halfvec"])
+def any_vector_store(request, monkeypatch) -> CustomPGVectorStore:
+    """A store for each kind of vector column, built after the setting is patched."""
+    monkeypatch.setattr(pg_vector, "VECTOR_QUANTIZATION", request.param)
+    return make_vector_store()
+
+
+def user_query(mode: VectorStoreQueryMode = VectorStoreQueryMode.DEFAULT) -> VectorStoreQuery:
+    return VectorStoreQuery(
+        query_embedding=[1.0, 0.0, 0.0, 0.0],
+        similarity_top_k=3,
+        query_str="where did you work",
+        mode=mode,
+        filters=MetadataFilters(filters=[
+            MetadataFilter(key="user_id", operator=FilterOperator.EQ, value="user"),
+            MetadataFilter(key="is_active", operator=FilterOperator.EQ, value="true"),
+        ]),
+    )
+
+
+def compile_sql(stmt) -> str:
+    return str(stmt.compile(dialect=postgresql.dialect()))
+
+
+def test_ef_search_is_never_below_the_rows_fetched(vector_store):
+    assert vector_store._search_settings(3, hnsw_ef_search=40) == [
+        "SET LOCAL hnsw.ef_search = 40"]
+    assert vector_store._search_settings(100, hnsw_ef_search=40) == [
+        "SET LOCAL hnsw.ef_search = 100"]
+
+
+def test_iterative_scan_follows_the_index_type(vector_store, monkeypatch):
+    monkeypatch.setattr(pg_vector, "VECTOR_ITERATIVE_SCAN", "relaxed_order")
+    assert vector_store._search_settings(3, hnsw_ef_search=40) == [
+        "SET LOCAL hnsw.ef_search = 40",
+        "SET LOCAL hnsw.iterative_scan = relaxed_order",
+    ]
+    assert vector_store._search_settings(3, ivfflat_probes=10) == [
+        "SET LOCAL ivfflat.probes = 10",
+        "SET LOCAL ivfflat.iterative_scan = relaxed_order",
+    ]
+    # Exact search: nothing to set.
+    assert vector_store._search_settings(3) == []
+
+    monkeypatch.setattr(pg_vector, "VECTOR_ITERATIVE_SCAN", "1; DROP TABLE x")
+    with pytest.raises(ValueError):
+        vector_store._search_settings(3, hnsw_ef_search=40)
+
+
+def test_vector_index_definition_matches_pg_indexes(vector_store, monkeypatch):
+    monkeypatch.setattr(pg_vector, "VECTOR_INDEX_TYPE", "hnsw")
+    assert vector_store._vector_index_definition() == (
+        "USING hnsw (embedding vector_cosine_ops) WITH (m='16', ef_construction='64')")
+    monkeypatch.setattr(pg_vector, "VECTOR_INDEX_TYPE", "none")
+    assert vector_store._vector_index_definition() is None
+
+
+def test_text_search_matches_any_word_of_the_query(vector_store):
+    compiled = vector_store._text_search_query("where did you work").compile(
+        dialect=postgresql.dialect())
+    assert str(compiled) == (
+        "CAST(replace(CAST(plainto_tsquery(%(param_1)s, %(plainto_tsquery_1)s) AS TEXT), "
+        "%(replace_1)s, %(replace_2)s) AS TSQUERY)")
+    assert compiled.params == {
+        "param_1": "english",
+        "plainto_tsquery_1": "where did you work",
+        "replace_1": " & ",
+        "replace_2": " | ",
+    }
+
+
+class CopyRecorder:
+    """Engine whose connections keep what COPY would have read."""
+
+    def __init__(self) -> None:
+        self.statements: List[str] = []
+        self.data = ""
+
+    @contextmanager
+    def begin(self):
+        yield self
+
+    def execute(self, statement) -> None:
+        self.statements.append(str(statement))
+
+    @property
+    def connection(self) -> "CopyRecorder":
+        return self
+
+    def cursor(self) -> "CopyRecorder":
+        return self
+
+    def copy_expert(self, sql: str, file) -> None:
+        self.statements.append(sql)
+        self.data = file.read()
+
+    def close(self) -> None:
+        pass
+
+
+def copy_unescape(field: str) -> str:
+    """Read a field like the text format of COPY does."""
+    return re.sub(
+        r"\\(.)", lambda m: {"t": "\t", "n": "\n", "r": "\r"}.get(m[1], m[1]), field)
+
+
+def test_copy_lines_round_trip_special_characters(vector_store, monkeypatch):
+    engine = CopyRecorder()
+    monkeypatch.setattr(vector_store, "_is_initialized", True)
+    monkeypatch.setattr(vector_store, "_engine", engine, raising=False)
+    text = "C:\\Users\\me\tskills\nPython\r\n\x00end"
+    node = TextNode(
+        text=text, id_="node", embedding=[0.5, -1.0, 0.0, 2.0],
+        metadata={"user_id": "user", "file_name": "a\\b\tc\n.pdf"})
+
+    assert vector_store.add([node]) == ["node"]
+    assert engine.statements == [
+        "COPY public.data_vectors (node_id, text, metadata_, embedding) FROM STDIN"]
+    lines = engine.data.split("\n")
+    assert lines[1:] == [""]
+    node_id, copied_text, metadata, embedding = map(copy_unescape, lines[0].split("\t"))
+    assert node_id == "node"
+    # NUL characters can't be stored in Postgres text.
+    assert copied_text == text.replace("\x00", "")
+    assert json.loads(metadata)["file_name"] == "a\\b\tc\n.pdf"
+    assert embedding == "[0.5,-1.0,0.0,2.0]"
+
+
+def test_vector_and_hybrid_queries_read_named_columns(any_vector_store):
+    query = user_query(VectorStoreQueryMode.HYBRID)
+    stmt = any_vector_store._build_query(
+        query.query_embedding, query.similarity_top_k, query.filters)
+    assert list(stmt.selected_columns.keys()) == [
+        "id", "node_id", "text", "metadata_", "distance"]
+    assert "ORDER BY distance" in compile_sql(stmt)
+
+    hybrid = any_vector_store._build_hybrid_query(query)
+    assert list(hybrid.selected_columns.keys()) == ["node_id", "text", "metadata_", "score"]
+    sql = compile_sql(hybrid)
+    assert "row_number() OVER (ORDER BY dense_hits.distance)" in sql
+    assert "user_id = %(user_id_1)s" in sql
+
+
+class ResultSession:
+    """Session answering a query with real rows of the columns it selects."""
+
+    def __init__(self, values: dict) -> None:
+        self.values = values
+        self.settings: List[str] = []
+        self._engine = sqlalchemy.create_engine("sqlite://")
+
+    def __enter__(self) -> "ResultSession":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    @contextmanager
+    def begin(self):
+        yield self
+
+    def execute(self, stmt):
+        if isinstance(stmt, sqlalchemy.TextClause):
+            self.settings.append(str(stmt))
+            return None
+        row = sqlalchemy.select(*[
+            sqlalchemy.literal(self.values[key], sqlalchemy.JSON if key == "metadata_" else None)
+            .label(key)
+            for key in stmt.selected_columns.keys()
+        ])
+        with self._engine.connect() as conn:
+            return conn.execute(row).freeze()()
+
+
+class AsyncResultSession(ResultSession):
+    async def __aenter__(self) -> "AsyncResultSession":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        pass
+
+    @asynccontextmanager
+    async def begin(self):
+        yield self
+
+    async def execute(self, stmt):
+        return ResultSession.execute(self, stmt)
+
+
+def test_vector_search_rows_become_embedding_rows(any_vector_store, monkeypatch):
+    values = {
+        "id": 1, "node_id": "node", "text": "Worked at Acme.",
+        "metadata_": {"user_id": "user"}, "distance": 0.25,
+    }
+    session = ResultSession(values)
+    async_session = AsyncResultSession(values)
+    monkeypatch.setattr(any_vector_store, "_is_initialized", True)
+    monkeypatch.setattr(any_vector_store, "_session", lambda: session, raising=False)
+    monkeypatch.setattr(
+        any_vector_store, "_async_session", lambda: async_session, raising=False)
+    query = user_query()
+
+    rows = any_vector_store._query_with_score(
+        query.query_embedding, 3, query.filters, hnsw_ef_search=40)
+    assert [tuple(row) for row in rows] == [
+        ("node", "Worked at Acme.", {"user_id": "user"}, 0.75)]
+    assert session.settings[0].startswith("SET LOCAL hnsw.ef_search")
+
+    rows = asyncio.run(any_vector_store._aquery_with_score(
+        query.query_embedding, 3, query.filters))
+    assert [tuple(row) for row in rows] == [
+        ("node", "Worked at Acme.", {"user_id": "user"}, 0.75)]
+
+
+class SchemaConnection:
+    """Connection to a data table that has the given columns and no indexes."""
+
+    def __init__(self, columns: List[str]) -> None:
+        self.columns = columns
+
+    async def __aenter__(self) -> "SchemaConnection":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        pass
+
+    def connect(self) -> "SchemaConnection":
+        return self
+
+    async def execute(self, stmt, params=None):
+        return sqlalchemy.create_engine("sqlite://").connect().execute(
+            sqlalchemy.select(sqlalchemy.literal(self.columns[0]).label("c")).union_all(*[
+                sqlalchemy.select(sqlalchemy.literal(column)) for column in self.columns[1:]
+            ])).freeze()()
+
+
+def schema_vector_store(monkeypatch, columns: List[str]) -> CustomPGVectorStore:
+    monkeypatch.setattr(pg_vector, "VECTOR_INDEX_TYPE", "ivfflat")
+    monkeypatch.setattr(pg_vector, "did_run_setup", False)
+    store = make_vector_store()
+    monkeypatch.setattr(store, "_is_initialized", True)
+    monkeypatch.setattr(
+        store, "_async_engine", SchemaConnection(columns), raising=False)
+
+    async def relkind(self, conn):
+        return "r"
+
+    async def missing(self, conn, *args):
+        return None
+
+    monkeypatch.setattr(CustomPGVectorStore, "_relkind", relkind)
+    monkeypatch.setattr(CustomPGVectorStore, "_index_is_valid", missing)
+    monkeypatch.setattr(CustomPGVectorStore, "_vector_index", missing)
+    return store
+
+
+def test_startup_refuses_missing_columns(monkeypatch):
+    store = schema_vector_store(monkeypatch, ["id", "text"])
+    with pytest.raises(RuntimeError, match="add column text_search_tsv"):
+        asyncio.run(store.run_setup())
+    assert not pg_vector.did_run_setup
+
+
+def test_missing_ivfflat_index_is_pending(monkeypatch):
+    columns = ["id", "text", "text_search_tsv", *pg_vector.TENANT_COLUMNS]
+    store = schema_vector_store(monkeypatch, columns)
+    assert "build the ivfflat vector index" in asyncio.run(store.pending_migrations())
+    # Indexes only make the queries faster: the app still starts.
+    asyncio.run(store.run_setup())
+    assert pg_vector.did_run_setup
+
+
+def test_hybrid_search_sizes_ef_search_for_the_dense_candidates(any_vector_store, monkeypatch):
+    values = {"node_id": "node", "text": "Worked at Acme.", "metadata_": {}, "score": 0.03}
+    session = ResultSession(values)
+    async_session = AsyncResultSession(values)
+    monkeypatch.setattr(any_vector_store, "_is_initialized", True)
+    monkeypatch.setattr(any_vector_store, "_session", lambda: session, raising=False)
+    monkeypatch.setattr(
+        any_vector_store, "_async_session", lambda: async_session, raising=False)
+    monkeypatch.setattr(pg_vector, "HYBRID_CANDIDATES", 50)
+    monkeypatch.setattr(pg_vector, "VECTOR_RERANK_FACTOR", 4)
+    query = user_query(VectorStoreQueryMode.HYBRID)
+    # The quantized ranking fetches the candidates of the rerank.
+    expected = 50 if pg_vector.VECTOR_QUANTIZATION == "none" else 200
+
+    rows = any_vector_store._hybrid_query(query, hnsw_ef_search=40)
+    assert [row.similarity for row in rows] == [0.03]
+    rows = asyncio.run(any_vector_store._async_hybrid_query(query, hnsw_ef_search=40))
+    assert [row.similarity for row in rows] == [0.03]
+    assert session.settings == async_session.settings == [
+        f"SET LOCAL hnsw.ef_search = {expected}"]
+
+
+class RecordingAsyncSession:
+    """Async session recording its statements, answering with the given row counts."""
+
+    def __init__(self, rowcounts: List[int]) -> None:
+        self.rowcounts = rowcounts
+        self.statements: List[tuple] = []
+
+    async def __aenter__(self) -> "RecordingAsyncSession":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        pass
+
+    @asynccontextmanager
+    async def begin(self):
+        yield self
+
+    async def execute(self, stmt, params=None):
+        self.statements.append((str(stmt), params))
+        return SimpleNamespace(rowcount=self.rowcounts.pop(0) if self.rowcounts else 0)
+
+
+def recording_vector_store(monkeypatch, session: RecordingAsyncSession) -> CustomPGVectorStore:
+    store = make_vector_store()
+    monkeypatch.setattr(store, "_is_initialized", True)
+    monkeypatch.setattr(store, "_async_session", lambda: session, raising=False)
+    return store
+
+
+@pytest.mark.parametrize("quantization, operator", [("halfvec", "<=>"), ("binary", "<~>")])
+def test_quantized_search_reranks_the_candidates(monkeypatch, quantization, operator):
+    monkeypatch.setattr(pg_vector, "VECTOR_QUANTIZATION", quantization)
+    monkeypatch.setattr(pg_vector, "VECTOR_RERANK_FACTOR", 4)
+    query = user_query()
+    compiled = make_vector_store()._build_query(
+        query.query_embedding, 3, query.filters).compile(dialect=postgresql.dialect())
+    sql = str(compiled)
+
+    # The candidates are found on the quantized vectors, with the filters...
+    candidates = sql[sql.index("(SELECT"):sql.index(") AS candidates")]
+    assert f"ORDER BY public.data_vectors.embedding_q {operator}" in candidates
+    assert "user_id = %(user_id_1)s" in candidates
+    # ...then reranked by their full precision distance.
+    assert candidates.endswith("LIMIT %(param_2)s")
+    assert sql.endswith("ORDER BY distance \n LIMIT %(param_3)s")
+    assert compiled.params["param_2"] == 12 and compiled.params["param_3"] == 3
+
+
+@pytest.mark.parametrize("quantization, expression", [
+    ("halfvec", "embedding::halfvec(4)"),
+    ("binary", "binary_quantize(embedding)::bit(4)"),
+])
+def test_backfill_quantizes_in_batches(monkeypatch, quantization, expression):
+    monkeypatch.setattr(pg_vector, "VECTOR_QUANTIZATION", quantization)
+    session = RecordingAsyncSession([2, 2, 1])
+    store = recording_vector_store(monkeypatch, session)
+
+    assert asyncio.run(store.backfill_quantized(batch_size=2)) == 5
+    assert len(session.statements) == 3
+    sql, params = session.statements[0]
+    assert sql.startswith(f"UPDATE public.data_vectors SET embedding_q = {expression} ")
+    assert "WHERE embedding_q IS NULL AND embedding IS NOT NULL LIMIT :batch_size" in sql
+    assert params == {"batch_size": 2}
+
+
+def test_documents_are_toggled_in_the_metadata(monkeypatch):
+    session = RecordingAsyncSession([])
+    store = recording_vector_store(monkeypatch, session)
+
+    asyncio.run(store.set_documents_active("user", ["doc-1", "doc-2"], False))
+    [(sql, params)] = session.statements
+    # The generated is_active column is computed from the metadata.
+    assert sql.startswith(
+        "UPDATE public.data_vectors SET metadata_ = jsonb_set(metadata_::jsonb, "
+        "'{is_active}', to_jsonb(CAST(:is_active AS boolean)))::")
+    assert sql.endswith("WHERE user_id = :user_id AND doc_uuid = ANY(:doc_uuids)")
+    assert params == {"is_active": False, "user_id": "user", "doc_uuids": ["doc-1", "doc-2"]}
+
+
+def test_is_active_filter_compares_booleans(vector_store):
+    compiled = vector_store._build_query(
+        [1.0, 0.0, 0.0, 0.0], 3, user_query().filters).compile(dialect=postgresql.dialect())
+    assert "(is_active = %(is_active_1)s)" in str(compiled)
+    # Metadata filters hold strings: "true" must match the boolean column.
+    assert compiled.params["is_active_1"] is True
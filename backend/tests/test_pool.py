@@ -0,0 +1,55 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+
+import httpx
+from fastapi import APIRouter, Depends, FastAPI
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from app.api.api import tag_endpoint
+from app.db.pool import PoolMetrics, current_endpoint, instrumented_pool
+
+
+def test_requests_are_tagged_with_their_route():
+    router = APIRouter(dependencies=[Depends(tag_endpoint)])
+
+    @router.get("/jobs/{job_id}")
+    async def get_job(job_id: str) -> str:
+        return current_endpoint.get()
+
+    app = FastAPI()
+    app.include_router(router, prefix="/api")
+
+    async def main():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return [(await client.get(f"/api/jobs/{job_id}")).json() for job_id in "12"]
+
+    assert asyncio.run(main()) == ["GET /api/jobs/{job_id}"] * 2
+
+
+def test_checkouts_and_timeouts_are_counted_per_endpoint():
+    metrics = PoolMetrics("test")
+    pool = instrumented_pool(QueuePool, metrics)(
+        lambda: sqlite3.connect(":memory:"), pool_size=1, max_overflow=0, timeout=0.01)
+    held = pool.connect()
+    token = current_endpoint.set("GET /api/chat")
+    try:
+        with pytest.raises(PoolTimeoutError):
+            pool.connect()
+    finally:
+        current_endpoint.reset(token)
+    held.close()
+    pool.connect().close()
+
+    stats = metrics.stats()
+    assert stats["max_checked_out"] == 1
+    assert stats["size"] == 1 and stats["checked_out"] == 0
+    assert stats["endpoints"]["GET /api/chat"]["timeouts"] == 1
+    assert stats["endpoints"]["GET /api/chat"]["checkouts"] == 0
+    assert stats["endpoints"]["background"]["checkouts"] == 2
@@ -0,0 +1,85 @@
+import time
+import asyncio
+from types import SimpleNamespace
+from typing import Dict, List
+
+import pytest
+
+pytest.importorskip("llama_index")
+
+import llama_index
+
+from app.core import precompute
+from app.core.precompute import DocumentAnswers
+
+
+class QuestionEmbedding:
+    def get_query_embedding(self, question: str) -> List[float]:
+        return [1.0, 0.0] if "where" in question.lower() else [0.0, 1.0]
+
+
+@pytest.fixture
+def database(monkeypatch) -> Dict[str, list]:
+    """Documents rows by user, and the number of times they were loaded."""
+    rows: Dict[str, list] = {"loads": []}
+
+    async def get_documents(user_id):
+        rows["loads"].append(user_id)
+        await asyncio.sleep(0.01)
+        return rows.get(user_id, [])
+
+    async def is_document_answer_current(user_id, question, answer):
+        return any(
+            document.is_active and document.question == question
+            and document.answer == answer
+            for document in rows.get(user_id, [])
+        )
+
+    monkeypatch.setattr(precompute, "get_documents", get_documents)
+    monkeypatch.setattr(
+        precompute, "is_document_answer_current", is_document_answer_current)
+    monkeypatch.setattr(
+        llama_index, "global_service_context",
+        SimpleNamespace(embed_model=QuestionEmbedding()))
+    return rows
+
+
+def document(question: str, answer: str, is_active: bool = True) -> SimpleNamespace:
+    return SimpleNamespace(question=question, answer=answer, is_active=is_active)
+
+
+def test_concurrent_lookups_load_once(database):
+    database["user"] = [document("Where did you work?", "At Acme.")]
+    answers = DocumentAnswers(ttl=60)
+
+    async def main():
+        return await asyncio.gather(*[
+            answers.lookup("user", [1.0, 0.0]) for _ in range(5)])
+
+    assert asyncio.run(main()) == ["At Acme."] * 5
+    assert database["loads"] == ["user"]
+
+
+def test_answer_changed_by_another_worker_is_not_served(database):
+    database["user"] = [document("Where did you work?", "At Acme.")]
+    answers = DocumentAnswers(ttl=60)
+    assert asyncio.run(answers.lookup("user", [1.0, 0.0])) == "At Acme."
+
+    # Another worker deactivated the document: this worker wasn't told.
+    database["user"] = [document("Where did you work?", "At Acme.", is_active=False)]
+    assert asyncio.run(answers.lookup("user", [1.0, 0.0])) is None
+    assert answers.stats()["stale_hits"] == 1
+
+    # ...then regenerated an answer: it is loaded again from the database.
+    database["user"] = [document("Where did you work?", "At Initech.")]
+    assert asyncio.run(answers.lookup("user", [1.0, 0.0])) == "At Initech."
+
+
+def test_answers_are_reloaded_after_the_ttl(database):
+    answers = DocumentAnswers(ttl=0.05)
+    assert asyncio.run(answers.lookup("user", [1.0, 0.0])) is None
+
+    time.sleep(0.1)
+    database["user"] = [document("Where did you work?", "At Acme.")]
+    assert asyncio.run(answers.lookup("user", [1.0, 0.0])) == "At Acme."
+    assert database["loads"] == ["user", "user"]
@@ -0,0 +1,69 @@
+from typing import List
+
+import pytest
+
+pytest.importorskip("llama_index")
+
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.schema import QueryBundle
+from llama_index.selectors.types import BaseSelector, SelectorResult, SingleSelection
+from llama_index.tools.types import ToolMetadata
+
+from app.core.router import ConfidentEmbeddingSelector
+
+VECTORS = {
+    "specific": [1.0, 0.0],
+    "summary": [0.0, 1.0],
+    "clearly specific": [1.0, 0.1],
+    "ambiguous": [1.0, 0.98],
+}
+
+
+class TableEmbedding(BaseEmbedding):
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return VECTORS[query]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return VECTORS[query]
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return VECTORS[text]
+
+
+class CountingSelector(BaseSelector):
+    calls = 0
+
+    def _get_prompts(self):
+        return {}
+
+    def _update_prompts(self, prompts) -> None:
+        pass
+
+    def _select(self, choices, query) -> SelectorResult:
+        self.calls += 1
+        return SelectorResult(selections=[SingleSelection(index=1, reason="llm")])
+
+    async def _aselect(self, choices, query) -> SelectorResult:
+        return self._select(choices, query)
+
+
+CHOICES = [
+    ToolMetadata(name="vector", description="specific"),
+    ToolMetadata(name="summary", description="summary"),
+]
+
+
+def test_ambiguous_query_goes_to_the_fallback():
+    fallback = CountingSelector()
+    selector = ConfidentEmbeddingSelector(TableEmbedding(), fallback=fallback)
+
+    assert selector.select(CHOICES, QueryBundle("clearly specific")).ind == 0
+    assert selector.select(CHOICES, QueryBundle("ambiguous")).ind == 1
+    assert fallback.calls == 1
+
+
+def test_without_fallback_the_best_score_is_taken():
+    selector = ConfidentEmbeddingSelector(TableEmbedding())
+
+    assert selector.select(CHOICES, QueryBundle("ambiguous")).ind == 0
+    assert selector.stats() == {"embedding_selections": 1, "fallback_selections": 0}
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+from app.core.scheduler import InferenceScheduler, SchedulerOverloaded
+
+
+def test_free_slot_is_taken_without_queueing():
+    async def main():
+        scheduler = InferenceScheduler(concurrency=1, max_wait=60)
+        await scheduler.acquire("user")
+        assert scheduler.stats()["running"] == 1
+        assert scheduler.queue_depth == 0
+        scheduler.release()
+        assert scheduler.stats()["running"] == 0
+
+    asyncio.run(main())
+
+
+def test_release_hands_the_slot_to_the_next_waiter():
+    async def main():
+        scheduler = InferenceScheduler(concurrency=1, max_wait=60)
+        await scheduler.acquire("a")
+        waiter = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 1
+        assert not waiter.done()
+
+        scheduler.release()
+        await waiter
+        assert scheduler.queue_depth == 0
+        assert scheduler.stats()["running"] == 1
+        scheduler.release()
+        assert scheduler.stats()["running"] == 0
+
+    asyncio.run(main())
+
+
+def test_requests_over_the_wait_budget_are_rejected():
+    async def main():
+        scheduler = InferenceScheduler(
+            concurrency=1, max_wait=15, service_time_prior=10)
+        await scheduler.acquire("a")
+        # One service time ahead: within the budget.
+        scheduler.check_admission()
+        queued = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+
+        # Two service times ahead.
+        with pytest.raises(SchedulerOverloaded) as e:
+            await scheduler.acquire("c")
+        assert e.value.retry_after == 20
+        with pytest.raises(SchedulerOverloaded):
+            scheduler.check_admission()
+        assert scheduler.rejected == 2
+
+        # Background work queues regardless of the budget.
+        background = asyncio.create_task(scheduler.acquire("c", wait=True))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 2
+
+        scheduler.release()
+        await queued
+        scheduler.release()
+        await background
+        scheduler.release()
+        assert scheduler.stats()["running"] == 0
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def main():
+        scheduler = InferenceScheduler(concurrency=1, max_wait=60)
+        await scheduler.acquire("a")
+        waiter = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert scheduler.queue_depth == 0
+
+        scheduler.release()
+        assert scheduler.stats()["running"] == 0
+
+    asyncio.run(main())
+
+
+def test_slot_handed_over_to_a_cancelled_waiter_is_passed_on():
+    async def main():
+        scheduler = InferenceScheduler(concurrency=1, max_wait=60)
+        await scheduler.acquire("a")
+        cancelled = asyncio.create_task(scheduler.acquire("b"))
+        second = asyncio.create_task(scheduler.acquire("c"))
+        await asyncio.sleep(0)
+
+        # The slot goes to "b", which is cancelled before it runs again.
+        scheduler.release()
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        await second
+        assert scheduler.stats()["running"] == 1
+        scheduler.release()
+        assert scheduler.stats()["running"] == 0
+
+    asyncio.run(main())
+
+
+def test_fair_policy_alternates_between_users():
+    async def main():
+        scheduler = InferenceScheduler(concurrency=1, policy="fair", max_wait=600)
+        await scheduler.acquire("busy")
+        order = []
+
+        async def generate(user_id: str, n: int) -> None:
+            await scheduler.acquire(user_id)
+            order.append((user_id, n))
+            scheduler.release()
+
+        tasks = [asyncio.create_task(generate("busy", n)) for n in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(generate("other", 0)))
+        await asyncio.sleep(0)
+
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        assert order[:2] == [("busy", 0), ("other", 0)]
+
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+import asyncio
+import threading
+import time
+from contextlib import aclosing
+
+import pytest
+
+pytest.importorskip("llama_index")
+
+from app.utils.stream import iterate_in_thread
+
+
+def test_items_are_streamed_in_order():
+    async def main():
+        return [item async for item in iterate_in_thread(lambda: iter(range(100)), maxsize=4)]
+
+    assert asyncio.run(main()) == list(range(100))
+
+
+def test_worker_errors_are_raised_to_the_consumer():
+    def failing():
+        yield 1
+        raise ValueError("boom")
+
+    async def main():
+        async for _ in iterate_in_thread(failing):
+            pass
+
+    with pytest.raises(ValueError, match="boom"):
+        asyncio.run(main())
+
+
+def test_early_stop_closes_the_iterator_before_on_done():
+    closed = threading.Event()
+    events = []
+
+    def endless():
+        try:
+            n = 0
+            while True:
+                yield n
+                n += 1
+                time.sleep(0.001)
+        finally:
+            # Like waiting for the LLM thread to finish.
+            time.sleep(0.05)
+            closed.set()
+
+    async def main():
+        done = asyncio.Event()
+
+        def on_done():
+            events.append(closed.is_set())
+            done.set()
+
+        async with aclosing(iterate_in_thread(endless, maxsize=1, on_done=on_done)) as items:
+            async for item in items:
+                if item == 3:
+                    break
+        # The consumer is gone, the worker still finishes on its own.
+        await asyncio.wait_for(done.wait(), 5)
+
+    asyncio.run(main())
+    assert events == [True]
+
+
+def test_cancelled_consumer_stops_a_blocked_worker():
+    produced = []
+
+    def numbers():
+        for n in range(1000):
+            produced.append(n)
+            yield n
+
+    async def main():
+        done = asyncio.Event()
+
+        async def consume():
+            async for _ in iterate_in_thread(numbers, maxsize=1, on_done=done.set):
+                # Never make room again: the worker blocks on the full queue.
+                await asyncio.sleep(3600)
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        await asyncio.wait_for(done.wait(), 5)
+
+    asyncio.run(main())
+    assert len(produced) < 1000
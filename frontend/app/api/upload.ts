@@ -0,0 +1,24 @@
+import axInstance from '@/app/api/config';
+import { IIngestionJob } from '@/app/interfaces/iingestion-job.interface';
+
+const sleep = (ms: number) => new Promise((resolve) => setTimeout(resolve, ms));
+
+/**
+ * Poll an ingestion job until it is done, and throw if it failed.
+ */
+export const waitForIngestionJob = async (
+    jobId: string,
+    onProgress?: (job: IIngestionJob) => void,
+    intervalMs: number = 1000,
+): Promise<IIngestionJob> => {
+    while (true) {
+        const { data } = await axInstance.get<IIngestionJob>(
+            `/chat/upload/jobs/${jobId}`,
+            { timeout: 10000 },
+        );
+        onProgress?.(data);
+        if (data.status === 'done') return data;
+        if (data.status === 'failed') throw new Error(data.error ?? 'Ingestion failed.');
+        await sleep(intervalMs);
+    }
+}
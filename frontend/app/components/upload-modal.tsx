@@ -4,7 +4,9 @@ import { UploadFile } from 'antd';
 import { UploadOutlined, InboxOutlined } from '@ant-design/icons';
 
 import { IDocumentGet } from '@/app/interfaces/idocument.interface';
+import { IIngestionJob } from '@/app/interfaces/iingestion-job.interface';
 import axInstance from '@/app/api/config';
+import { waitForIngestionJob } from '@/app/api/upload';
 import { useAuth } from "@/app/auth/provider";
 
 interface FormInputs {
@@ -48,7 +50,8 @@ const UploadModal: React.FC<UploadModelProps> = ({ onUploadSucces }) => {
                     formData.append('description', description)
                     formData.append('question', question)
 
-                    const { data } = await axInstance.post(
+                    // The upload is accepted right away and ingested in the background.
+                    const { data } = await axInstance.post<IIngestionJob>(
                         '/chat/upload/single',
                         formData,
                         {
@@ -60,15 +63,25 @@ const UploadModal: React.FC<UploadModelProps> = ({ onUploadSucces }) => {
                         }
                     );
                     messageApi.open({
+                        key: data.id,
+                        type: 'loading',
+                        content: 'Uploaded. Reading your document...',
+                        duration: 0,
+                    });
+                    await waitForIngestionJob(data.id);
+                    messageApi.open({
+                        key: data.id,
                         type: 'success',
-                        content: 'Uploaded. Go chat and leave me alone.',
+                        content: 'Ready. Go chat and leave me alone.',
                         duration: 3,
                     });
-                    onUploadSucces(data);
+                    data.documents?.forEach(onUploadSucces);
                 }
                 form.resetFields();
             })
             .catch((info) => {
+                // Also closes the message of a job that failed.
+                messageApi.destroy();
                 messageApi.open({
                     type: 'error',
                     content: 'Sorry, our sever fucked up.',
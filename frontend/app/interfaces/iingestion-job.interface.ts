@@ -0,0 +1,30 @@
+import { IDocumentGet } from '@/app/interfaces/idocument.interface';
+
+/**
+ * One stage (upload, parse, embed, index, persist) of an ingestion job.
+ */
+export interface IIngestionStage {
+    name: string;
+    status: 'pending' | 'running' | 'done' | 'failed';
+    progress: number;
+    attempts: number;
+    seconds: number | null;
+    error: string | null;
+}
+
+/**
+ * Background ingestion of uploaded documents, returned with status 202 by the
+ * upload endpoints and polled at `/chat/upload/jobs/{id}`.
+ */
+export interface IIngestionJob {
+    id: string;
+    status: 'queued' | 'running' | 'done' | 'failed';
+    error: string | null;
+    document_ids: string[];
+    // Only in the upload response: the documents are deleted if the job fails.
+    documents?: IDocumentGet[];
+    cached_embeddings: number;
+    created_at: number;
+    finished_at: number | null;
+    stages: IIngestionStage[];
+}
@@ -7,7 +7,9 @@ import { useFieldArray, useForm } from 'react-hook-form';
 import { PlusIcon, SendHorizonalIcon } from 'lucide-react';
 
 import { IDocumentGet } from "@/app/interfaces/idocument.interface";
+import { IIngestionJob } from "@/app/interfaces/iingestion-job.interface";
 import axInstance from "@/app/api/config";
+import { waitForIngestionJob } from "@/app/api/upload";
 import { useAuth } from "@/app/auth/provider";
 import ProtectedRoute from '@/app/components/protected-route';
 
@@ -97,8 +99,8 @@ const App = () => {
 
             // Set loading progress.
             setIsSubmitting(true);
-            const response = await axInstance.post(
-                '/chat/upload',
+            const { data: job } = await axInstance.post<IIngestionJob>(
+                '/chat/upload/multiple',
                 formData,
                 {
                     timeout: 20000,
@@ -108,7 +110,8 @@ const App = () => {
                     }
                 },
             );
-            console.log(response.data);
+            // Keep the loading state until the documents are ingested.
+            console.log(await waitForIngestionJob(job.id));
         } catch (error) {
             // TODO: handle this error too bitch.
             console.error(error);